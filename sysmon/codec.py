@@ -0,0 +1,807 @@
+#########################################################################
+# YASMon - Yet Another System Monitor                                   #
+# Copyright (C) 2010  Scott Lawrence                                    #
+#                                                                       #
+# This program is free software: you can redistribute it and/or modify  #
+# it under the terms of the GNU General Public License as published by  #
+# the Free Software Foundation, either version 3 of the License, or     #
+# (at your option) any later version.                                   #
+#                                                                       #
+# This program is distributed in the hope that it will be useful,       #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+# GNU General Public License for more details.                          #
+#                                                                       #
+# You should have received a copy of the GNU General Public License     #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>. #
+#########################################################################
+
+"""The binary encoding of samples used by the framed protocol.
+
+Samples are encoded as a sequence of records, one per part. Each kind of
+part has a fixed schema: a list of dynamic fields, packed as big-endian
+integers or doubles, and a list of static fields (strings that rarely
+change, like a processor's model name). The encoder and decoder at the
+two ends of a connection keep some state, so that each part key and each
+static field is sent only once, and is referred to by a small number
+after that. Dynamic fields are delta-encoded: only the fields that
+changed since the part was last sent are included, except in keyframes,
+which carry every field and are sent for each part at least every
+KEYFRAME_INTERVAL records.
+
+A record is:
+
+ - a varint holding (ref<<3)|(keyframe<<2)|(static<<1)|new, where ref is
+   the number of the part on this connection
+ - if new is set, the part key (a varint length and the bytes)
+ - the time the sample was taken, in milliseconds: in a keyframe, a varint
+   counting from the epoch; otherwise, a zigzag varint counting from the
+   time in the previous record of the part
+ - the time the sample was taken by the server's monotonic clock, in
+   milliseconds, and the sample's sequence number, each encoded like the
+   time
+ - a varint mask of the dynamic fields sent, followed by their values; in
+   a keyframe, fields that are not sent are absent, otherwise they are
+   unchanged
+ - if static is set, a varint mask of the static fields present, followed
+   by their values (each a varint length and the bytes)
+
+Samples are (key,data,time,mono,seq) tuples: the part key, the data as
+served by yasmond, the time the sample was taken by the wall clock and by
+the monotonic clock of the server, and the number of the sample, counting
+the samples of the part (see sysmon.daemon.SampleCache).
+
+Samples announced over UDP are encoded differently, so that every
+datagram can be decoded on its own; see DatagramEncoder.
+
+Nothing but integers, floats and strings is ever built from the data, so
+it is safe to decode data received from the network. The line protocol
+still carries pickles, for the sake of old clients; safe_loads() unpickles
+them without constructing arbitrary objects.
+"""
+
+import cPickle,random,struct,zlib
+from cStringIO import StringIO
+
+from error import *
+
+class Schema():
+    """Describes how the samples of one kind of part are encoded.
+    """
+    def __init__(self,shape,fields,static=()):
+        """Creates a schema.
+
+        fields is a list of (name,code) pairs giving the dynamic fields,
+        where code is the struct format character of the field ('Q' or
+        'd'), and static lists the names of the static fields. The shape
+        gives the kind of data served for the part: 'dict' (a dictionary
+        by field name), 'tuple' (the dynamic fields and then the static
+        fields, in order) or 'scalar' (the single dynamic field).
+        """
+        self.shape=shape
+        self.names=[name for (name,code) in fields]
+        self.codes=[code for (name,code) in fields]
+        self.static=list(static)
+        self.full=(1<<len(fields))-1
+        self.empty=[None]*len(fields)
+        self._structs={}
+
+    def struct(self,mask):
+        """Returns the struct packing the dynamic fields in the given mask.
+        """
+        try:
+            return self._structs[mask]
+        except KeyError:
+            s=struct.Struct('!'+''.join([code for (i,code)
+                                         in enumerate(self.codes)
+                                         if mask&(1<<i)]))
+            self._structs[mask]=s
+            return s
+
+    def merge(self,base,mask,values):
+        """Returns a copy of the list of dynamic values base, with the
+        fields in the given mask replaced by values.
+        """
+        merged=base[:]
+        values=iter(values)
+        for i in xrange(len(merged)):
+            if mask&(1<<i):
+                merged[i]=values.next()
+        return merged
+
+    def numbers(self,values):
+        """Returns a list of dynamic values converted to the types of their
+        fields (None where they are absent or cannot be packed).
+        """
+        return [_number(code,value)
+                for (code,value) in zip(self.codes,values)]
+
+    def split(self,data):
+        """Returns the lists of dynamic and static values in data (None
+        for absent fields).
+        """
+        if self.shape=='dict':
+            return ([data.get(name) for name in self.names],
+                    [data.get(name) for name in self.static])
+        if self.shape=='tuple':
+            n=len(self.names)
+            return (list(data[:n]),list(data[n:]))
+        return ([data],[])
+
+    def join(self,values,static):
+        """Builds the data served for a part from the list of values of
+        its dynamic fields (None if absent) and the dictionary of its
+        static fields.
+        """
+        if self.shape=='dict':
+            if None in values:
+                data=dict([(name,value) for (name,value)
+                           in zip(self.names,values) if value is not None])
+            else:
+                data=dict(zip(self.names,values))
+            if static:
+                data.update(static)
+            return data
+        if self.shape=='tuple':
+            return tuple(values)+tuple([static.get(name)
+                                        for name in self.static])
+        return values[0]
+
+#the fields of /proc/meminfo that are sent
+MEMORY_FIELDS=['MemTotal','MemFree','MemAvailable','Buffers','Cached',
+               'SwapCached','Active','Inactive','SwapTotal','SwapFree',
+               'Dirty','Writeback','Shmem','Slab']
+
+#the fields of /proc/cpuinfo that are sent (besides the usage)
+PROCESSOR_STATIC=['model name','vendor_id','cpu family','model','stepping',
+                  'cache size','cpu cores','bogomips','flags']
+
+#schemas by kind of part (the first word of the part key, after the name
+#of the system if it is relayed)
+SCHEMAS={
+    'uptime': Schema('scalar',[('uptime','d')]),
+    'processor': Schema('dict',[('usage','d'),('cpu MHz','d')],
+                        PROCESSOR_STATIC),
+    'memory': Schema('dict',[(name,'Q') for name in MEMORY_FIELDS]),
+    'filesystem': Schema('tuple',[('size','Q'),('available','Q')],
+                         ['mount point']),
+    }
+
+#the largest number of records of a part between two keyframes
+KEYFRAME_INTERVAL=60
+
+#the start of every datagram: magic, kind, session, sequence number and the
+#time it was sent, by the wall clock and by the monotonic clock
+DATAGRAM_HEADER=struct.Struct('!4sBIIdd')
+DATAGRAM_MAGIC='YSMd'
+
+#kinds of datagrams
+DATAGRAM_LAYOUT=0
+DATAGRAM_SAMPLES=1
+
+#layout datagrams: the layout's ID, the interval between announcements,
+#and the number of this piece of the layout and of pieces
+LAYOUT_HEADER=struct.Struct('!IdHH')
+
+#samples datagrams: the layout's ID and the number of the first part in
+#the datagram
+SAMPLES_HEADER=struct.Struct('!IH')
+
+#the largest datagram sent: the least MTU of IPv6 (1280 bytes), less the
+#IPv6 and UDP headers, so that datagrams never need to be fragmented
+DATAGRAM_SIZE=1232
+
+#the age of each sample in a samples datagram, in milliseconds, and its
+#sequence number (modulo 2**32)
+SAMPLE_STAMP=struct.Struct('!II')
+
+#the largest number of announcements between two sendings of the layout
+LAYOUT_INTERVAL=10
+
+#the values standing for absent fields in samples datagrams
+_ABSENT={'Q': (1<<64)-1, 'd': float('nan')}
+
+def schema(key):
+    """Returns the schema of the part with the given key, or None.
+    """
+    return SCHEMAS.get(key.rsplit('/',1)[-1].split(' ',1)[0])
+
+def pack_varint(n):
+    """Returns the varint encoding of a non-negative integer.
+    """
+    if n<0x80:
+        return chr(n)
+    out=[]
+    while n>=0x80:
+        out.append(chr((n&0x7f)|0x80))
+        n>>=7
+    out.append(chr(n))
+    return ''.join(out)
+
+def unpack_varint(data,pos):
+    """Decodes the varint at pos in data, and returns a tuple
+    (value,new position).
+    """
+    try:
+        b=ord(data[pos])
+        if b<0x80:
+            return (b,pos+1)
+        n=0
+        shift=0
+        while b&0x80:
+            n|=(b&0x7f)<<shift
+            shift+=7
+            pos+=1
+            b=ord(data[pos])
+    except IndexError:
+        raise InsaneError("truncated varint")
+    return (n|(b<<shift),pos+1)
+
+def pack_zigzag(n):
+    """Returns the zigzag varint encoding of an integer.
+    """
+    if n>=0:
+        return pack_varint(n<<1)
+    return pack_varint(((-n)<<1)-1)
+
+def unzigzag(n):
+    """Returns the integer whose zigzag encoding is n.
+    """
+    if n&1:
+        return -((n+1)>>1)
+    return n>>1
+
+def pack_string(s):
+    """Returns the encoding of a string: its length and its bytes.
+    """
+    if isinstance(s,unicode):
+        s=s.encode('utf-8')
+    return pack_varint(len(s))+s
+
+def unpack_string(data,pos):
+    """Decodes the string at pos in data, and returns a tuple
+    (string,new position).
+    """
+    (n,pos)=unpack_varint(data,pos)
+    if pos+n>len(data):
+        raise InsaneError("truncated string")
+    return (data[pos:pos+n],pos+n)
+
+def _number(code,value):
+    """Converts a value to the type of the given field code, returning
+    None if it cannot be packed.
+    """
+    if value is None:
+        return None
+    try:
+        if code=='d':
+            return float(value)
+        value=int(value)
+        if 0<=value<(1<<64):
+            return value
+    except (TypeError,ValueError):
+        pass
+    return None
+
+
+class Encoder():
+    """Encodes samples for one connection.
+
+    Records must be decoded in the order they were encoded, by a single
+    Decoder.
+    """
+    def __init__(self,keyframe_interval=KEYFRAME_INTERVAL):
+        """Creates an encoder, which sends a keyframe for each part at
+        least every keyframe_interval records.
+        """
+        self._refs={} #part key -> ref
+        self._static={} #ref -> static values last sent
+        self._last={} #ref -> dynamic values last sent
+        self._deltas={} #ref -> records sent since the last keyframe
+        self._times={} #ref -> (time,mono,seq) last sent, times in ms
+        self._interval=keyframe_interval
+
+    def encode(self,samples):
+        """Encodes samples ((key,data,time,mono,seq) tuples) into a
+        string. Parts without a schema are skipped.
+        """
+        out=[]
+        for (key,data,t,mono,seq) in samples:
+            sch=schema(key)
+            if sch is None or data is None:
+                continue
+            (values,static)=sch.split(data)
+            ref=self._refs.get(key)
+            flags=0
+            if ref is None:
+                ref=len(self._refs)
+                self._refs[key]=ref
+                flags|=1
+            if sch.static and self._static.get(ref)!=static:
+                self._static[ref]=static
+                flags|=2
+            #dynamic fields
+            values=[_number(code,value)
+                    for (code,value) in zip(sch.codes,values)]
+            last=self._last.get(ref)
+            deltas=self._deltas.get(ref,0)
+            if (last is None or deltas>=self._interval or
+                (None in values and
+                 [i for (i,value) in enumerate(values)
+                  if value is None and last[i] is not None])):
+                #keyframe: send everything
+                flags|=4
+                self._deltas[ref]=0
+                mask=0
+                packed=[]
+                for (i,value) in enumerate(values):
+                    if value is not None:
+                        mask|=1<<i
+                        packed.append(value)
+            else:
+                #send what changed
+                self._deltas[ref]=deltas+1
+                mask=0
+                packed=[]
+                for (i,value) in enumerate(values):
+                    if value!=last[i]:
+                        mask|=1<<i
+                        packed.append(value)
+            self._last[ref]=values
+            out.append(pack_varint((ref<<3)|flags))
+            if flags&1:
+                out.append(pack_string(key))
+            stamp=(max(0,int(round(t*1000))),
+                   max(0,int(round(mono*1000))),max(0,seq))
+            if flags&4:
+                for n in stamp:
+                    out.append(pack_varint(n))
+            else:
+                for (n,last) in zip(stamp,self._times[ref]):
+                    out.append(pack_zigzag(n-last))
+            self._times[ref]=stamp
+            out.append(pack_varint(mask))
+            out.append(sch.struct(mask).pack(*packed))
+            #static fields
+            if flags&2:
+                mask=0
+                strings=[]
+                for (i,value) in enumerate(static):
+                    if value is not None:
+                        mask|=1<<i
+                        strings.append(pack_string(str(value)))
+                out.append(pack_varint(mask))
+                out.extend(strings)
+        return ''.join(out)
+
+
+class Decoder():
+    """Decodes the samples encoded by an Encoder on the other end of a
+    connection.
+    """
+    def __init__(self):
+        self._keys=[] #ref -> part key
+        self._schemas=[] #ref -> schema
+        self._static=[] #ref -> dictionary of static fields
+        self._values=[] #ref -> current dynamic values (None if absent)
+        self._times=[] #ref -> time of the current values, in milliseconds
+        self._monos=[] #ref -> monotonic time of the current values, in ms
+        self._seqs=[] #ref -> sequence number of the current values
+
+    def decode(self,payload):
+        """Decodes a string produced by Encoder.encode(), and returns the
+        list of samples ((key,data,time,mono,seq) tuples) it holds.
+
+        InsaneError is raised if the data is malformed.
+        """
+        samples=[]
+        keys=self._keys
+        schemas=self._schemas
+        statics=self._static
+        current=self._values
+        times=self._times
+        monos=self._monos
+        seqs=self._seqs
+        pos=0
+        end=len(payload)
+        try:
+            while pos<end:
+                word=ord(payload[pos])
+                pos+=1
+                if word&0x80:
+                    (word,pos)=unpack_varint(payload,pos-1)
+                ref=word>>3
+                if word&1:
+                    (key,pos)=unpack_string(payload,pos)
+                    if ref!=len(keys):
+                        raise InsaneError("unexpected part number %d" % ref)
+                    sch=schema(key)
+                    if sch is None:
+                        raise InsaneError("unknown part %s" % key)
+                    keys.append(key)
+                    schemas.append(sch)
+                    statics.append({})
+                    current.append(None)
+                    times.append(0)
+                    monos.append(0)
+                    seqs.append(0)
+                elif ref>=len(keys):
+                    raise InsaneError("unknown part number %d" % ref)
+                key=keys[ref]
+                sch=schemas[ref]
+                (ms,pos)=unpack_varint(payload,pos)
+                (mono,pos)=unpack_varint(payload,pos)
+                (seq,pos)=unpack_varint(payload,pos)
+                if word&4:
+                    times[ref]=ms
+                    monos[ref]=mono
+                    seqs[ref]=seq
+                else:
+                    times[ref]+=unzigzag(ms)
+                    monos[ref]+=unzigzag(mono)
+                    seqs[ref]+=unzigzag(seq)
+                #dynamic fields
+                mask=ord(payload[pos])
+                pos+=1
+                if mask&0x80:
+                    (mask,pos)=unpack_varint(payload,pos-1)
+                s=sch.struct(mask)
+                values=s.unpack_from(payload,pos)
+                pos+=s.size
+                if word&4:
+                    if mask==sch.full:
+                        values=list(values)
+                    else:
+                        values=sch.merge(sch.empty,mask,values)
+                elif current[ref] is None:
+                    raise InsaneError("delta before keyframe")
+                elif mask:
+                    values=sch.merge(current[ref],mask,values)
+                else:
+                    values=current[ref]
+                current[ref]=values
+                #static fields
+                if word&2:
+                    (mask,pos)=unpack_varint(payload,pos)
+                    static={}
+                    for (i,name) in enumerate(sch.static):
+                        if mask&(1<<i):
+                            (static[name],pos)=unpack_string(payload,pos)
+                    statics[ref]=static
+                data=sch.join(values,statics[ref])
+                if data is not None:
+                    samples.append((key,data,times[ref]/1000.0,
+                                    monos[ref]/1000.0,seqs[ref]))
+        except (IndexError,struct.error):
+            raise InsaneError("truncated record")
+        return samples
+
+
+def encode_meta(meta):
+    """Encodes a system's metadata (a dictionary mapping names to
+    (description,value) pairs).
+    """
+    out=[pack_varint(len(meta))]
+    for (name,(desc,value)) in meta.items():
+        out.append(pack_string(name))
+        out.append(pack_string(desc))
+        out.append(pack_string(value))
+    return ''.join(out)
+
+def decode_meta(payload):
+    """Decodes metadata encoded by encode_meta().
+    """
+    meta={}
+    (n,pos)=unpack_varint(payload,0)
+    for i in xrange(n):
+        (name,pos)=unpack_string(payload,pos)
+        (desc,pos)=unpack_string(payload,pos)
+        (value,pos)=unpack_string(payload,pos)
+        meta[name]=(desc,value)
+    return meta
+
+#the processor usage and I/O rate of a process
+PROCESS_RATES=struct.Struct('!dd')
+
+def encode_processes(processes):
+    """Encodes a list of (pid,name,user,cpu,rss,io) process tuples (see
+    sysmon.system.ProcessList).
+    """
+    out=[pack_varint(len(processes))]
+    for (pid,name,user,cpu,rss,io) in processes:
+        out.append(pack_varint(pid))
+        out.append(pack_string(name))
+        out.append(pack_string(user))
+        out.append(pack_varint(rss))
+        out.append(PROCESS_RATES.pack(cpu,io))
+    return ''.join(out)
+
+def decode_processes(payload):
+    """Decodes processes encoded by encode_processes().
+
+    InsaneError is raised if the data is malformed.
+    """
+    processes=[]
+    (n,pos)=unpack_varint(payload,0)
+    try:
+        for i in xrange(n):
+            (pid,pos)=unpack_varint(payload,pos)
+            (name,pos)=unpack_string(payload,pos)
+            (user,pos)=unpack_string(payload,pos)
+            (rss,pos)=unpack_varint(payload,pos)
+            (cpu,io)=PROCESS_RATES.unpack_from(payload,pos)
+            pos+=PROCESS_RATES.size
+            processes.append((pid,name,user,cpu,rss,io))
+    except struct.error:
+        raise InsaneError("truncated process")
+    return processes
+
+def safe_loads(data):
+    """Unpickles data received in the line protocol, refusing to build
+    anything but the builtin types (dictionaries, lists, tuples, strings
+    and numbers).
+    """
+    unpickler=cPickle.Unpickler(StringIO(data))
+    unpickler.find_global=None
+    try:
+        return unpickler.load()
+    except (cPickle.UnpicklingError,EOFError,ValueError,
+            IndexError,KeyError) as err:
+        raise InsaneError("bad pickle: %s" % err)
+
+def parse_line(key,reply):
+    """Parses the reply to a query for a single part in the line protocol.
+    """
+    if key=='uptime':
+        #(served as a whole number of seconds, for the sake of old clients)
+        return float(reply)
+    return safe_loads(reply)
+
+
+class DatagramEncoder():
+    """Encodes samples into datagrams that can each be decoded on its own,
+    for announcing them over UDP.
+
+    Every datagram starts with DATAGRAM_HEADER, holding a session number
+    (chosen at random for each encoder) and a sequence number, so that
+    receivers can tell when datagrams are lost, duplicated or reordered.
+    Samples datagrams have a fixed layout: after the layout's ID and the
+    number of the first part in the datagram, every part has its age in
+    milliseconds, its sequence number and all its dynamic fields, packed as
+    in its schema (absent fields are all ones, or NaN). The layout itself
+    (the metadata, the static fields, each distinct value once, and the
+    part keys with the numbers of their static fields' values) is sent in
+    layout datagrams before the first samples datagram, whenever it
+    changes, and at least every LAYOUT_INTERVAL announcements.
+
+    No datagram is larger than max_size bytes: the layout is cut into as
+    many pieces as needed, and the parts are spread over as many samples
+    datagrams as needed.
+    """
+    def __init__(self,meta,interval,layout_interval=LAYOUT_INTERVAL,
+                 max_size=DATAGRAM_SIZE):
+        """Creates an encoder announcing a system with the given metadata,
+        every interval seconds, in datagrams of at most max_size bytes
+        (or of any size, if max_size is None).
+        """
+        self._session=random.getrandbits(32)
+        self._seq=0
+        self._meta=pack_string(encode_meta(meta))
+        self._interval=interval
+        self._layout_interval=layout_interval
+        self._max_size=max_size
+        self._layout=None
+        self._layout_id=None
+        self._since=0
+
+    def _header(self,kind,now,mono):
+        self._seq=(self._seq+1)&0xffffffff
+        return DATAGRAM_HEADER.pack(DATAGRAM_MAGIC,kind,self._session,
+                                    self._seq,now,mono)
+
+    def encode(self,samples,now,mono):
+        """Encodes samples ((key,data,time,mono,seq) tuples), announced at
+        the time now (mono by the monotonic clock), and returns the list of
+        datagrams to send, in order. Parts without a schema are skipped.
+        """
+        parts=[]
+        layout=[]
+        strings={} #static value -> number
+        for (key,data,t,sampled,seq) in samples:
+            sch=schema(key)
+            if sch is None or data is None:
+                continue
+            (values,static)=sch.split(data)
+            parts.append((sch,values,sampled,seq))
+            mask=0
+            refs=[]
+            for (i,value) in enumerate(static):
+                if value is not None:
+                    mask|=1<<i
+                    #(processors all have the same long list of flags)
+                    refs.append(pack_varint(
+                            strings.setdefault(str(value),len(strings))))
+            layout.append(pack_string(key)+pack_varint(mask)+''.join(refs))
+        table=sorted(strings,key=strings.get)
+        layout=(self._meta+pack_varint(len(table))+
+                ''.join([pack_string(value) for value in table])+
+                pack_varint(len(layout))+''.join(layout))
+        datagrams=[]
+        if layout!=self._layout or self._since>=self._layout_interval:
+            self._layout=layout
+            self._layout_id=zlib.crc32(layout)&0xffffffff
+            self._since=0
+            if self._max_size is None:
+                step=len(layout)
+            else:
+                step=self._max_size-DATAGRAM_HEADER.size-LAYOUT_HEADER.size
+            pieces=[layout[i:i+step] for i in xrange(0,len(layout),step)]
+            if len(pieces)>0xffff:
+                raise InsaneError("layout too large to announce")
+            for (i,piece) in enumerate(pieces):
+                datagrams.append(self._header(DATAGRAM_LAYOUT,now,mono)+
+                                 LAYOUT_HEADER.pack(self._layout_id,
+                                                    self._interval,i,
+                                                    len(pieces))+
+                                 piece)
+        out=None
+        for (n,(sch,values,sampled,seq)) in enumerate(parts):
+            age=int(max(0,mono-sampled)*1000)
+            packed=[]
+            for (code,value) in zip(sch.codes,values):
+                value=_number(code,value)
+                if value is None:
+                    value=_ABSENT[code]
+                packed.append(value)
+            part=(SAMPLE_STAMP.pack(min(age,0xffffffff),seq&0xffffffff)+
+                  sch.struct(sch.full).pack(*packed))
+            if out is None or (self._max_size is not None and
+                               size+len(part)>self._max_size):
+                if out is not None:
+                    datagrams.append(''.join(out))
+                out=[self._header(DATAGRAM_SAMPLES,now,mono),
+                     SAMPLES_HEADER.pack(self._layout_id,n)]
+                size=DATAGRAM_HEADER.size+SAMPLES_HEADER.size
+            out.append(part)
+            size+=len(part)
+        if out is None:
+            #nothing to announce but that we're here
+            out=[self._header(DATAGRAM_SAMPLES,now,mono),
+                 SAMPLES_HEADER.pack(self._layout_id,0)]
+        datagrams.append(''.join(out))
+        self._since+=1
+        return datagrams
+
+
+class DatagramDecoder():
+    """Decodes the datagrams of a single DatagramEncoder (one sender), and
+    keeps count of those that were lost.
+
+    Datagrams that arrive late (after one with a greater sequence number)
+    or twice are dropped. A new session means the sender was restarted,
+    and starts the count afresh.
+    """
+    def __init__(self):
+        self.session=None
+        self.seq=None
+        self.received=0 #datagrams decoded
+        self.lost=0 #datagrams never received
+        self.dropped=0 #datagrams received late or twice
+        self.meta={}
+        self.interval=None
+        self.keys=[]
+        self._layout_id=None
+        self._parts=[] #(key,schema,static fields)
+        self._pieces=None #(layout ID,pieces received so far)
+
+    def decode(self,datagram,count=True):
+        """Decodes a datagram, and returns the list of samples
+        ((key,data,time,mono,seq) tuples) it holds, which is empty for
+        layout datagrams, and for samples datagrams whose layout is not
+        known yet.
+
+        If count is False, the datagram is decoded even if it is late or
+        was seen before, and it is neither counted nor used to tell how
+        many were lost (for datagrams read again, like the layout in a
+        shared memory snapshot).
+
+        InsaneError is raised if the datagram is malformed.
+        """
+        try:
+            (magic,kind,session,seq,now,mono)=DATAGRAM_HEADER.unpack_from(
+                datagram,0)
+        except struct.error:
+            raise InsaneError("truncated datagram")
+        if magic!=DATAGRAM_MAGIC:
+            raise InsaneError("not a datagram")
+        if session!=self.session:
+            self.__init__()
+            self.session=session
+        elif self.seq is not None and count:
+            gap=(seq-self.seq)&0xffffffff
+            if gap==0 or gap>=1<<31:
+                self.dropped+=1
+                return []
+            self.lost+=gap-1
+        if count:
+            self.seq=seq
+            self.received+=1
+        pos=DATAGRAM_HEADER.size
+        try:
+            if kind==DATAGRAM_LAYOUT:
+                self._decode_layout(datagram,pos)
+                return []
+            if kind!=DATAGRAM_SAMPLES:
+                return []
+            (layout_id,first)=SAMPLES_HEADER.unpack_from(datagram,pos)
+            if layout_id!=self._layout_id:
+                return []
+            pos+=SAMPLES_HEADER.size
+            end=len(datagram)
+            samples=[]
+            for (key,sch,static) in self._parts[first:]:
+                if pos>=end:
+                    #the rest are in other datagrams
+                    break
+                (age,number)=SAMPLE_STAMP.unpack_from(datagram,pos)
+                pos+=SAMPLE_STAMP.size
+                st=sch.struct(sch.full)
+                values=list(st.unpack_from(datagram,pos))
+                pos+=st.size
+                for (i,code) in enumerate(sch.codes):
+                    if code=='Q' and values[i]==_ABSENT['Q']:
+                        values[i]=None
+                    elif code=='d' and values[i]!=values[i]:
+                        values[i]=None
+                age/=1000.0
+                samples.append((key,sch.join(values,static),now-age,
+                                mono-age,number))
+            return samples
+        except (IndexError,struct.error):
+            raise InsaneError("truncated datagram")
+
+    def _decode_layout(self,datagram,pos):
+        (layout_id,interval,i,n)=LAYOUT_HEADER.unpack_from(datagram,pos)
+        pos+=LAYOUT_HEADER.size
+        if layout_id==self._layout_id:
+            return
+        if i>=n:
+            raise InsaneError("layout piece %d of %d" % (i,n))
+        if self._pieces is None or self._pieces[0]!=layout_id or \
+                len(self._pieces[1])!=n:
+            #(pieces of an older layout are forgotten)
+            self._pieces=(layout_id,[None]*n)
+        pieces=self._pieces[1]
+        pieces[i]=datagram[pos:]
+        if None in pieces:
+            return
+        self._pieces=None
+        layout=''.join(pieces)
+        (meta,pos)=unpack_string(layout,0)
+        meta=decode_meta(meta)
+        (n,pos)=unpack_varint(layout,pos)
+        table=[]
+        for i in xrange(n):
+            (value,pos)=unpack_string(layout,pos)
+            table.append(value)
+        parts=[]
+        (n,pos)=unpack_varint(layout,pos)
+        for i in xrange(n):
+            (key,pos)=unpack_string(layout,pos)
+            sch=schema(key)
+            if sch is None:
+                raise InsaneError("unknown part: %s" % key)
+            (mask,pos)=unpack_varint(layout,pos)
+            static={}
+            for (j,name) in enumerate(sch.static):
+                if mask&(1<<j):
+                    (ref,pos)=unpack_varint(layout,pos)
+                    if ref>=len(table):
+                        raise InsaneError("unknown static value %d" % ref)
+                    static[name]=table[ref]
+            parts.append((key,sch,static))
+        self.meta=meta
+        self.interval=interval
+        self.keys=[key for (key,sch,static) in parts]
+        self._parts=parts
+        self._layout_id=layout_id
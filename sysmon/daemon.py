@@ -0,0 +1,1330 @@
+#########################################################################
+# YASMon - Yet Another System Monitor                                   #
+# Copyright (C) 2010  Scott Lawrence                                    #
+#                                                                       #
+# This program is free software: you can redistribute it and/or modify  #
+# it under the terms of the GNU General Public License as published by  #
+# the Free Software Foundation, either version 3 of the License, or     #
+# (at your option) any later version.                                   #
+#                                                                       #
+# This program is distributed in the hope that it will be useful,       #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+# GNU General Public License for more details.                          #
+#                                                                       #
+# You should have received a copy of the GNU General Public License     #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>. #
+#########################################################################
+
+"""The server run by yasmond, which serves a system to remote clients.
+
+All clients are served from a single thread, by an event loop built on
+epoll (or poll, where epoll is not available). Sockets are non-blocking
+and every connection has its own input and output buffers, so a slow
+client never holds up the others, and subscriptions are pushed from the
+same loop instead of from a thread per client.
+
+Parts are sampled by a SampleCache, on their own schedule, and every
+client is served from the cache, so the cost of sampling does not depend
+on the number of clients. A Relay serves the systems of other servers
+from a cache in the same way.
+
+Every sample is served with the time it was taken, by the wall clock and
+by the monotonic clock of the server, and with a sequence number counting
+the samples of its part, so clients can compute rates without being
+misled by network delays, and tell when they missed samples. The latest
+samples of every part are kept for a while, so clients that were away can
+catch up (see protocol.history()).
+"""
+
+import array,bisect,cPickle,ctypes,ctypes.util,errno,heapq,itertools,os
+import socket,stat,threading,time,traceback
+
+from error import *
+import codec,events,protocol,remote
+from system import top_processes
+
+#the default number of connections waiting to be accepted
+DEFAULT_BACKLOG=128
+
+#the shortest interval at which samples are pushed
+MIN_INTERVAL=0.1
+
+#the most data received from a connection at once, in the line protocol
+READ_SIZE=65536
+
+#the longest request line accepted
+MAX_LINE=65536
+
+#connections with more unsent output than this are dropped
+MAX_OUTPUT=1<<22
+
+#pushes are skipped while a connection has more unsent output than this
+PUSH_BACKLOG=65536
+
+#the default intervals at which parts are sampled, in seconds
+DEFAULT_INTERVAL=1.0
+DEFAULT_FS_INTERVAL=10.0
+
+#the shortest time between two samples of a part forced by max-age
+MIN_AGE=0.1
+
+#the default number of samples of each part kept (an hour's worth, at the
+#default interval)
+DEFAULT_HISTORY=3600
+
+#processes are scanned for this many intervals after they were last asked
+#for
+SCAN_INTERVALS=30
+
+#absent fields in a SampleHistory
+_NAN=float('nan')
+
+#the number of hops multicast announcements may take
+ANNOUNCE_TTL=1
+
+#errors meaning that a non-blocking operation would have blocked
+_WOULDBLOCK=(errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR)
+
+#CLOCK_MONOTONIC, from <time.h>
+_CLOCK_MONOTONIC=1
+
+class _timespec(ctypes.Structure):
+    _fields_=[('tv_sec',ctypes.c_long),('tv_nsec',ctypes.c_long)]
+
+def _monotonic_clock():
+    """Returns a function returning the time of the monotonic clock, in
+    seconds since some unspecified start.
+
+    The clock is read with clock_gettime(); where that cannot be found, the
+    elapsed time given by os.times() (in clock ticks) is used instead.
+    """
+    try:
+        libc=ctypes.CDLL(ctypes.util.find_library('rt') or
+                         ctypes.util.find_library('c'),use_errno=True)
+        clock_gettime=libc.clock_gettime
+    except (OSError,AttributeError):
+        return lambda: os.times()[4]
+    clock_gettime.argtypes=[ctypes.c_int,ctypes.POINTER(_timespec)]
+    def monotonic():
+        ts=_timespec()
+        if clock_gettime(_CLOCK_MONOTONIC,ctypes.byref(ts)):
+            raise OSError(ctypes.get_errno(),"clock_gettime failed")
+        return ts.tv_sec+ts.tv_nsec*1e-9
+    return monotonic
+
+#the time of the monotonic clock, which never jumps with the wall clock
+monotonic=_monotonic_clock()
+
+class SampleHistory():
+    """Keeps the last samples of one part, column by column.
+
+    The dynamic fields of the part's schema (see sysmon.codec) are kept in
+    arrays of doubles, one per field (NaN where absent), next to arrays of
+    the times and sequence numbers; the static fields (like the flags of a
+    processor) are only kept once, as last sampled. A processor sample
+    takes 40 bytes.
+
+    Samples are numbered from 0 as they are kept, and keep their numbers
+    when older ones are let go. Their sequence numbers always increase: a
+    lower one than the latest means the part's server started afresh, and
+    so does the history.
+    """
+    def __init__(self,schema,length):
+        """Creates an empty history of a part with the given schema,
+        keeping (at least) its last length samples.
+        """
+        self._schema=schema
+        self._length=length
+        self._times=array.array('d')
+        self._monos=array.array('d')
+        self._seqs=array.array('d')
+        self._columns=[array.array('d') for name in schema.names]
+        self._static={}
+        self._dropped=0 #the number of the oldest sample in the arrays
+
+    def __len__(self):
+        return min(len(self._times),self._length)
+
+    def last(self):
+        """Returns the times and sequence number of the latest sample, as
+        a tuple (time,mono,seq), or None.
+        """
+        if not len(self):
+            return None
+        return (self._times[-1],self._monos[-1],int(self._seqs[-1]))
+
+    def append(self,data,t,mono,seq):
+        """Keeps a sample, as served by yasmond.
+        """
+        sch=self._schema
+        (values,static)=sch.split(data)
+        self._static=dict([(name,value) for (name,value)
+                           in zip(sch.static,static) if value is not None])
+        arrays=[self._times,self._monos,self._seqs]+self._columns
+        if self._seqs and seq<=self._seqs[-1]:
+            self._dropped+=len(self._times)
+            for column in arrays:
+                del column[:]
+        for (column,value) in zip(self._columns,sch.numbers(values)):
+            if value is None:
+                value=_NAN
+            column.append(value)
+        self._times.append(t)
+        self._monos.append(mono)
+        self._seqs.append(seq)
+        #trim in batches, so that appending stays cheap
+        n=len(self._times)
+        if n>self._length+(self._length>>2):
+            self._dropped+=n-self._length
+            for column in arrays:
+                del column[:n-self._length]
+
+    def find(self,since=None,after=None,limit=None):
+        """Finds the samples taken at or after the time since, and
+        numbered above after, oldest first (only the oldest limit of them,
+        if a limit is given), without decoding them. Returns a tuple
+        (number,times): the number of the first sample found (see
+        sample()) and an array of the times the samples were taken.
+        """
+        #(both the times and the sequence numbers are in order, so no
+        #more than a few of them are looked at)
+        lo=len(self._times)-len(self)
+        if since is not None:
+            lo=bisect.bisect_left(self._times,since,lo)
+        if after is not None:
+            lo=bisect.bisect_right(self._seqs,after,lo)
+        end=len(self._times)
+        if limit is not None:
+            end=min(end,lo+limit)
+        return (self._dropped+lo,self._times[lo:end])
+
+    def sample(self,number):
+        """Returns the sample with the given number, as a tuple
+        (data,time,mono,seq), or None if it is no longer kept.
+        """
+        sch=self._schema
+        i=number-self._dropped
+        if not len(self._times)-len(self)<=i<len(self._times):
+            return None
+        values=[]
+        for (column,code) in zip(self._columns,sch.codes):
+            value=column[i]
+            if value!=value:
+                value=None
+            elif code=='Q':
+                value=int(value)
+            values.append(value)
+        return (sch.join(values,self._static),self._times[i],
+                self._monos[i],int(self._seqs[i]))
+
+    def since(self,since=None,after=None,limit=None):
+        """Returns the samples taken at or after the time since, and
+        numbered above after, oldest first, as (data,time,mono,seq)
+        tuples; only the oldest limit of them, if a limit is given.
+        """
+        (first,times)=self.find(since,after,limit)
+        return [self.sample(first+k) for k in xrange(len(times))]
+
+
+class SampleCache():
+    """Samples every served part of a system on its own schedule, and
+    keeps the latest samples of each, with the times they were taken and
+    their sequence numbers.
+
+    The cache is only used from the thread running the event loop, so it
+    needs no locking. The only exception are the processes, which are
+    scanned by a worker thread of the default event loop (a scan reads
+    several files for every process, far too slow for the loop) and handed
+    over as a whole, in a single assignment. They are scanned once at
+    startup, and then every interval, but only as long as they are asked
+    for: until SCAN_INTERVALS intervals after the last time.
+    """
+    def __init__(self,system,interval=DEFAULT_INTERVAL,
+                 fs_interval=DEFAULT_FS_INTERVAL,history=DEFAULT_HISTORY,
+                 log=None):
+        """Creates a cache for the given system, sampling filesystems every
+        fs_interval seconds and every other part every interval seconds,
+        and keeping the last history samples of each part.
+
+        Every part is sampled once right away. A part that cannot be
+        sampled keeps its latest sample, and log, if given, is called with
+        a message saying why.
+        """
+        self._log=log
+        self._parts={} #key -> part
+        self._intervals={} #key -> interval
+        for part in system.parts():
+            if part.sample() is None:
+                continue
+            self._parts[part.key()]=part
+            if part in system.filesystems():
+                self._intervals[part.key()]=fs_interval
+            else:
+                self._intervals[part.key()]=interval
+        self._samples={} #key -> (data,time,mono,seq)
+        self._seqs={} #key -> sequence number of the latest sample
+        self._history={} #key -> SampleHistory
+        for key in self._parts:
+            if codec.schema(key) is not None:
+                self._history[key]=SampleHistory(codec.schema(key),history)
+        self._processlist=system.processlist()
+        self._interval=interval
+        self._processes=[] #the latest scan with rates in it
+        self._scans=0
+        self._scanning=False
+        self._scan_due=time.time() #None while nobody asks
+        self._asked=None
+        self._due=[] #heap of (time,key)
+        now=time.time()
+        for key in self._parts:
+            self.refresh(key)
+            heapq.heappush(self._due,(now+self._intervals[key],key))
+
+    def keys(self):
+        """Returns the keys of all parts in the cache.
+        """
+        return self._parts.keys()
+
+    def has(self,key):
+        """Returns True if the part with the given key is in the cache.
+        """
+        return key in self._parts
+
+    def refresh(self,key):
+        """Samples the part with the given key now.
+        """
+        part=self._parts[key]
+        try:
+            part.update()
+            data=part.sample()
+        except Exception as err:
+            #(a filesystem unmounted meanwhile, say)
+            if self._log is not None:
+                self._log("Cannot sample %s: %s" % (key,err))
+            return
+        if isinstance(data,dict):
+            #the part keeps updating its dictionary in place
+            data=dict(data)
+        seq=self._seqs.get(key,0)+1
+        self._seqs[key]=seq
+        entry=(data,time.time(),monotonic(),seq)
+        self._samples[key]=entry
+        history=self._history.get(key)
+        if history is not None and data is not None:
+            history.append(*entry)
+
+    def get(self,key,max_age=None):
+        """Returns the latest sample of the part with the given key, as a
+        tuple (data,time,mono,seq), or None if there is no such part: time
+        and mono are the times it was taken by the wall clock and by the
+        monotonic clock, and seq counts the samples of the part, from 1.
+
+        If a max_age is given and the latest sample is older than that
+        many seconds, the part is sampled again first.
+        """
+        entry=self._samples.get(key)
+        if entry is None:
+            return None
+        if max_age is not None and time.time()-entry[1]>max(max_age,MIN_AGE):
+            self.refresh(key)
+            entry=self._samples[key]
+        return entry
+
+    def history(self,key,since=None,after=None,limit=None):
+        """Returns the kept samples of the part with the given key taken
+        at or after the time since, and numbered above after, oldest
+        first (only the oldest limit of them, if a limit is given), as
+        (data,time,mono,seq) tuples like those of get().
+        """
+        history=self._history.get(key)
+        if history is None:
+            return []
+        return history.since(since,after,limit)
+
+    def find_history(self,key,since=None,after=None,limit=None):
+        """Finds the kept samples of the part with the given key, as
+        history() does, without decoding them. Returns a tuple
+        (number,times), as SampleHistory.find() does.
+        """
+        history=self._history.get(key)
+        if history is None:
+            return (0,[])
+        return history.find(since,after,limit)
+
+    def history_samples(self,key,numbers):
+        """Returns the kept samples of the part with the given key with
+        the given numbers (see find_history()), as tuples like those of
+        get(); those no longer kept are left out.
+        """
+        history=self._history.get(key)
+        if history is None:
+            return []
+        samples=[history.sample(number) for number in numbers]
+        return [sample for sample in samples if sample is not None]
+
+    def top(self,n,by='cpu',user=None,name=None):
+        """Returns the top processes, as sysmon.system.top_processes()
+        does, from the latest scan, and has the processes scanned for a
+        while (see SampleCache). There are none until the processes have
+        been scanned twice, since the rates are only known from then on.
+        """
+        now=time.time()
+        self._asked=now
+        if self._scan_due is None:
+            self._scan_due=now
+        return top_processes(self._processes,n,by,user,name)
+
+    def _scan(self):
+        """Scans the processes; runs in a worker thread.
+        """
+        try:
+            #(not update(), which would hold the system's lock - and with
+            #it every other part - for the whole scan)
+            self._processlist.do_update()
+            self._scans+=1
+            if self._scans>1:
+                self._processes=self._processlist.processes()
+        finally:
+            self._scanning=False
+
+    def relayed(self):
+        """Returns the names of the systems relayed from other servers;
+        there are none in a plain cache (see Relay).
+        """
+        return []
+
+    def next_due(self):
+        """Returns the time at which the next part is to be sampled, or
+        None.
+        """
+        due=self._scan_due
+        if self._due and (due is None or self._due[0][0]<due):
+            due=self._due[0][0]
+        return due
+
+    def run(self):
+        """Samples all parts that are due, and has the processes scanned
+        again if they are due and the previous scan is done.
+        """
+        now=time.time()
+        if self._scan_due is not None and self._scan_due<=now:
+            if not self._scanning:
+                self._scanning=True
+                events.default_loop().defer(self._scan)
+            if self._asked is not None and \
+                    now-self._asked<SCAN_INTERVALS*self._interval:
+                #(a scan that takes longer than an interval skips the next)
+                self._scan_due=max(self._scan_due+self._interval,now)
+            else:
+                #until asked again
+                self._scan_due=None
+        due=self._due
+        while due and due[0][0]<=now:
+            (when,key)=heapq.heappop(due)
+            self.refresh(key)
+            when+=self._intervals[key]
+            if when<now:
+                #we fell behind; don't try to catch up
+                when=now+self._intervals[key]
+            heapq.heappush(due,(when,key))
+
+
+class Relay():
+    """Serves the systems served by other yasmonds (upstreams), next to
+    the parts of a local SampleCache, so that any number of clients can
+    watch them while each upstream only has a single client: the relay.
+
+    Part KEY of the upstream NAME is served as 'NAME/KEY', where NAME is
+    the upstream's address (with the port, if it is not the default one).
+    The systems an upstream relays itself are served under their own
+    names, so relays can be stacked, one per rack feeding one per site,
+    say.
+
+    A relay has the methods of a SampleCache, plus meta() and overview()
+    for the relayed systems. Upstreams are followed by RemoteContacts,
+    subscribed to all their parts, and must speak the framed protocol.
+    Their samples arrive on the event loop of the contacts, in another
+    thread, so they are kept under a lock.
+    """
+    def __init__(self,cache,upstreams,interval=DEFAULT_INTERVAL,
+                 fs_interval=DEFAULT_FS_INTERVAL,timeout=10.0,log=None,
+                 history=DEFAULT_HISTORY):
+        """Creates a relay serving the parts of the given SampleCache, and
+        those of the given upstreams, a list of (addr,port) pairs, pushed
+        every fs_interval seconds for filesystems and every interval
+        seconds for other parts. The last history samples pushed of each
+        relayed part are kept.
+
+        Upstreams are connected to in the background; log is called with a
+        message whenever one comes up or goes down.
+        """
+        self._cache=cache
+        self._interval=interval
+        self._fs_interval=fs_interval
+        self._log=log
+        self._lock=threading.Lock()
+        self._samples={} #relayed key -> (data,time,mono,seq)
+        self._history={} #relayed key -> SampleHistory
+        self._length=history
+        self._meta={} #relayed name -> meta dictionary
+        self._keys={} #relayed name -> part keys
+        self._contacts={} #upstream name -> RemoteContact
+        for (addr,port) in upstreams:
+            name=addr
+            if port!=protocol.DEFAULT_PORT:
+                name="%s:%d" % (addr,port)
+            contact=remote.RemoteContact(addr,port,timeout,connect=False)
+            contact.callback().hook("connection.changed",
+                                    lambda c,name=name: self._changed(name,c))
+            self._contacts[name]=contact
+            contact.connect_later()
+
+    def _changed(self,name,contact):
+        """Follows an upstream whose connection just went up or down.
+        """
+        if self._log is not None:
+            self._log("Upstream %s is %s" % (name,contact.state()))
+        if not contact.connected():
+            #keep serving the latest samples; their times tell how old
+            return
+        if not contact.framed():
+            if self._log is not None:
+                self._log("Upstream %s cannot push; not relayed" % name)
+            return
+        try:
+            (meta,info)=contact.query_all(['meta','overview'])
+            keys={name: ['uptime','memory']}
+            for line in info.split("\n"):
+                if not line:
+                    continue
+                if '/' in line:
+                    #relayed by the upstream itself
+                    (relayed,key)=line.split('/',1)
+                    keys.setdefault(relayed,[]).append(key)
+                else:
+                    keys[name].append(line)
+            names=[relayed for relayed in keys if relayed!=name]
+            metas=contact.query_all(["%s/meta" % relayed
+                                     for relayed in names])
+            intervals={}
+            for (relayed,part_keys) in keys.items():
+                prefix=relayed!=name and relayed+'/' or ''
+                for key in part_keys:
+                    if key.startswith('filesystem '):
+                        intervals[prefix+key]=self._fs_interval
+                    else:
+                        intervals[prefix+key]=self._interval
+            with self._lock:
+                self._meta[name]=codec.decode_meta(meta)
+                for (relayed,data) in zip(names,metas):
+                    self._meta[relayed]=codec.decode_meta(data)
+                self._keys.update(keys)
+            contact.subscribe(intervals,
+                              lambda samples: self._catch(name,samples))
+        except (RemoteError,InsaneError):
+            #we'll be back after reconnecting
+            pass
+
+    def _catch(self,name,samples):
+        """Keeps the samples pushed by the upstream with the given name.
+        """
+        with self._lock:
+            for (key,data,t,mono,seq) in samples:
+                if '/' not in key:
+                    key="%s/%s" % (name,key)
+                history=self._history.get(key)
+                if history is None:
+                    history=SampleHistory(codec.schema(key),self._length)
+                    self._history[key]=history
+                last=history.last()
+                if last is not None and last[1:]==(mono,seq):
+                    #pushed again
+                    continue
+                self._samples[key]=(data,t,mono,seq)
+                history.append(data,t,mono,seq)
+
+    def upstreams(self):
+        """Returns a dictionary mapping the names of upstreams to the
+        RemoteContacts following them.
+        """
+        return self._contacts
+
+    def relayed(self):
+        """Returns the names of all relayed systems.
+        """
+        with self._lock:
+            return self._keys.keys()
+
+    def meta(self,name):
+        """Returns the metadata of the relayed system with the given name.
+        """
+        with self._lock:
+            return self._meta.get(name,{})
+
+    def overview(self,name):
+        """Returns the keys of all parts of the relayed system with the
+        given name.
+        """
+        with self._lock:
+            return list(self._keys.get(name,[]))
+
+    def keys(self):
+        with self._lock:
+            return self._cache.keys()+self._samples.keys()
+
+    def has(self,key):
+        if self._cache.has(key):
+            return True
+        with self._lock:
+            return key in self._samples
+
+    def refresh(self,key):
+        """Samples the local part with the given key now; relayed parts
+        are only sampled by their upstreams.
+        """
+        if self._cache.has(key):
+            self._cache.refresh(key)
+
+    def get(self,key,max_age=None):
+        """Returns the latest sample of the part with the given key, as in
+        SampleCache.get(). max_age is ignored for relayed parts, whose times
+        and sequence numbers are those of their upstreams.
+        """
+        if self._cache.has(key):
+            return self._cache.get(key,max_age)
+        with self._lock:
+            return self._samples.get(key)
+
+    def history(self,key,since=None,after=None,limit=None):
+        """Returns the kept samples of the part with the given key, as in
+        SampleCache.history().
+        """
+        if self._cache.has(key):
+            return self._cache.history(key,since,after,limit)
+        with self._lock:
+            history=self._history.get(key)
+            if history is None:
+                return []
+            return history.since(since,after,limit)
+
+    def find_history(self,key,since=None,after=None,limit=None):
+        """Finds the kept samples of the part with the given key, as in
+        SampleCache.find_history().
+        """
+        if self._cache.has(key):
+            return self._cache.find_history(key,since,after,limit)
+        with self._lock:
+            history=self._history.get(key)
+            if history is None:
+                return (0,[])
+            return history.find(since,after,limit)
+
+    def history_samples(self,key,numbers):
+        """Returns the kept samples of the part with the given key with
+        the given numbers, as in SampleCache.history_samples().
+        """
+        if self._cache.has(key):
+            return self._cache.history_samples(key,numbers)
+        with self._lock:
+            history=self._history.get(key)
+            if history is None:
+                return []
+            samples=[history.sample(number) for number in numbers]
+        return [sample for sample in samples if sample is not None]
+
+    def top(self,n,by='cpu',user=None,name=None):
+        """Returns the top local processes, as SampleCache.top(); the
+        processes of relayed systems are not known.
+        """
+        return self._cache.top(n,by,user,name)
+
+    def next_due(self):
+        return self._cache.next_due()
+
+    def run(self):
+        self._cache.run()
+
+
+class Announcer():
+    """Announces the latest samples of all parts served from a cache over
+    UDP, every interval seconds, in datagrams encoded by
+    codec.DatagramEncoder.
+
+    Datagrams are sent to a single address, which may be a unicast,
+    broadcast or multicast one, without waiting for anything: whatever
+    cannot be sent at once is lost, and receivers notice.
+    """
+    def __init__(self,system,cache,addr,port=protocol.DEFAULT_PORT,
+                 interval=DEFAULT_INTERVAL,ttl=ANNOUNCE_TTL):
+        """Creates an announcer of the system served from the given cache,
+        to the given address and port. ttl is the number of hops multicast
+        datagrams may take.
+        """
+        self._cache=cache
+        self._dest=(addr,port)
+        self._interval=interval
+        self._encoder=codec.DatagramEncoder(system.meta(),interval)
+        self._socket=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET,socket.SO_BROADCAST,1)
+        self._socket.setsockopt(socket.IPPROTO_IP,socket.IP_MULTICAST_TTL,
+                                ttl)
+        self._socket.setblocking(0)
+        self._due=time.time()
+        self.sent=0 #datagrams sent
+        self.failed=0 #datagrams that could not be sent
+
+    def next_due(self):
+        return self._due
+
+    def run(self):
+        """Announces the latest samples, if it is time to.
+        """
+        now=time.time()
+        if now<self._due:
+            return
+        self._due+=self._interval
+        if self._due<now:
+            #we fell behind; don't try to catch up
+            self._due=now+self._interval
+        cache=self._cache
+        samples=[]
+        #(relayed systems are not announced)
+        for key in sorted(cache.keys()):
+            entry=cache.get(key)
+            if '/' not in key and entry is not None:
+                samples.append((key,)+entry)
+        for datagram in self._encoder.encode(samples,now,monotonic()):
+            try:
+                self._socket.sendto(datagram,self._dest)
+                self.sent+=1
+            except socket.error:
+                self.failed+=1
+
+    def close(self):
+        """Stops announcing.
+        """
+        self._socket.close()
+
+
+class Connection():
+    """A client connected to the server, and the state of the
+    conversation with it.
+
+    Connections speaking something other than the protocol of
+    sysmon.protocol (see Server.listen_tcp()) override receive(), and
+    return no requests from it.
+    """
+    #whether the server logs the comings and goings of such connections
+    quiet=False
+
+    def __init__(self,server,sock,addr):
+        """Creates the connection of a client that was just accepted.
+        """
+        self.sock=sock
+        self.fd=sock.fileno()
+        self.addr=addr
+        self.closed=False
+        self.reader=None #FrameReader, once in the framed protocol
+        self.encoder=None
+        self.compressor=None
+        self.scope='' #prefix of all keys, as set by a relay request
+        self.intervals={} #subscribed part key -> interval
+        self.due={} #subscribed part key -> time of the next push
+        self.generation=0 #changes whenever the subscription does
+        self._server=server
+        self._input=''
+        self._output=[]
+        self._backlog=0
+        self._writing=False
+        self._closing=False
+
+    def framed(self):
+        """Returns True if the connection is in the framed protocol.
+        """
+        return self.reader is not None
+
+    def backlog(self):
+        """Returns the number of bytes waiting to be sent.
+        """
+        return self._backlog
+
+    def write(self,data):
+        """Queues data to be sent, sending as much as possible at once.
+        """
+        if self.closed:
+            return
+        self._output.append(data)
+        self._backlog+=len(data)
+        if self._backlog>MAX_OUTPUT:
+            self._server.drop(self,"too slow")
+        elif not self._writing:
+            self.flush()
+
+    def close_when_sent(self):
+        """Has the server disconnect the client once everything queued
+        has been sent.
+        """
+        self._closing=True
+        if not self._output:
+            self._server.drop(self)
+
+    def flush(self):
+        """Sends as much of the queued data as the socket accepts, and
+        watches the socket for room to send the rest.
+        """
+        if self.closed:
+            return
+        if len(self._output)>1:
+            self._output=[''.join(self._output)]
+        while self._output:
+            data=self._output[0]
+            try:
+                n=self.sock.send(data)
+            except socket.error as err:
+                if err.args[0] in _WOULDBLOCK:
+                    break
+                self._server.drop(self)
+                return
+            self._backlog-=n
+            if n<len(data):
+                self._output[0]=data[n:]
+                break
+            self._output.pop(0)
+        if self._closing and not self._output:
+            self._server.drop(self)
+            return
+        writing=bool(self._output)
+        if writing!=self._writing:
+            self._writing=writing
+            self._server.poller().modify(self.fd,writing)
+
+    def send(self,payload,kind=protocol.FRAME_REPLY,tag=0):
+        """Sends a frame.
+        """
+        if self.compressor is not None:
+            self.write(self.compressor.pack_frame(payload,kind,tag))
+        else:
+            self.write(protocol.pack_frame(payload,kind,tag))
+
+    def send_samples(self,samples,kind=protocol.FRAME_REPLY,tag=0):
+        """Sends a frame of encoded samples, given as
+        (key,data,time,mono,seq) tuples.
+        """
+        self.send(self.encoder.encode(samples),
+                  kind|protocol.FRAME_SAMPLES,tag)
+
+    def receive(self):
+        """Receives whatever data is available, and returns the complete
+        requests (line or frame payloads, with their request IDs) in it as
+        a list of (tag,request) pairs.
+
+        EOFError is raised when the client leaves.
+        """
+        requests=[]
+        if self.reader is None:
+            data=self.sock.recv(READ_SIZE)
+            if not data:
+                raise EOFError("connection closed")
+            self._input+=data
+            while self.reader is None and '\n' in self._input:
+                (line,self._input)=self._input.split('\n',1)
+                requests.append((None,line.rstrip('\r')))
+                if line.rstrip('\r')==protocol.negotiation():
+                    #whatever follows is framed
+                    self.reader=protocol.FrameReader(self.sock)
+                    self.reader.feed(self._input)
+                    self._input=''
+            if len(self._input)>MAX_LINE:
+                raise InsaneError("request too long")
+            if self.reader is None:
+                return requests
+        elif not self.reader.fill(self.reader.wanted()):
+            raise EOFError("connection closed")
+        frame=self.reader.next_frame()
+        while frame is not None:
+            (kind,tag,payload)=frame
+            requests.append((tag,payload))
+            frame=self.reader.next_frame()
+        return requests
+
+
+class Server():
+    """Serves a system to remote clients, in the protocol described in
+    sysmon.protocol.
+    """
+    def __init__(self,system,port=protocol.DEFAULT_PORT,
+                 backlog=DEFAULT_BACKLOG,address='',cache=None):
+        """Creates a server for the given system, listening on the given
+        port, with the given backlog of connections waiting to be
+        accepted.
+
+        Parts are served from the given SampleCache, or from one with the
+        default intervals.
+        """
+        self._system=system
+        if cache is None:
+            cache=SampleCache(system)
+        self._cache=cache
+        self._tasks=[cache]
+        self._poller=events.Poller()
+        self._conns={} #fd -> Connection
+        self._pushes=[] #heap of (time,seq,connection,generation)
+        self._seq=itertools.count()
+        self._backlog=backlog
+        self._listeners={} #fd -> (listening socket,connection factory)
+        self._paths=[] #Unix socket files to remove when closing
+        self.listen_tcp(port,address)
+
+    def _listen(self,sock,factory=Connection):
+        sock.listen(self._backlog)
+        sock.setblocking(0)
+        self._listeners[sock.fileno()]=(sock,factory)
+        self._poller.register(sock.fileno())
+
+    def listen_tcp(self,port,address='',factory=Connection):
+        """Listens on the given TCP port. Clients connecting there are
+        served by connections made with factory(server,socket,address),
+        which by default speak the protocol of sysmon.protocol.
+        """
+        sock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        #allow restarting at once, while clients are reconnecting
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        sock.bind((address,port))
+        self._listen(sock,factory)
+
+    def listen_unix(self,path):
+        """Also listens on a Unix socket at the given path, for clients on
+        the same machine. A socket left at the path by an earlier server
+        is replaced.
+        """
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+        sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.bind(path)
+        self._paths.append(path)
+        self._listen(sock)
+
+    def poller(self):
+        """Returns the Poller used by the event loop.
+        """
+        return self._poller
+
+    def connections(self):
+        """Returns the list of connected clients.
+        """
+        return self._conns.values()
+
+    def log(self,msg):
+        """Tells the admin what is happening.
+        """
+        print msg
+
+    def cache(self):
+        """Returns the SampleCache serving the parts.
+        """
+        return self._cache
+
+    def add_task(self,task):
+        """Has the event loop call task.run() whenever the time returned
+        by task.next_due() comes (if it is not None), like the cache's.
+
+        The task must not block. If it has a close() method, that is called
+        when the server is closed.
+        """
+        self._tasks.append(task)
+
+    def serve_forever(self):
+        """Runs the event loop until interrupted.
+        """
+        while True:
+            self.serve_once()
+
+    def serve_once(self,timeout=None):
+        """Runs one iteration of the event loop, waiting at most timeout
+        seconds (or until the next sample or push is due) for something to
+        happen.
+        """
+        due=[task.next_due() for task in self._tasks]
+        if self._pushes:
+            due.append(self._pushes[0][0])
+        for when in due:
+            if when is not None:
+                wait=when-time.time()
+                if timeout is None or wait<timeout:
+                    timeout=wait
+        poller=self._poller
+        for (fd,events) in poller.poll(timeout):
+            if fd in self._listeners:
+                self._accept(*self._listeners[fd])
+                continue
+            conn=self._conns.get(fd)
+            if conn is None:
+                continue
+            if events&(poller.IN|poller.ERR):
+                self._receive(conn)
+            if events&poller.OUT and not conn.closed:
+                conn.flush()
+        for task in self._tasks:
+            #(tasks schedule their next run before doing anything, so a
+            #task that fails is not run again at once)
+            try:
+                task.run()
+            except Exception:
+                self.log("Task %s failed:\n%s" % (task.__class__.__name__,
+                                                   traceback.format_exc()))
+        self._push()
+
+    def close(self):
+        """Disconnects all clients and stops listening.
+        """
+        for conn in self._conns.values():
+            self.drop(conn)
+        for (fd,(sock,factory)) in self._listeners.items():
+            self._poller.unregister(fd)
+            sock.close()
+        for path in self._paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        for task in self._tasks:
+            if hasattr(task,'close'):
+                task.close()
+        self._poller.close()
+
+    def _accept(self,listener,factory):
+        while True:
+            try:
+                (sock,addr)=listener.accept()
+            except socket.error as err:
+                if err.args[0] in _WOULDBLOCK+(errno.ECONNABORTED,):
+                    return
+                if err.args[0] in (errno.EMFILE,errno.ENFILE):
+                    self.log("Out of file descriptors!")
+                    return
+                raise
+            sock.setblocking(0)
+            if sock.family==socket.AF_UNIX:
+                addr=('local',)
+            conn=factory(self,sock,addr[0])
+            self._conns[conn.fd]=conn
+            self._poller.register(conn.fd)
+            if not conn.quiet:
+                self.log("Handling connection from %s" % conn.addr)
+
+    def drop(self,conn,why=None):
+        """Disconnects a client.
+        """
+        if conn.closed:
+            return
+        conn.closed=True
+        del self._conns[conn.fd]
+        self._poller.unregister(conn.fd)
+        conn.sock.close()
+        if conn.quiet:
+            return
+        msg="%s left" % conn.addr
+        if why is not None:
+            msg="%s (%s)" % (msg,why)
+        compressor=conn.compressor
+        if compressor is not None:
+            msg=("%s (sent %d bytes, %d uncompressed, "
+                 "%.1f ms compressing)" %
+                 (msg,compressor.wire,compressor.raw,compressor.time*1000))
+        self.log(msg)
+
+    def _receive(self,conn):
+        try:
+            requests=conn.receive()
+        except socket.error as err:
+            if err.args[0] in _WOULDBLOCK:
+                return
+            self.drop(conn)
+            return
+        except EOFError:
+            self.drop(conn)
+            return
+        except InsaneError as err:
+            self.drop(conn,str(err))
+            return
+        for (tag,x) in requests:
+            if conn.closed:
+                return
+            if tag is None:
+                self.handle_line(conn,x)
+            else:
+                self.handle_frame(conn,tag,x)
+
+    def handle_line(self,conn,x):
+        """Answers a request in the line protocol.
+        """
+        if x==protocol.negotiation():
+            #switch to the framed protocol (the reader is already set up)
+            conn.encoder=codec.Encoder()
+            conn.write("%s\n*DONE\n" % x)
+            return
+        threshold=protocol.parse_compression(x)
+        if threshold is not None:
+            #compress the framed protocol, once we switch to it
+            conn.compressor=protocol.Compressor(threshold)
+            conn.write("%s\n*DONE\n" % x)
+            return
+        name=protocol.parse_relay(x)
+        if name is not None:
+            #watch a relayed system alone
+            if name in self._cache.relayed():
+                conn.scope=name+'/'
+                conn.write("%s\n*DONE\n" % x)
+            else:
+                conn.write("unknown system: %s\n*DONE\n" % name)
+            return
+        conn.write(self.answer(x,conn.scope)+"*DONE\n")
+
+    def handle_frame(self,conn,tag,x):
+        """Answers a request in the framed protocol.
+        """
+        if x.startswith('subscribe ') or x=='unsubscribe':
+            intervals={}
+            if x!='unsubscribe':
+                try:
+                    intervals=protocol.parse_intervals(x[10:])
+                except UserError as err:
+                    conn.send("%s\n" % err,tag=tag)
+                    return
+            conn.send("",tag=tag)
+            self.subscribe(conn,intervals)
+        elif self.meta(x,conn.scope) is not None:
+            conn.send(codec.encode_meta(self.meta(x,conn.scope)),tag=tag)
+        else:
+            try:
+                samples=self.samples(x,conn.scope)
+                processes=self.processes(x,conn.scope)
+            except UserError as err:
+                conn.send("%s\n" % err,tag=tag)
+                return
+            if samples is not None:
+                conn.send_samples(samples,tag=tag)
+            elif processes is not None:
+                conn.send(codec.encode_processes(processes),tag=tag)
+            else:
+                conn.send(self.answer(x,conn.scope),tag=tag)
+
+    def subscribe(self,conn,intervals):
+        """Replaces the subscription of a client with one to the given
+        parts, each pushed at its own interval.
+
+        Parts that are not in the cache but could be (those with a schema)
+        are kept: a relay has none of an upstream's parts until it is
+        reached, and they are pushed as soon as their first samples
+        arrive.
+        """
+        conn.generation+=1
+        conn.intervals=dict([(key,max(interval,MIN_INTERVAL))
+                             for (key,interval) in intervals.items()
+                             if self._cache.has(conn.scope+key) or
+                             codec.schema(key) is not None])
+        now=time.time()
+        conn.due=dict([(key,now) for key in conn.intervals])
+        if conn.due:
+            heapq.heappush(self._pushes,
+                           (now,self._seq.next(),conn,conn.generation))
+
+    def _push(self):
+        """Pushes samples to all clients whose subscribed parts are due.
+        """
+        now=time.time()
+        pushes=self._pushes
+        while pushes and pushes[0][0]<=now:
+            (when,seq,conn,generation)=heapq.heappop(pushes)
+            if conn.closed or generation!=conn.generation:
+                continue
+            keys=[key for (key,due) in conn.due.items() if due<=now]
+            if conn.backlog()<PUSH_BACKLOG:
+                samples=[]
+                for key in keys:
+                    entry=self._cache.get(conn.scope+key)
+                    if entry is not None:
+                        samples.append((key,)+entry)
+                #(sent even if empty, so the client knows we're here)
+                conn.send_samples(samples,protocol.FRAME_PUSH)
+            #(if the client cannot keep up, it misses this push)
+            for key in keys:
+                conn.due[key]=now+conn.intervals[key]
+            if not conn.closed:
+                heapq.heappush(pushes,(min(conn.due.values()),
+                                       self._seq.next(),conn,generation))
+
+    def meta(self,x,scope=''):
+        """Returns the metadata asked for by a request ('meta', or
+        'NAME/meta' for a relayed system), or None for any other request.
+
+        Keys in the request are taken to start with scope.
+        """
+        x=scope+x
+        if x=='meta':
+            return self._system.meta()
+        if x.endswith('/meta') and x[:-5] in self._cache.relayed():
+            return self._cache.meta(x[:-5])
+        return None
+
+    def overview(self,scope=''):
+        """Returns the lines of the reply to 'overview', listing the
+        parts of the system, and every part of every relayed system.
+
+        With a scope, only the parts of that relayed system are listed.
+        """
+        if scope:
+            return ["%s\n" % key for key in self._cache.overview(scope[:-1])]
+        out=[]
+        #(skip uptime)
+        #cpus
+        for cpu in self._system.processors():
+            out.append("processor %s\n" % cpu.name())
+
+        #(skip memory)
+        #filesystems
+        for fs in self._system.filesystems():
+            out.append("filesystem %s\n" % fs.device())
+
+        #drives
+
+        #(skip processlist)
+        #relayed systems, in full
+        for name in sorted(self._cache.relayed()):
+            for key in self._cache.overview(name):
+                out.append("%s/%s\n" % (name,key))
+        return out
+
+    def samples(self,x,scope=''):
+        """Returns the samples requested by a snapshot or part query, as a
+        list of (key,data,time,mono,seq) tuples (see SampleCache.get()), or
+        None for any other request.
+
+        Keys in the request are taken to start with scope, which is left
+        out of the keys of the samples.
+
+        UserError is raised if the query has a bad max-age option.
+        """
+        history=protocol.parse_history(x)
+        if history is not None:
+            return self.history(scope,*history)
+        (x,max_age)=protocol.split_max_age(x)
+        if x=='snapshot' or x.startswith('snapshot '):
+            keys=x[len('snapshot '):].split(',')
+            if keys==['']:
+                keys=[key[len(scope):] for key in self._cache.keys()
+                      if key.startswith(scope)]
+        elif self._cache.has(scope+x):
+            keys=[x]
+        else:
+            return None
+        samples=[]
+        for key in keys:
+            entry=self._cache.get(scope+key,max_age)
+            if entry is not None:
+                samples.append((key,)+entry)
+        return samples
+
+    def processes(self,x,scope=''):
+        """Returns the processes asked for by a top request (see
+        protocol.top()), or None for any other request. Relayed systems
+        (with a scope) have no processes.
+
+        UserError is raised if the request is malformed.
+        """
+        top=protocol.parse_top(x)
+        if top is None:
+            return None
+        if scope:
+            return []
+        return self._cache.top(*top)
+
+    def history(self,scope,keys,since=None,seqs={}):
+        """Returns the kept samples asked for by a history request (see
+        protocol.history()), oldest first, as a list of
+        (key,data,time,mono,seq) tuples of at most protocol.HISTORY_PAGE
+        samples.
+
+        Keys in the request are taken to start with scope, which is left
+        out of the keys of the samples.
+        """
+        cache=self._cache
+        if not keys:
+            keys=[key[len(scope):] for key in cache.keys()
+                  if key.startswith(scope)]
+        #the page is chosen by time alone, and only the samples in it are
+        #decoded
+        found=[]
+        for key in keys:
+            (first,times)=cache.find_history(scope+key,since,seqs.get(key),
+                                             protocol.HISTORY_PAGE)
+            found.append(itertools.izip(times,itertools.repeat(key),
+                                        itertools.count(first)))
+        numbers={} #key -> numbers of the samples in the page
+        for (t,key,number) in itertools.islice(heapq.merge(*found),
+                                               protocol.HISTORY_PAGE):
+            numbers.setdefault(key,[]).append(number)
+        page=[]
+        for (key,numbers) in numbers.items():
+            for entry in cache.history_samples(scope+key,numbers):
+                page.append((entry[1],key,entry))
+        #the oldest first
+        page.sort(key=lambda item: item[:2])
+        return [(key,)+entry for (t,key,entry) in page]
+
+    def answer(self,x,scope=''):
+        """Returns the reply to a single request in the line protocol,
+        without the final *DONE.
+
+        Keys in the request are taken to start with scope.
+        """
+        system=self._system
+        cache=self._cache
+        out=[]
+        try:
+            samples=self.samples(x,scope)
+            processes=self.processes(x,scope)
+        except UserError as err:
+            return "%s\n" % err
+        meta=self.meta(x,scope)
+        if meta is not None:
+            #give metadata
+            out.append("%s\n" % cPickle.dumps(meta))
+        elif x=='overview':
+            #list all parts
+            out.extend(self.overview(scope))
+        elif scope and x in ('filesystem','all'):
+            #relayed parts are only sampled by their upstreams
+            pass
+        elif x=='filesystem':
+            # update all filesystems
+            for fs in system.filesystems():
+                cache.refresh(fs.key())
+        elif x=='all':
+            #everything
+            for key in cache.keys():
+                cache.refresh(key)
+        elif processes is not None:
+            #a list of processes
+            out.append("%s\n" % cPickle.dumps(processes))
+        elif samples is None:
+            #unknown
+            pass
+        elif x.startswith('history'):
+            #a list of samples
+            out.append("%s\n" % cPickle.dumps(samples))
+        elif x.startswith('snapshot'):
+            #several parts at once, as a pickled dictionary
+            out.append("%s\n" % cPickle.dumps(
+                    dict([(sample[0],sample[1]) for sample in samples])))
+        elif x.startswith('uptime'):
+            #that doesn't have a callback - just give the answer
+            out.append("%d\n" % samples[0][1])
+        elif samples:
+            #memory, processor or filesystem: get the pickled data
+            out.append("%s\n" % cPickle.dumps(samples[0][1]))
+        return "".join(out)
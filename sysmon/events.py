@@ -0,0 +1,317 @@
+#########################################################################
+# YASMon - Yet Another System Monitor                                   #
+# Copyright (C) 2010  Scott Lawrence                                    #
+#                                                                       #
+# This program is free software: you can redistribute it and/or modify  #
+# it under the terms of the GNU General Public License as published by  #
+# the Free Software Foundation, either version 3 of the License, or     #
+# (at your option) any later version.                                   #
+#                                                                       #
+# This program is distributed in the hope that it will be useful,       #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+# GNU General Public License for more details.                          #
+#                                                                       #
+# You should have received a copy of the GNU General Public License     #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>. #
+#########################################################################
+
+"""Event loops, for watching many sockets from a single thread.
+
+"""
+
+import collections,errno,fcntl,heapq,itertools,os,select,threading,time
+import traceback,Queue
+
+#the default number of worker threads of an EventLoop
+DEFAULT_WORKERS=8
+
+#the default largest number of connector threads of an EventLoop
+DEFAULT_CONNECTORS=64
+
+class Poller():
+    """Waits for events on many file descriptors at once.
+    """
+    def __init__(self):
+        """Creates a poller, using epoll if it is available.
+        """
+        if hasattr(select,'epoll'):
+            self._poll=select.epoll()
+            self._scale=1.0
+            self.IN=select.EPOLLIN
+            self.OUT=select.EPOLLOUT
+            self.ERR=select.EPOLLERR|select.EPOLLHUP
+        else:
+            self._poll=select.poll()
+            self._scale=1000.0
+            self.IN=select.POLLIN
+            self.OUT=select.POLLOUT
+            self.ERR=select.POLLERR|select.POLLHUP|select.POLLNVAL
+
+    def register(self,fd,write=False):
+        """Starts watching fd, for input and, if write is True, for room
+        to write.
+        """
+        self._poll.register(fd,self.IN|(write and self.OUT or 0))
+
+    def modify(self,fd,write):
+        """Changes whether fd is watched for room to write.
+        """
+        self._poll.modify(fd,self.IN|(write and self.OUT or 0))
+
+    def unregister(self,fd):
+        """Stops watching fd.
+        """
+        self._poll.unregister(fd)
+
+    def poll(self,timeout=None):
+        """Waits until some events happen, or until timeout seconds have
+        passed, and returns a list of (fd,events) pairs.
+        """
+        if timeout is None:
+            timeout=-1
+        else:
+            timeout=max(0,timeout)*self._scale
+        try:
+            return self._poll.poll(timeout)
+        except (IOError,select.error) as err:
+            if err.args[0]==errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        """Releases the poller.
+        """
+        if hasattr(self._poll,'close'):
+            self._poll.close()
+
+
+class Call():
+    """A call scheduled with EventLoop.call_later().
+    """
+    def __init__(self,func,args):
+        self._func=func
+        self._args=args
+        self._cancelled=False
+
+    def cancel(self):
+        """Keeps the call from happening, if it has not happened yet.
+        """
+        self._cancelled=True
+
+    def cancelled(self):
+        """Returns True if the call was cancelled.
+        """
+        return self._cancelled
+
+    def run(self):
+        if not self._cancelled:
+            self._func(*self._args)
+
+
+class EventLoop():
+    """Calls functions when sockets become readable, and at given times,
+    all from a single thread.
+
+    Functions run by the loop must never block. Anything that might (like
+    waiting for a reply) is handed to one of a fixed number of worker
+    threads with defer(), so the number of threads does not depend on the
+    number of sockets watched. Connecting to remote machines is handed to
+    connector threads instead, with defer_connect(): a machine that does
+    not answer keeps one of them waiting until the connection times out,
+    and the workers must stay free meanwhile. Connector threads are only
+    started as they are needed, up to a bound, which is the number of
+    machines that can be waited for at once.
+
+    All methods may be called from any thread.
+    """
+    def __init__(self,workers=DEFAULT_WORKERS,connectors=DEFAULT_CONNECTORS):
+        """Creates an event loop with the given number of worker threads,
+        and at most the given number of connector threads.
+
+        Nothing runs before start() is called.
+        """
+        self._poller=Poller()
+        self._readers={} #fd -> (socket,function)
+        self._timers=[] #heap of (time,seq,Call)
+        self._seq=itertools.count()
+        self._calls=collections.deque()
+        self._lock=threading.Lock()
+        #written to wake the loop up
+        (self._wake_r,self._wake_w)=os.pipe()
+        for fd in (self._wake_r,self._wake_w):
+            fcntl.fcntl(fd,fcntl.F_SETFL,
+                        fcntl.fcntl(fd,fcntl.F_GETFL)|os.O_NONBLOCK)
+        self._poller.register(self._wake_r)
+        self._tasks=Queue.Queue()
+        self._workers=workers
+        self._connects=Queue.Queue()
+        self._connectors=connectors
+        self._connect_lock=threading.Lock()
+        self._started=0 #connector threads started
+        self._idle=0 #connector threads waiting for something to do
+        self._thread=None
+
+    def start(self):
+        """Starts the loop and the worker threads.
+        """
+        self._thread=threading.Thread(target=self.run_forever)
+        self._thread.daemon=True
+        self._thread.start()
+        for i in xrange(self._workers):
+            worker=threading.Thread(target=self._work)
+            worker.daemon=True
+            worker.start()
+
+    def in_loop(self):
+        """Returns True if called from the loop's thread.
+        """
+        return threading.current_thread() is self._thread
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w,'x')
+        except OSError:
+            #the pipe is full, so the loop wakes up anyway
+            pass
+
+    def call_soon(self,func,*args):
+        """Has the loop call func with the given arguments as soon as
+        possible.
+        """
+        self._calls.append((func,args))
+        self._wake()
+
+    def call_later(self,delay,func,*args):
+        """Has the loop call func with the given arguments after delay
+        seconds, and returns a Call that may be cancelled.
+        """
+        call=Call(func,args)
+        with self._lock:
+            heapq.heappush(self._timers,
+                           (time.time()+delay,self._seq.next(),call))
+        self._wake()
+        return call
+
+    def defer(self,func,*args):
+        """Has a worker thread call func with the given arguments.
+        """
+        self._tasks.put((func,args))
+
+    def defer_connect(self,func,*args):
+        """Has a connector thread call func with the given arguments; func
+        is expected to connect somewhere, and may block until it times
+        out.
+        """
+        self._connects.put((func,args))
+        with self._connect_lock:
+            if self._connects.qsize()>self._idle and \
+                    self._started<self._connectors:
+                self._started+=1
+                connector=threading.Thread(target=self._connect_work)
+                connector.daemon=True
+                connector.start()
+
+    def add_reader(self,sock,func):
+        """Has the loop call func whenever sock is readable.
+        """
+        self.call_soon(self._add_reader,sock,func)
+
+    def remove_reader(self,sock):
+        """Stops watching sock.
+        """
+        self.call_soon(self._remove_reader,sock)
+
+    def _add_reader(self,sock,func):
+        fd=sock.fileno()
+        if fd in self._readers:
+            self._remove_reader(self._readers[fd][0])
+        self._readers[fd]=(sock,func)
+        self._poller.register(fd)
+
+    def _remove_reader(self,sock):
+        for (fd,(s,func)) in self._readers.items():
+            if s is sock:
+                del self._readers[fd]
+                try:
+                    self._poller.unregister(fd)
+                except (IOError,OSError,KeyError,ValueError):
+                    #closed already
+                    pass
+                return
+
+    def _run(self,func,args):
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def run_once(self,timeout=None):
+        """Runs one iteration of the loop, waiting at most timeout seconds
+        (or until the next call is due) for something to happen.
+        """
+        with self._lock:
+            if self._timers:
+                wait=self._timers[0][0]-time.time()
+                if timeout is None or wait<timeout:
+                    timeout=wait
+        if self._calls:
+            timeout=0
+        for (fd,events) in self._poller.poll(timeout):
+            if fd==self._wake_r:
+                try:
+                    while os.read(fd,4096):
+                        pass
+                except OSError:
+                    pass
+                continue
+            entry=self._readers.get(fd)
+            if entry is not None:
+                self._run(entry[1],())
+        #calls
+        for i in xrange(len(self._calls)):
+            (func,args)=self._calls.popleft()
+            self._run(func,args)
+        #timers
+        now=time.time()
+        due=[]
+        with self._lock:
+            while self._timers and self._timers[0][0]<=now:
+                due.append(heapq.heappop(self._timers)[2])
+        for call in due:
+            self._run(call.run,())
+
+    def run_forever(self):
+        """Runs the loop forever.
+        """
+        while True:
+            self.run_once()
+
+    def _work(self):
+        while True:
+            (func,args)=self._tasks.get()
+            self._run(func,args)
+
+    def _connect_work(self):
+        while True:
+            with self._connect_lock:
+                self._idle+=1
+            (func,args)=self._connects.get()
+            with self._connect_lock:
+                self._idle-=1
+            self._run(func,args)
+
+
+_default=None
+_default_lock=threading.Lock()
+
+def default_loop():
+    """Returns the event loop shared by everything that is not given one
+    of its own, starting it if needed.
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default=EventLoop()
+            _default.start()
+        return _default
@@ -291,7 +291,9 @@ class PartHistoryView(QWidget):
         #create the list of PartHistorys
         self.hlist = []
         for part in self.plist:
-            hist=sysmon.history.PartHistory(part)
+            hist=part.history()
+            if hist is None:
+                hist=sysmon.history.ColumnarHistory(part)
             self.hlist += [hist]
         self.setToolTip("History") #FIXME TODO a better tooltip
         #set the size
@@ -19,9 +19,13 @@
 """Provides utilities for storing and analyzing histories of parts.
 """
 
+import array,binascii,bisect,csv,math,mmap,os,os.path,struct,sys,time
+from collections import deque
 import cPickle
+from cStringIO import StringIO
 
 import sysmon
+from error import *
 
 class PartHistory():
     """Stores the history of a single part.
@@ -52,3 +56,1505 @@ class PartHistory():
         """
         # append the current data to the history
         self.hist += [self.part.data_copy()]
+
+
+class Column():
+    """Stores the history of a single numeric metric.
+
+    Samples are kept in two parallel, contiguous arrays of doubles - one
+    holding the timestamps and one holding the values - so that the
+    history can be sliced by time with a binary search and handed to
+    graphing or statistics code without touching a single python object
+    per sample.
+    """
+    def __init__(self,maxlen=None):
+        """Creates an empty column.
+
+        If maxlen is given, old samples are discarded so that only (at
+        least) the last maxlen samples are kept.
+        """
+        self._times=array.array('d')
+        self._values=array.array('d')
+        self._maxlen=maxlen
+
+    def __len__(self):
+        return len(self._times)
+
+    def append(self,t,value):
+        """Appends a single sample, taken at time t.
+
+        Samples must be appended in chronological order.
+        """
+        self._times.append(t)
+        self._values.append(value)
+        #trim in batches, so that appending stays cheap
+        maxlen=self._maxlen
+        if maxlen and len(self._times)>maxlen+(maxlen>>2):
+            del self._times[:-maxlen]
+            del self._values[:-maxlen]
+
+    def times(self):
+        """Returns the array of timestamps.
+
+        The returned array is owned by the column and must not be
+        modified.
+        """
+        return self._times
+
+    def values(self):
+        """Returns the array of values, parallel to times().
+
+        The returned array is owned by the column and must not be
+        modified.
+        """
+        return self._values
+
+    def last(self):
+        """Returns the most recent sample as a (time,value) tuple, or
+        None if the column is empty.
+        """
+        if not self._times:
+            return None
+        return (self._times[-1],self._values[-1])
+
+    def bounds(self,start=None,end=None):
+        """Returns the range of indices (i,j) of samples taken in the time
+        range [start,end).
+
+        Either bound may be None, meaning the range is unbounded on that
+        side.
+        """
+        i=0
+        j=len(self._times)
+        if start is not None:
+            i=bisect.bisect_left(self._times,start)
+        if end is not None:
+            j=bisect.bisect_left(self._times,end)
+        return (i,max(i,j))
+
+    def slice(self,start=None,end=None):
+        """Returns the samples taken in the time range [start,end) as a
+        tuple of two arrays (times,values).
+
+        The returned arrays are copies and may be used freely.
+        """
+        (i,j)=self.bounds(start,end)
+        return (self._times[i:j],self._values[i:j])
+
+    def chunks(self,size=4096):
+        """Yields the samples in chunks of up to size samples, as tuples of
+        two arrays (times,values).
+        """
+        n=len(self._times)
+        for i in xrange(0,n,size):
+            j=min(i+size,n)
+            yield (self._times[i:j],self._values[i:j])
+
+
+class QuantileSketch():
+    """Estimates quantiles of a changing multiset of numbers.
+
+    Values are counted in logarithmically sized buckets, so that every
+    quantile is estimated within the given relative accuracy. Values may
+    be removed as well as added, and the number of buckets depends only on
+    the range of the values, not on how many there are.
+    """
+    def __init__(self,accuracy=0.01):
+        """Creates an empty sketch with the given relative accuracy.
+        """
+        self._gamma=(1+accuracy)/(1-accuracy)
+        self._lngamma=math.log(self._gamma)
+        self._counts={} #bucket -> count
+        self._keys=[] #sorted list of buckets in use
+        self._n=0
+
+    def __len__(self):
+        return self._n
+
+    def _key(self,value):
+        """Returns the bucket for a value.
+
+        Buckets of positive values are numbered upwards from a large
+        offset, buckets of negative values mirror them below zero, and
+        bucket 0 holds zero, so that bucket order matches value order.
+        """
+        if value==0:
+            return 0
+        k=int(math.ceil(math.log(abs(value))/self._lngamma))+(1<<20)
+        if value>0:
+            return k
+        return -k
+
+    def _value(self,key):
+        """Returns the representative value of a bucket.
+        """
+        if key==0:
+            return 0.0
+        value=2*self._gamma**(abs(key)-(1<<20))/(self._gamma+1)
+        if key<0:
+            return -value
+        return value
+
+    def add(self,value):
+        """Adds a value to the sketch.
+        """
+        key=self._key(value)
+        count=self._counts.get(key,0)
+        if not count:
+            bisect.insort(self._keys,key)
+        self._counts[key]=count+1
+        self._n+=1
+
+    def remove(self,value):
+        """Removes a value previously added to the sketch.
+        """
+        key=self._key(value)
+        count=self._counts[key]-1
+        if count:
+            self._counts[key]=count
+        else:
+            del self._counts[key]
+            del self._keys[bisect.bisect_left(self._keys,key)]
+        self._n-=1
+
+    def quantile(self,q):
+        """Returns an estimate of the q-quantile (0<=q<=1), or None if
+        the sketch is empty.
+        """
+        if not self._n:
+            return None
+        rank=q*(self._n-1)
+        seen=0
+        for key in self._keys:
+            seen+=self._counts[key]
+            if seen>rank:
+                return self._value(key)
+        return self._value(self._keys[-1])
+
+
+class WindowStats():
+    """Maintains aggregates of a metric over a sliding time window.
+
+    Every aggregate is updated incrementally as samples are appended and
+    expire, so reading one never rescans the window: min() and max() use
+    monotonic queues, mean() and stddev() Welford's running mean and sum of
+    squared deviations (updated on removal as well), and percentile() a
+    QuantileSketch. The running sums are recomputed exactly once the
+    window has turned over, or an outlier has left it, so rounding errors
+    never build up.
+    """
+    def __init__(self,width,accuracy=0.01):
+        """Creates an empty window spanning width seconds.
+
+        Percentiles are estimated within the given relative accuracy.
+        """
+        self._width=width
+        self._samples=deque()
+        self._mins=deque()
+        self._maxs=deque()
+        self._mean=0.0
+        self._m2=0.0 #sum of squared deviations from the mean
+        self._removed=0 #samples expired since the sums were recomputed
+        self._sketch=QuantileSketch(accuracy)
+
+    def width(self):
+        """Returns the width of the window, in seconds.
+        """
+        return self._width
+
+    def __len__(self):
+        return len(self._samples)
+
+    def append(self,t,value):
+        """Adds a single sample, taken at time t, and expires all samples
+        that are now older than the window.
+
+        NaN and infinite values have no place in any of the aggregates,
+        and are skipped.
+        """
+        if math.isnan(value) or math.isinf(value):
+            self.expire(t)
+            return
+        self._samples.append((t,value))
+        while self._mins and self._mins[-1][1]>=value:
+            self._mins.pop()
+        self._mins.append((t,value))
+        while self._maxs and self._maxs[-1][1]<=value:
+            self._maxs.pop()
+        self._maxs.append((t,value))
+        d=value-self._mean
+        self._mean+=d/len(self._samples)
+        self._m2+=d*(value-self._mean)
+        self._sketch.add(value)
+        self.expire(t)
+
+    def expire(self,now):
+        """Removes all samples older than the window ending at now.
+
+        This is done automatically on each append.
+        """
+        limit=now-self._width
+        samples=self._samples
+        while samples and samples[0][0]<=limit:
+            (t,value)=samples.popleft()
+            n=len(samples)
+            if n:
+                d=value-self._mean
+                self._mean-=d/n
+                m2=self._m2
+                self._m2-=d*(value-self._mean)
+                if self._m2<m2*1e-6:
+                    #an outlier left, and took most of the precision of
+                    #the sum with it
+                    self._removed=n
+            else:
+                self._mean=self._m2=0.0
+            self._removed+=1
+            self._sketch.remove(value)
+        while self._mins and self._mins[0][0]<=limit:
+            self._mins.popleft()
+        while self._maxs and self._maxs[0][0]<=limit:
+            self._maxs.popleft()
+        if self._removed>=len(samples):
+            self._recompute()
+
+    def _recompute(self):
+        """Recomputes the running mean and sum of squared deviations from
+        the samples in the window.
+        """
+        samples=self._samples
+        self._removed=0
+        if not samples:
+            self._mean=self._m2=0.0
+            return
+        mean=math.fsum([value for (t,value) in samples])/len(samples)
+        self._mean=mean
+        self._m2=math.fsum([(value-mean)**2 for (t,value) in samples])
+
+    def min(self):
+        """Returns the smallest value in the window, or None.
+        """
+        if self._mins:
+            return self._mins[0][1]
+        return None
+
+    def max(self):
+        """Returns the largest value in the window, or None.
+        """
+        if self._maxs:
+            return self._maxs[0][1]
+        return None
+
+    def mean(self):
+        """Returns the mean of the window, or None.
+        """
+        n=len(self._samples)
+        if not n:
+            return None
+        return self._mean
+
+    def stddev(self):
+        """Returns the (population) standard deviation of the window, or
+        None.
+        """
+        n=len(self._samples)
+        if not n:
+            return None
+        return math.sqrt(max(self._m2/n,0.0))
+
+    def percentile(self,p):
+        """Returns an estimate of the p-th percentile (0<=p<=100) of the
+        window, or None.
+        """
+        return self._sketch.quantile(p/100.)
+
+
+class MetricHistory():
+    """Base class for histories storing the numeric metrics of a single
+    part, one series per metric.
+
+    Subclasses decide how each series is stored by implementing
+    new_series().
+    """
+    def __init__(self,part=None):
+        """Creates a self-managing history for the given part.
+
+        If no part is given, the history is not attached to anything and
+        must be filled with append().
+        """
+        self.part=part
+        self._series={}
+        self._windows={} #metric -> list of WindowStats
+        if part is not None:
+            part.system().callback().hook(part.update_hook(),
+                                          self.catch_update)
+
+    def new_series(self,name):
+        """Returns a new, empty series for the named metric.
+
+        Subclasses must implement this method.
+        """
+        raise UnimplementedError("MetricHistory must implement new_series()")
+
+    def catch_update(self,part):
+        """Records the current metrics of the attached part.
+
+        This method is called after the attached part updates (by the hook
+        system), and should not be called in any other way.
+        """
+        #several parts may share one hook
+        if part is not self.part:
+            return
+        #(remote parts are sampled by the remote machine, a while before
+        #their samples arrive)
+        self.record(part.sampled() or time.time())
+
+    def record(self,t):
+        """Records the current values of all of the part's metrics as
+        taken at time t.
+        """
+        for (name,value) in self.part.metrics().items():
+            try:
+                value=float(value())
+            except (KeyError,TypeError,ValueError):
+                #no data (yet)
+                continue
+            self.append(name,t,value)
+
+    def append(self,name,t,value):
+        """Appends a single sample to the named metric's series.
+        """
+        series=self._series.get(name)
+        if series is None:
+            series=self._series[name]=self.new_series(name)
+        series.append(t,value)
+        for window in self._windows.get(name,()):
+            window.append(t,value)
+
+    def window(self,name,width,accuracy=0.01):
+        """Returns a WindowStats maintaining aggregates of the named metric
+        over the last width seconds.
+
+        The window is created (from the history recorded so far) the first
+        time it is asked for, and kept up to date on every append from then
+        on, so asking for it again is cheap.
+        """
+        windows=self._windows.setdefault(name,[])
+        for window in windows:
+            if window.width()==width:
+                return window
+        window=WindowStats(width,accuracy)
+        series=self._series.get(name)
+        if series is not None and len(series):
+            (times,values)=series.slice(series.last()[0]-width)
+            for (t,value) in zip(times,values):
+                window.append(t,value)
+        windows.append(window)
+        return window
+
+    def metrics(self):
+        """Returns a sorted list of the names of all recorded metrics.
+        """
+        return sorted(self._series.keys())
+
+    def last_time(self):
+        """Returns the time of the latest sample recorded, or None if
+        nothing was.
+        """
+        times=[series.last()[0] for series in self._series.values()
+               if series.last() is not None]
+        if not times:
+            return None
+        return max(times)
+
+    def series(self,name):
+        """Returns the series storing the named metric.
+        """
+        return self._series[name]
+
+    def slice(self,name,start=None,end=None):
+        """Returns the samples of the named metric taken in the time range
+        [start,end) as a tuple of two arrays (times,values).
+        """
+        return self._series[name].slice(start,end)
+
+    def chunks(self,size=4096):
+        """Yields the whole history in chunks of up to size samples, as
+        tuples (metric,times,values).
+        """
+        for name in self.metrics():
+            for (times,values) in self._series[name].chunks(size):
+                yield (name,times,values)
+
+
+class ColumnarHistory(MetricHistory):
+    """Stores the numeric history of a single part in Columns.
+    """
+    def __init__(self,part=None,maxlen=None):
+        """Creates a self-managing ColumnarHistory for the given part.
+
+        If maxlen is given, only (at least) the last maxlen samples of
+        each metric are kept.
+        """
+        self._maxlen=maxlen
+        MetricHistory.__init__(self,part)
+
+    def new_series(self,name):
+        return Column(self._maxlen)
+
+
+#the default rollup tiers, as (step,length) pairs: one second for an hour,
+#one minute for a day and fifteen minutes for a month
+DEFAULT_TIERS=((1,3600),(60,1440),(900,2976))
+
+class RollupTier():
+    """Stores a metric consolidated to a fixed resolution, RRD-style.
+
+    Samples are grouped into buckets of step seconds, each holding the
+    minimum, maximum, average and last value of the samples that fell into
+    it. At most length buckets are kept in a ring, so the memory used by a
+    tier never changes. Buckets are consolidated incrementally as samples
+    arrive - the ring is never rescanned.
+    """
+    def __init__(self,step,length):
+        """Creates an empty tier of length buckets of step seconds each.
+        """
+        self._step=step
+        self._length=length
+        #the ring of sealed buckets
+        self._times=array.array('d',[0.0])*length
+        self._mins=array.array('d',[0.0])*length
+        self._maxs=array.array('d',[0.0])*length
+        self._avgs=array.array('d',[0.0])*length
+        self._lasts=array.array('d',[0.0])*length
+        self._head=0 #index of the next bucket to be written
+        self._count=0
+        #the bucket currently being filled
+        self._bucket=None
+        self._min=self._max=self._sum=self._last=0.0
+        self._n=0
+
+    def step(self):
+        """Returns the width of a single bucket, in seconds.
+        """
+        return self._step
+
+    def length(self):
+        """Returns the maximum number of buckets kept.
+        """
+        return self._length
+
+    def __len__(self):
+        return self._count+(self._n>0)
+
+    def add(self,t,value):
+        """Consolidates a single sample, taken at time t, into the tier.
+        """
+        bucket=int(t//self._step)
+        if bucket!=self._bucket:
+            self.seal()
+            self._bucket=bucket
+            self._min=self._max=value
+            self._sum=0.0
+        elif value<self._min:
+            self._min=value
+        elif value>self._max:
+            self._max=value
+        self._sum+=value
+        self._last=value
+        self._n+=1
+
+    def seal(self):
+        """Writes the bucket currently being filled to the ring.
+
+        This is done automatically when the first sample of a later bucket
+        arrives.
+        """
+        if not self._n:
+            return
+        i=self._head
+        self._times[i]=self._bucket*self._step
+        self._mins[i]=self._min
+        self._maxs[i]=self._max
+        self._avgs[i]=self._sum/self._n
+        self._lasts[i]=self._last
+        self._head=(i+1)%self._length
+        self._count=min(self._count+1,self._length)
+        self._n=0
+
+    def last(self):
+        """Returns the start time and last value of the newest bucket as a
+        tuple, or None if the tier is empty.
+        """
+        if self._n:
+            return (self._bucket*self._step,self._last)
+        if self._count:
+            i=self._index(self._count-1)
+            return (self._times[i],self._lasts[i])
+        return None
+
+    def oldest(self):
+        """Returns the start time of the oldest bucket kept, or None if the
+        tier is empty.
+        """
+        if self._count:
+            return self._times[self._index(0)]
+        if self._n:
+            return self._bucket*self._step
+        return None
+
+    def covers(self,start):
+        """Returns True if the tier still holds everything recorded since
+        time start.
+        """
+        if self._count<self._length:
+            #nothing was overwritten yet
+            return True
+        return self._times[self._index(0)]<=start
+
+    def _index(self,i):
+        """Maps the chronological index i onto an index into the ring.
+        """
+        return (self._head-self._count+i)%self._length
+
+    def _bisect(self,t):
+        """Returns the chronological index of the first sealed bucket
+        starting at or after time t.
+        """
+        lo=0
+        hi=self._count
+        while lo<hi:
+            mid=(lo+hi)//2
+            if self._times[self._index(mid)]<t:
+                lo=mid+1
+            else:
+                hi=mid
+        return lo
+
+    def rows(self,start=None,end=None):
+        """Returns the buckets starting in the time range [start,end) as a
+        tuple of five arrays (times,mins,maxs,avgs,lasts).
+
+        The bucket currently being filled is included as the last row.
+        """
+        i=0
+        j=self._count
+        if start is not None:
+            i=self._bisect(start)
+        if end is not None:
+            j=max(i,self._bisect(end))
+        #map [i,j) onto at most two slices of the ring
+        a=self._index(i)
+        b=a+(j-i)
+        if b<=self._length:
+            ranges=((a,b),)
+        else:
+            ranges=((a,self._length),(0,b-self._length))
+        rows=[]
+        for col in (self._times,self._mins,self._maxs,
+                    self._avgs,self._lasts):
+            out=array.array('d')
+            for (x,y) in ranges:
+                out.extend(col[x:y])
+            rows.append(out)
+        #append the open bucket
+        if self._n:
+            t=self._bucket*self._step
+            if (start is None or t>=start) and (end is None or t<end):
+                for (col,value) in zip(rows,(t,self._min,self._max,
+                                             self._sum/self._n,self._last)):
+                    col.append(value)
+        return tuple(rows)
+
+
+class RollupSeries():
+    """Stores a single metric in several RollupTiers of decreasing
+    resolution.
+    """
+    def __init__(self,tiers=DEFAULT_TIERS):
+        """Creates an empty series with the given tiers, as a sequence of
+        (step,length) pairs.
+        """
+        self._tiers=[RollupTier(step,length)
+                     for (step,length) in sorted(tiers)]
+
+    def __len__(self):
+        return len(self._tiers[0])
+
+    def tiers(self):
+        """Returns the list of tiers, finest first.
+        """
+        return self._tiers
+
+    def append(self,t,value):
+        """Consolidates a single sample, taken at time t, into every tier.
+        """
+        for tier in self._tiers:
+            tier.add(t,value)
+
+    def last(self):
+        """Returns the newest bucket of the finest tier as a (time,value)
+        tuple, or None if the series is empty.
+        """
+        return self._tiers[0].last()
+
+    def tier(self,resolution=None,start=None):
+        """Returns the tier to answer a query at the given resolution (in
+        seconds) reaching back to time start.
+
+        The tier closest to the resolution - the coarsest whose step is no
+        larger than it, or the finest if none is fine enough - is returned
+        if it still covers start. Otherwise the finest coarser tier that
+        does is, or the coarsest tier if none does.
+        """
+        tiers=self._tiers
+        i=0
+        if resolution is not None:
+            for (j,tier) in enumerate(tiers):
+                if tier.step()<=resolution:
+                    i=j
+        if start is None:
+            return tiers[i]
+        for tier in tiers[i::-1]:
+            if tier.covers(start):
+                return tier
+        for tier in tiers[i+1:]:
+            if tier.covers(start):
+                return tier
+        return tiers[-1]
+
+    def query(self,start=None,end=None,resolution=None):
+        """Returns the consolidated history in the time range [start,end) at
+        the given resolution.
+
+        The return value is a tuple (step,rows), where step is the step of
+        the tier chosen by tier() and rows is as returned by
+        RollupTier.rows().
+        """
+        tier=self.tier(resolution,start)
+        return (tier.step(),tier.rows(start,end))
+
+    def slice(self,start=None,end=None):
+        """Returns the averages of the finest tier in the time range
+        [start,end) as a tuple of two arrays (times,values).
+        """
+        rows=self._tiers[0].rows(start,end)
+        return (rows[0],rows[3])
+
+    def chunks(self,size=4096):
+        """Yields the averages of the finest tier in chunks of up to size
+        samples, as tuples of two arrays (times,values).
+        """
+        (times,values)=self.slice()
+        for i in xrange(0,len(times),size):
+            yield (times[i:i+size],values[i:i+size])
+
+
+class RollupHistory(MetricHistory):
+    """Stores the numeric history of a single part in RollupSeries.
+    """
+    def __init__(self,part=None,tiers=DEFAULT_TIERS):
+        """Creates a self-managing RollupHistory for the given part, with
+        the given tiers (as a sequence of (step,length) pairs).
+        """
+        self._tiers=tiers
+        MetricHistory.__init__(self,part)
+
+    def new_series(self,name):
+        return RollupSeries(self._tiers)
+
+    def query(self,name,start=None,end=None,resolution=None):
+        """Returns the consolidated history of the named metric; see
+        RollupSeries.query().
+        """
+        return self._series[name].query(start,end,resolution)
+
+
+#layout of the header of a mapped history file: magic, format version,
+#number of slots, and the total number of samples ever appended
+MAPPED_MAGIC='YSMH'
+MAPPED_VERSION=1
+MAPPED_HEADER=struct.Struct('<4sIQQ')
+MAPPED_HEADER_SIZE=64
+#offset of the sample counter in the header
+MAPPED_TOTAL_OFFSET=16
+
+def mapped_size(length):
+    """Returns the size, in bytes, of a mapped history file keeping the
+    last length samples of a metric.
+    """
+    return MAPPED_HEADER_SIZE+16*(length+1)
+
+class MappedColumn():
+    """Stores the history of a single numeric metric in a memory-mapped
+    file.
+
+    The file has a fixed layout: a 64-byte header followed by a ring of
+    timestamps and a parallel ring of values, both arrays of little-endian
+    doubles, so its size depends only on the number of samples kept (see
+    mapped_size()). Reopening an existing file maps it and reads nothing
+    but the header.
+
+    A sample is written to the ring before the sample counter in the
+    header is advanced, and the ring has one slot more than the number of
+    samples kept, so the slot being written is never visible. A crash
+    therefore loses at most the sample being appended. Data reaches the
+    disk when the kernel writes the mapping back, or when flush() is
+    called.
+    """
+    def __init__(self,filename,length):
+        """Opens (or creates) the mapped file for a column keeping the last
+        length samples.
+
+        If the file exists but was created for a different length, its
+        samples are carried over to a file of the new length.
+        """
+        self._filename=filename
+        self._length=length
+        self._slots=length+1
+        size=mapped_size(length)
+        samples=None
+        if os.path.exists(filename):
+            if os.path.getsize(filename)==size:
+                if self._open(size) is not None:
+                    return
+            else:
+                old=MappedColumn._reopen(filename)
+                if old is not None:
+                    samples=old.slice()
+                    old.close()
+        #create a new file
+        fd=os.open(filename,os.O_RDWR|os.O_CREAT|os.O_TRUNC,0644)
+        try:
+            os.ftruncate(fd,size)
+            self._map=mmap.mmap(fd,size)
+        finally:
+            os.close(fd)
+        MAPPED_HEADER.pack_into(self._map,0,MAPPED_MAGIC,MAPPED_VERSION,
+                                self._slots,0)
+        self._total=0
+        if samples is not None:
+            (times,values)=samples
+            for (t,value) in zip(times[-length:],values[-length:]):
+                self.append(t,value)
+
+    @staticmethod
+    def _reopen(filename):
+        """Opens an existing mapped file with whatever length it was
+        created with, or returns None if it is not a valid mapped file.
+        """
+        with open(filename,'rb') as f:
+            header=f.read(MAPPED_HEADER.size)
+        if len(header)<MAPPED_HEADER.size:
+            return None
+        (magic,version,slots,total)=MAPPED_HEADER.unpack(header)
+        if magic!=MAPPED_MAGIC or version!=MAPPED_VERSION or slots<2:
+            return None
+        if os.path.getsize(filename)!=mapped_size(slots-1):
+            return None
+        return MappedColumn(filename,slots-1)
+
+    def _open(self,size):
+        """Maps the existing file, returning None if its header is not
+        valid for this column.
+        """
+        fd=os.open(self._filename,os.O_RDWR)
+        try:
+            m=mmap.mmap(fd,size)
+        finally:
+            os.close(fd)
+        (magic,version,slots,total)=MAPPED_HEADER.unpack_from(m,0)
+        if (magic!=MAPPED_MAGIC or version!=MAPPED_VERSION or
+            slots!=self._slots):
+            m.close()
+            return None
+        self._map=m
+        self._total=total
+        return self
+
+    def filename(self):
+        """Returns the name of the backing file.
+        """
+        return self._filename
+
+    def __len__(self):
+        return min(self._total,self._length)
+
+    def _offsets(self):
+        """Returns the offsets of the timestamp and value rings.
+        """
+        return (MAPPED_HEADER_SIZE,MAPPED_HEADER_SIZE+8*self._slots)
+
+    def _slot(self,i):
+        """Maps the chronological index i onto a slot of the ring.
+        """
+        return (self._total-len(self)+i)%self._slots
+
+    def append(self,t,value):
+        """Appends a single sample, taken at time t.
+
+        Samples must be appended in chronological order.
+        """
+        (toff,voff)=self._offsets()
+        slot=self._total%self._slots
+        struct.pack_into('<d',self._map,toff+8*slot,t)
+        struct.pack_into('<d',self._map,voff+8*slot,value)
+        #publish the sample
+        self._total+=1
+        struct.pack_into('<Q',self._map,MAPPED_TOTAL_OFFSET,self._total)
+
+    def _time(self,i):
+        return struct.unpack_from('<d',self._map,
+                                  MAPPED_HEADER_SIZE+8*self._slot(i))[0]
+
+    def _range(self,offset,i,j):
+        """Returns the chronological range [i,j) of the ring at offset as
+        an array.
+        """
+        out=array.array('d')
+        a=self._slot(i)
+        b=a+(j-i)
+        if b<=self._slots:
+            ranges=((a,b),)
+        else:
+            ranges=((a,self._slots),(0,b-self._slots))
+        for (x,y) in ranges:
+            out.fromstring(self._map[offset+8*x:offset+8*y])
+        if sys.byteorder!='little':
+            out.byteswap()
+        return out
+
+    def times(self):
+        """Returns a copy of the timestamps as an array.
+        """
+        return self._range(self._offsets()[0],0,len(self))
+
+    def values(self):
+        """Returns a copy of the values as an array, parallel to times().
+        """
+        return self._range(self._offsets()[1],0,len(self))
+
+    def last(self):
+        """Returns the most recent sample as a (time,value) tuple, or
+        None if the column is empty.
+        """
+        n=len(self)
+        if not n:
+            return None
+        (toff,voff)=self._offsets()
+        slot=self._slot(n-1)
+        return (struct.unpack_from('<d',self._map,toff+8*slot)[0],
+                struct.unpack_from('<d',self._map,voff+8*slot)[0])
+
+    def _bisect(self,t):
+        lo=0
+        hi=len(self)
+        while lo<hi:
+            mid=(lo+hi)//2
+            if self._time(mid)<t:
+                lo=mid+1
+            else:
+                hi=mid
+        return lo
+
+    def bounds(self,start=None,end=None):
+        """Returns the range of indices (i,j) of samples taken in the time
+        range [start,end).
+        """
+        i=0
+        j=len(self)
+        if start is not None:
+            i=self._bisect(start)
+        if end is not None:
+            j=self._bisect(end)
+        return (i,max(i,j))
+
+    def slice(self,start=None,end=None):
+        """Returns the samples taken in the time range [start,end) as a
+        tuple of two arrays (times,values).
+        """
+        (i,j)=self.bounds(start,end)
+        (toff,voff)=self._offsets()
+        return (self._range(toff,i,j),self._range(voff,i,j))
+
+    def chunks(self,size=4096):
+        """Yields the samples in chunks of up to size samples, as tuples of
+        two arrays (times,values).
+        """
+        (toff,voff)=self._offsets()
+        n=len(self)
+        for i in xrange(0,n,size):
+            j=min(i+size,n)
+            yield (self._range(toff,i,j),self._range(voff,i,j))
+
+    def flush(self):
+        """Forces the mapped file to be written to disk.
+        """
+        self._map.flush()
+
+    def close(self):
+        """Unmaps the backing file.
+        """
+        self._map.close()
+
+
+#characters escaped in the names of history files and directories
+_UNSAFE=('%','/',':','\0')
+
+def quote_filename(name):
+    """Returns name escaped for use as a single path component: '%', '/',
+    ':' and NUL are percent-encoded.
+
+    InsaneError is raised for names that would still not name a file of
+    their own (empty, '.' or '..').
+    """
+    for c in _UNSAFE:
+        name=name.replace(c,'%%%02X' % ord(c))
+    if name in ('','.','..'):
+        raise InsaneError("bad file name: %r" % name)
+    return name
+
+def unquote_filename(name):
+    """Reverses quote_filename().
+    """
+    for c in reversed(_UNSAFE):
+        name=name.replace('%%%02X' % ord(c),c)
+    return name
+
+class MappedHistory(MetricHistory):
+    """Stores the numeric history of a single part in MappedColumns, so
+    that it survives restarts.
+
+    Each metric is kept in its own file, named after the metric, in a
+    directory named after the system and the part (for example
+    DIRECTORY/localhost/processor/cpu0/usage.hist). Every component is
+    escaped with quote_filename(), so that names such as socket paths or
+    relayed systems (DIRECTORY/%2Frun%2Fyasmond.sock/... or
+    DIRECTORY/relay%2Fhost%3A61875/...) stay below the directory. Existing
+    files are reopened immediately, so the history of previous runs is
+    available before the part first updates.
+    """
+    def __init__(self,part,directory,length=86400):
+        """Creates a self-managing MappedHistory for the given part,
+        storing the last length samples of each metric under directory.
+
+        If no part is given, the files are kept directly in directory.
+        """
+        if part is not None:
+            names=[part.system().name()]+part.key().split(' ')
+            directory=os.path.join(directory,
+                                   *[quote_filename(n) for n in names])
+        self._directory=directory
+        self._length=length
+        MetricHistory.__init__(self,part)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        #reopen what we had
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.hist'):
+                name=unquote_filename(filename[:-len('.hist')])
+                self._series[name]=self.new_series(name)
+
+    def directory(self):
+        """Returns the directory holding this history's files.
+        """
+        return self._directory
+
+    def new_series(self,name):
+        return MappedColumn(os.path.join(self._directory,
+                                         quote_filename(name)+'.hist'),
+                            self._length)
+
+    def flush(self):
+        """Forces all files to be written to disk.
+        """
+        for series in self._series.values():
+            series.flush()
+
+    def close(self):
+        """Unmaps all files.
+        """
+        for series in self._series.values():
+            series.close()
+
+
+_double=struct.Struct('<d')
+_uint64=struct.Struct('<Q')
+
+def _float_bits(value):
+    """Returns the IEEE 754 representation of a float as an integer.
+    """
+    return _uint64.unpack(_double.pack(value))[0]
+
+def _bits_float(bits):
+    """Returns the float represented by the given IEEE 754 bits.
+    """
+    return _double.unpack(_uint64.pack(bits))[0]
+
+class BitWriter():
+    """Writes a stream of bits, most significant bit first.
+    """
+    def __init__(self):
+        self._data=bytearray()
+        self._acc=0
+        self._n=0 #number of bits in the accumulator
+
+    def write(self,value,nbits):
+        """Writes the low nbits bits of value.
+        """
+        self._acc=(self._acc<<nbits)|(value&((1<<nbits)-1))
+        self._n+=nbits
+        while self._n>=8:
+            self._n-=8
+            self._data.append((self._acc>>self._n)&0xff)
+        self._acc&=(1<<self._n)-1
+
+    def bits(self):
+        """Returns the number of bits written.
+        """
+        return 8*len(self._data)+self._n
+
+    def getvalue(self):
+        """Returns the bits written so far as a string, padded with zero
+        bits to a whole number of bytes.
+        """
+        data=str(self._data)
+        if self._n:
+            data+=chr((self._acc<<(8-self._n))&0xff)
+        return data
+
+
+class BitReader():
+    """Reads a stream of bits written by a BitWriter.
+    """
+    def __init__(self,data):
+        self._bits=8*len(data)
+        self._value=int(binascii.hexlify(data) or '0',16)
+        self._pos=0
+
+    def read(self,nbits):
+        """Reads nbits bits as an unsigned integer.
+        """
+        self._pos+=nbits
+        return (self._value>>(self._bits-self._pos))&((1<<nbits)-1)
+
+
+def _signed(value,nbits):
+    """Interprets the low nbits bits of value as a two's complement
+    number.
+    """
+    if value>>(nbits-1):
+        return value-(1<<nbits)
+    return value
+
+#delta-of-delta timestamp encodings, as (prefix,prefix bits,value bits)
+_DOD_RANGES=((0x2,2,7),(0x6,3,9),(0xe,4,12))
+
+class CompressedBlock():
+    """A block of samples compressed in the style of Facebook's Gorilla.
+
+    Timestamps are stored to the millisecond as deltas of deltas, taking a
+    single bit for regularly spaced samples. Values are stored XORed with
+    their predecessor, taking a single bit for an unchanged value and only
+    the meaningful bits otherwise.
+    """
+    def __init__(self):
+        """Creates an empty, open block.
+        """
+        self._writer=BitWriter()
+        self._count=0
+        self._first=None
+        self._last=None
+        self._data=None
+
+    def __len__(self):
+        return self._count
+
+    def first(self):
+        """Returns the time of the first sample, or None.
+        """
+        return self._first
+
+    def last(self):
+        """Returns the last sample as a (time,value) tuple, or None.
+        """
+        if not self._count:
+            return None
+        return (self._t/1000.,_bits_float(self._bits))
+
+    def append(self,t,value):
+        """Appends a single sample, taken at time t, to an open block.
+        """
+        w=self._writer
+        t=int(round(t*1000))
+        bits=_float_bits(value)
+        if not self._count:
+            self._first=t/1000.
+            w.write(t,64)
+            w.write(bits,64)
+            self._delta=0
+            self._lead=self._trail=-1
+        else:
+            #timestamp
+            delta=t-self._t
+            dod=delta-self._delta
+            self._delta=delta
+            if dod==0:
+                w.write(0,1)
+            else:
+                for (prefix,pbits,vbits) in _DOD_RANGES:
+                    if -(1<<(vbits-1))<=dod<(1<<(vbits-1)):
+                        w.write(prefix,pbits)
+                        w.write(dod,vbits)
+                        break
+                else:
+                    w.write(0xf,4)
+                    w.write(dod,64)
+            #value
+            xor=bits^self._bits
+            if xor==0:
+                w.write(0,1)
+            else:
+                lead=min(64-xor.bit_length(),31)
+                trail=(xor&-xor).bit_length()-1
+                if self._lead>=0 and lead>=self._lead and trail>=self._trail:
+                    #fits in the previous window
+                    w.write(0x2,2)
+                    w.write(xor>>self._trail,64-self._lead-self._trail)
+                else:
+                    size=64-lead-trail
+                    w.write(0x3,2)
+                    w.write(lead,5)
+                    w.write(size-1,6)
+                    w.write(xor>>trail,size)
+                    self._lead=lead
+                    self._trail=trail
+        self._t=t
+        self._bits=bits
+        self._last=t/1000.
+        self._count+=1
+
+    def seal(self):
+        """Seals the block, after which no more samples may be appended.
+
+        Only the compressed data and a few counters are kept.
+        """
+        self._data=self._writer.getvalue()
+        self._writer=None
+
+    def sealed(self):
+        """Returns True if the block has been sealed.
+        """
+        return self._writer is None
+
+    def data(self):
+        """Returns the compressed data.
+        """
+        if self._data is not None:
+            return self._data
+        return self._writer.getvalue()
+
+    def nbytes(self):
+        """Returns the number of bytes of compressed data.
+        """
+        if self._data is not None:
+            return len(self._data)
+        return (self._writer.bits()+7)//8
+
+    def __iter__(self):
+        """Yields the samples of the block as (time,value) tuples,
+        decoding them as it goes.
+        """
+        if not self._count:
+            return
+        r=BitReader(self.data())
+        t=r.read(64)
+        bits=r.read(64)
+        yield (t/1000.,_bits_float(bits))
+        delta=0
+        lead=trail=0
+        for i in xrange(self._count-1):
+            #timestamp
+            if r.read(1):
+                if not r.read(1):
+                    dod=_signed(r.read(7),7)
+                elif not r.read(1):
+                    dod=_signed(r.read(9),9)
+                elif not r.read(1):
+                    dod=_signed(r.read(12),12)
+                else:
+                    dod=_signed(r.read(64),64)
+                delta+=dod
+            t+=delta
+            #value
+            if r.read(1):
+                if r.read(1):
+                    lead=r.read(5)
+                    size=r.read(6)+1
+                    trail=64-lead-size
+                bits^=r.read(64-lead-trail)<<trail
+            yield (t/1000.,_bits_float(bits))
+
+
+class CompressedSeries():
+    """Stores the history of a single numeric metric in CompressedBlocks.
+
+    Blocks are sealed once they hold block_size samples. Iterating over the
+    series, or slicing it, only decodes the blocks that are needed, one at
+    a time.
+    """
+    def __init__(self,block_size=256,maxlen=None):
+        """Creates an empty series.
+
+        If maxlen is given, whole blocks are discarded once (at least)
+        the last maxlen samples are kept without them.
+        """
+        self._block_size=block_size
+        self._maxblocks=None
+        if maxlen:
+            self._maxblocks=-(-maxlen//block_size)+1
+        self._blocks=[]
+        self._count=0
+
+    def __len__(self):
+        return self._count
+
+    def blocks(self):
+        """Returns the list of blocks, oldest first.
+        """
+        return self._blocks
+
+    def append(self,t,value):
+        """Appends a single sample, taken at time t.
+
+        Samples must be appended in chronological order.
+        """
+        blocks=self._blocks
+        if not blocks or len(blocks[-1])>=self._block_size:
+            if blocks:
+                blocks[-1].seal()
+            blocks.append(CompressedBlock())
+            if self._maxblocks and len(blocks)>self._maxblocks:
+                self._count-=len(blocks.pop(0))
+        blocks[-1].append(t,value)
+        self._count+=1
+
+    def last(self):
+        """Returns the most recent sample as a (time,value) tuple, or
+        None if the series is empty.
+        """
+        if not self._blocks:
+            return None
+        return self._blocks[-1].last()
+
+    def __iter__(self):
+        for block in self._blocks:
+            for sample in block:
+                yield sample
+
+    def iter(self,start=None,end=None):
+        """Yields the samples taken in the time range [start,end) as
+        (time,value) tuples, skipping blocks entirely outside of it.
+        """
+        for block in self._blocks:
+            if start is not None and block.last()[0]<start:
+                continue
+            if end is not None and block.first()>=end:
+                break
+            for (t,value) in block:
+                if start is not None and t<start:
+                    continue
+                if end is not None and t>=end:
+                    break
+                yield (t,value)
+
+    def slice(self,start=None,end=None):
+        """Returns the samples taken in the time range [start,end) as a
+        tuple of two arrays (times,values).
+        """
+        times=array.array('d')
+        values=array.array('d')
+        for (t,value) in self.iter(start,end):
+            times.append(t)
+            values.append(value)
+        return (times,values)
+
+    def chunks(self,size=4096):
+        """Yields the samples in chunks of up to size samples, as tuples of
+        two arrays (times,values), decoding one block at a time.
+        """
+        times=array.array('d')
+        values=array.array('d')
+        for (t,value) in self:
+            times.append(t)
+            values.append(value)
+            if len(times)>=size:
+                yield (times,values)
+                times=array.array('d')
+                values=array.array('d')
+        if times:
+            yield (times,values)
+
+    def nbytes(self):
+        """Returns the number of bytes of compressed data held.
+        """
+        return sum(block.nbytes() for block in self._blocks)
+
+
+class CompressedHistory(MetricHistory):
+    """Stores the numeric history of a single part in CompressedSeries.
+    """
+    def __init__(self,part=None,block_size=256,maxlen=None):
+        """Creates a self-managing CompressedHistory for the given part.
+        """
+        self._block_size=block_size
+        self._maxlen=maxlen
+        MetricHistory.__init__(self,part)
+
+    def new_series(self,name):
+        return CompressedSeries(self._block_size,self._maxlen)
+
+    def nbytes(self):
+        """Returns the number of bytes of compressed data held.
+        """
+        return sum(series.nbytes() for series in self._series.values())
+
+
+def system_histories(system):
+    """Returns a dictionary mapping the keys of all parts of the system
+    that have a history (see SystemPart.set_history()) to their histories.
+
+    The result may be passed to any of the export functions below; to
+    export a single part, pass {part.key(): history} instead.
+    """
+    histories={}
+    for part in system.parts():
+        if part.history() is not None:
+            histories[part.key()]=part.history()
+    return histories
+
+def iter_records(histories,size=4096):
+    """Yields the contents of a dictionary of histories (keyed by part) in
+    chunks of up to size samples, as tuples (part,metric,times,values).
+    """
+    for key in sorted(histories.keys()):
+        for (name,times,values) in histories[key].chunks(size):
+            yield (key,name,times,values)
+
+def iter_csv(histories,size=4096):
+    """Yields the contents of a dictionary of histories as CSV text, one
+    chunk of up to size rows at a time.
+
+    Each row has the columns part, metric, time and value, and the first
+    chunk starts with a header row. Rows are written by the csv module, so
+    names containing commas or quotes are quoted as needed.
+    """
+    buf=StringIO()
+    out=csv.writer(buf)
+    out.writerow(('part','metric','time','value'))
+    yield buf.getvalue()
+    for (key,name,times,values) in iter_records(histories,size):
+        buf.seek(0)
+        buf.truncate()
+        out.writerows([(key,name,repr(t),repr(value))
+                       for (t,value) in zip(times,values)])
+        yield buf.getvalue()
+
+def export_csv(histories,f,size=4096):
+    """Writes the contents of a dictionary of histories to the file f as
+    CSV (see iter_csv()).
+    """
+    for chunk in iter_csv(histories,size):
+        f.write(chunk)
+
+def import_csv(f,size=4096):
+    """Reads CSV written by export_csv() from the file f, yielding chunks
+    of up to size samples as tuples (part,metric,times,values).
+    """
+    rows=csv.reader(f)
+    rows.next() #header
+    current=None
+    times=array.array('d')
+    values=array.array('d')
+    for (key,name,t,value) in rows:
+        if (key,name)!=current or len(times)>=size:
+            if times:
+                yield current+(times,values)
+            current=(key,name)
+            times=array.array('d')
+            values=array.array('d')
+        times.append(float(t))
+        values.append(float(value))
+    if times:
+        yield current+(times,values)
+
+#binary export format: a file header, then a sequence of chunks, each a
+#chunk header followed by the part and metric names, count timestamps and
+#count values (all little-endian doubles)
+EXPORT_MAGIC='YSMX'
+EXPORT_VERSION=1
+EXPORT_HEADER=struct.Struct('<4sI')
+EXPORT_CHUNK=struct.Struct('<HHI')
+
+def iter_binary(histories,size=65536):
+    """Yields the contents of a dictionary of histories in YASMon's binary
+    columnar export format, one chunk of up to size samples at a time.
+    """
+    yield EXPORT_HEADER.pack(EXPORT_MAGIC,EXPORT_VERSION)
+    for (key,name,times,values) in iter_records(histories,size):
+        if sys.byteorder!='little':
+            times.byteswap()
+            values.byteswap()
+        yield "".join((EXPORT_CHUNK.pack(len(key),len(name),len(times)),
+                       key,name,times.tostring(),values.tostring()))
+
+def export_binary(histories,f,size=65536):
+    """Writes the contents of a dictionary of histories to the file f in
+    the binary columnar export format (see iter_binary()).
+    """
+    for chunk in iter_binary(histories,size):
+        f.write(chunk)
+
+def import_binary(f):
+    """Reads data written by export_binary() from the file f, yielding
+    chunks as tuples (part,metric,times,values).
+    """
+    header=f.read(EXPORT_HEADER.size)
+    (magic,version)=EXPORT_HEADER.unpack(header)
+    if magic!=EXPORT_MAGIC or version!=EXPORT_VERSION:
+        raise UserError("not a YASMon history export")
+    while True:
+        header=f.read(EXPORT_CHUNK.size)
+        if not header:
+            return
+        if len(header)<EXPORT_CHUNK.size:
+            raise UserError("truncated history export")
+        (klen,nlen,count)=EXPORT_CHUNK.unpack(header)
+        key=f.read(klen)
+        name=f.read(nlen)
+        data=f.read(16*count)
+        if len(key)<klen or len(name)<nlen or len(data)<16*count:
+            raise UserError("truncated history export")
+        times=array.array('d',data[:8*count])
+        values=array.array('d',data[8*count:])
+        if sys.byteorder!='little':
+            times.byteswap()
+            values.byteswap()
+        yield (key,name,times,values)
+
+def load(records,histories=None,factory=ColumnarHistory):
+    """Appends imported chunks, as yielded by import_csv() or
+    import_binary(), to a dictionary of histories keyed by part.
+
+    Histories for parts not in the dictionary are created by calling
+    factory() without arguments. The dictionary is returned.
+    """
+    if histories is None:
+        histories={}
+    for (key,name,times,values) in records:
+        history=histories.get(key)
+        if history is None:
+            history=histories[key]=factory()
+        for (t,value) in zip(times,values):
+            history.append(name,t,value)
+    return histories
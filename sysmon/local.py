@@ -20,7 +20,7 @@
 
 """
 
-import os,os.path
+import os,os.path,pwd
 import re
 import sys
 
@@ -289,6 +289,12 @@ class LocalDrive(Drive):
         pass
 
 
+#the units of processor time in /proc/PID/stat, per second
+CLOCK_TICKS=os.sysconf('SC_CLK_TCK')
+
+#the size of a page of memory, in bytes
+PAGE_SIZE=os.sysconf('SC_PAGE_SIZE')
+
 class LocalProcessList(ProcessList):
     """Represents a local list of processes.
 
@@ -298,12 +304,80 @@ class LocalProcessList(ProcessList):
     """
     def __init__(self):
         ProcessList.__init__(self)
+        self._processes=[]
+        self._counters={} #pid -> (start time,processor ticks,I/O bytes)
+        self._uptime=None #the uptime at the latest update
+        self._users={} #uid -> user name
 
     def update_hook(self):
         return "processlist.updated"
 
+    def processes(self):
+        return self._processes
+
+    def _user(self,uid):
+        """Returns the name of the user with the given uid.
+        """
+        try:
+            return self._users[uid]
+        except KeyError:
+            try:
+                name=pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name=str(uid)
+            self._users[uid]=name
+            return name
+
     def do_update(self):
-        pass
+        with open("/proc/uptime") as uptime:
+            now=float(uptime.read().split()[0])
+        elapsed=None
+        if self._uptime is not None and now>self._uptime:
+            elapsed=now-self._uptime
+        self._uptime=now
+        last=self._counters
+        counters={}
+        processes=[]
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            pid=int(entry)
+            try:
+                with open("/proc/%d/stat" % pid) as stat:
+                    line=stat.read()
+                uid=os.stat("/proc/%d" % pid).st_uid
+            except (IOError,OSError):
+                #gone already
+                continue
+            #the name is in parentheses, and may contain anything
+            (head,sep,tail)=line.rpartition(')')
+            name=head[head.find('(')+1:]
+            fields=tail.split()
+            #(utime, stime, starttime and rss: fields 14, 15, 22 and 24)
+            ticks=int(fields[11])+int(fields[12])
+            start=fields[19]
+            rss=int(fields[21])*PAGE_SIZE
+            io=None
+            try:
+                with open("/proc/%d/io" % pid) as f:
+                    for l in f:
+                        if l.startswith("read_bytes:") or \
+                                l.startswith("write_bytes:"):
+                            io=(io or 0)+int(l.split()[1])
+            except (IOError,OSError):
+                #not ours to look at
+                pass
+            cpu=0.0
+            rate=0.0
+            before=last.get(pid)
+            if elapsed and before is not None and before[0]==start:
+                cpu=100.0*(ticks-before[1])/CLOCK_TICKS/elapsed
+                if io is not None and before[2] is not None:
+                    rate=(io-before[2])/elapsed
+            counters[pid]=(start,ticks,io)
+            processes.append((pid,name,self._user(uid),cpu,rss,rate))
+        self._counters=counters
+        self._processes=processes
 
 class LocalProcess(Process):
     """Represents a single local process.
@@ -0,0 +1,222 @@
+#########################################################################
+# YASMon - Yet Another System Monitor                                   #
+# Copyright (C) 2010  Scott Lawrence                                    #
+#                                                                       #
+# This program is free software: you can redistribute it and/or modify  #
+# it under the terms of the GNU General Public License as published by  #
+# the Free Software Foundation, either version 3 of the License, or     #
+# (at your option) any later version.                                   #
+#                                                                       #
+# This program is distributed in the hope that it will be useful,       #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+# GNU General Public License for more details.                          #
+#                                                                       #
+# You should have received a copy of the GNU General Public License     #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>. #
+#########################################################################
+
+"""The latest samples, served over HTTP in the OpenMetrics text format,
+for Prometheus and the like to scrape.
+
+The whole HTTP response is rendered once per interval by an Exposition,
+from the samples in the server's cache, and every scrape is answered with
+it as it is: scraping never samples anything, however often it happens.
+Relayed systems are exposed too, with their name in the 'system' label.
+"""
+
+import math,re,time
+
+from error import *
+import codec,daemon
+
+#the content type of the OpenMetrics text format
+CONTENT_TYPE='application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+#the metric families exposed, in order, as (name,help) pairs; all are
+#gauges
+FAMILIES=[
+    ('yasmon_uptime_seconds',"Time since the system was booted."),
+    ('yasmon_processor_usage_mhz',"Processor time used, in MHz."),
+    ('yasmon_processor_frequency_mhz',"Current processor frequency."),
+    ('yasmon_memory_bytes',"Memory statistics, as in /proc/meminfo."),
+    ('yasmon_filesystem_size_bytes',"Size of the filesystem."),
+    ('yasmon_filesystem_available_bytes',"Space available on the filesystem."),
+    ]
+
+#the paths the metrics are served at
+PATHS=('/metrics','/')
+
+#the longest request accepted, in bytes
+MAX_REQUEST=8192
+
+def _escape(value):
+    """Escapes a label value.
+    """
+    return (str(value).replace('\\','\\\\').replace('"','\\"')
+            .replace('\n','\\n'))
+
+def metrics(key,data):
+    """Returns the metrics in a sample of the part with the given key, as
+    a list of (family,labels,value) triples, where labels is a list of
+    (name,value) pairs. Values, and the values of labels, are None where
+    the sample doesn't have them; render() leaves those out.
+    """
+    (system,sep,key)=key.rpartition('/')
+    labels=[]
+    if system:
+        labels.append(('system',system))
+    (kind,sep,name)=key.partition(' ')
+    found=[]
+    if kind=='uptime':
+        found.append(('yasmon_uptime_seconds',labels,data))
+    elif kind=='processor':
+        labels.append(('cpu',name))
+        found.append(('yasmon_processor_usage_mhz',labels,data.get('usage')))
+        found.append(('yasmon_processor_frequency_mhz',labels,
+                      data.get('cpu MHz')))
+    elif kind=='memory':
+        for field in codec.MEMORY_FIELDS:
+            found.append(('yasmon_memory_bytes',labels+[('field',field)],
+                          data.get(field)))
+    elif kind=='filesystem':
+        labels+=[('device',name),('mountpoint',data[2])]
+        found.append(('yasmon_filesystem_size_bytes',labels,data[0]))
+        found.append(('yasmon_filesystem_available_bytes',labels,data[1]))
+    return found
+
+def render(samples):
+    """Renders samples ((key,data,...) tuples, as served by yasmond) in the
+    OpenMetrics text format.
+    """
+    lines=dict([(family,[]) for (family,help) in FAMILIES])
+    for sample in samples:
+        (key,data)=sample[:2]
+        if data is None:
+            continue
+        for (family,labels,value) in metrics(key,data):
+            try:
+                value=float(value)
+            except (TypeError,ValueError):
+                #absent
+                continue
+            if math.isnan(value) or math.isinf(value):
+                #no value either
+                continue
+            labels=[(name,v) for (name,v) in labels if v is not None]
+            if labels:
+                labels="{%s}" % ",".join(['%s="%s"' % (name,_escape(v))
+                                          for (name,v) in labels])
+            else:
+                labels=""
+            lines[family].append("%s%s %r\n" % (family,labels,value))
+    out=[]
+    for (family,help) in FAMILIES:
+        if lines[family]:
+            out.append("# TYPE %s gauge\n" % family)
+            out.append("# HELP %s %s\n" % (family,help))
+            out.extend(lines[family])
+    out.append("# EOF\n")
+    return "".join(out)
+
+def response(status,content_type,body):
+    """Returns a whole HTTP response, closing the connection.
+    """
+    return ("HTTP/1.1 %s\r\n"
+            "Content-Type: %s\r\n"
+            "Content-Length: %d\r\n"
+            "Connection: close\r\n"
+            "\r\n%s" % (status,content_type,len(body),body))
+
+
+class Exposition():
+    """Renders the latest samples of all parts served from a cache every
+    interval seconds, ready to be served to scrapers.
+
+    It is run as a task of a sysmon.daemon.Server, and scrapers are served
+    by ScrapeConnections (see connection()).
+    """
+    def __init__(self,cache,interval=daemon.DEFAULT_INTERVAL):
+        """Creates an exposition of the parts served from the given cache.
+        """
+        self._cache=cache
+        self._interval=interval
+        self._response=None
+        self._due=time.time()
+        self.scrapes=0 #scrapes answered
+
+    def next_due(self):
+        return self._due
+
+    def run(self):
+        """Renders the latest samples again, if it is time to.
+        """
+        now=time.time()
+        if now<self._due:
+            return
+        self._due+=self._interval
+        if self._due<now:
+            #we fell behind; don't try to catch up
+            self._due=now+self._interval
+        cache=self._cache
+        samples=[]
+        for key in sorted(cache.keys()):
+            entry=cache.get(key)
+            if entry is not None:
+                samples.append((key,)+entry)
+        self._response=response("200 OK",CONTENT_TYPE,render(samples))
+
+    def response(self):
+        """Returns the latest rendered HTTP response.
+        """
+        if self._response is None:
+            self.run()
+        if self._response is None:
+            #the first rendering failed
+            return response("503 Service Unavailable","text/plain",
+                            "no metrics yet\n")
+        return self._response
+
+    def connection(self,server,sock,addr):
+        """Returns a ScrapeConnection serving this exposition to a client
+        just accepted by the server (see Server.listen_tcp()).
+        """
+        return ScrapeConnection(server,sock,addr,self)
+
+
+class ScrapeConnection(daemon.Connection):
+    """A scraper connected to the server: it is answered with the latest
+    rendered response of an Exposition, and disconnected.
+    """
+    quiet=True
+
+    def __init__(self,server,sock,addr,exposition):
+        daemon.Connection.__init__(self,server,sock,addr)
+        self._exposition=exposition
+
+    def receive(self):
+        """Reads the HTTP request, and answers it once it is whole.
+
+        EOFError is raised when the client leaves.
+        """
+        data=self.sock.recv(daemon.READ_SIZE)
+        if not data:
+            raise EOFError("connection closed")
+        self._input+=data
+        if '\r\n\r\n' not in self._input and '\n\n' not in self._input:
+            if len(self._input)>MAX_REQUEST:
+                raise InsaneError("request too long")
+            return []
+        words=self._input.split('\n',1)[0].split()
+        self._input=''
+        if len(words)<2 or words[0]!='GET':
+            self.write(response("405 Method Not Allowed","text/plain",
+                                "only GET is supported\n"))
+        elif words[1].split('?',1)[0] not in PATHS:
+            self.write(response("404 Not Found","text/plain",
+                                "metrics are at /metrics\n"))
+        else:
+            self.write(self._exposition.response())
+            self._exposition.scrapes+=1
+        self.close_when_sent()
+        return []
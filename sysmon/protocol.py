@@ -0,0 +1,431 @@
+#########################################################################
+# YASMon - Yet Another System Monitor                                   #
+# Copyright (C) 2010  Scott Lawrence                                    #
+#                                                                       #
+# This program is free software: you can redistribute it and/or modify  #
+# it under the terms of the GNU General Public License as published by  #
+# the Free Software Foundation, either version 3 of the License, or     #
+# (at your option) any later version.                                   #
+#                                                                       #
+# This program is distributed in the hope that it will be useful,       #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+# GNU General Public License for more details.                          #
+#                                                                       #
+# You should have received a copy of the GNU General Public License     #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>. #
+#########################################################################
+
+"""The wire protocol spoken between yasmon and yasmond.
+
+Every connection starts out in the line protocol: each request is a
+single line, and each reply is any number of lines followed by a line
+containing only '*DONE'.
+
+A client may then send the request 'protocol N'. If the server speaks
+version N of the framed protocol, it replies 'protocol N', and from then
+on every message on the connection is a frame: a 4-byte big-endian
+payload length, a byte giving the kind of frame, a 4-byte request ID, and
+the payload. Servers that do not speak version N (including those that
+predate the framed protocol) reply with nothing but '*DONE', and the
+client keeps using the line protocol.
+
+In the framed protocol, every request frame is answered by exactly one
+reply frame carrying the same request ID. A client may send any number of
+requests without waiting for their replies, and match the replies up by
+ID when they arrive. After a client subscribes to some parts (with
+'subscribe KEY=INTERVAL,...'), the server also sends push frames, each
+holding samples like the reply to 'snapshot', whenever a subscribed part
+is due. Push frames have the request ID 0.
+
+In the framed protocol, samples (the replies to part queries and
+snapshots, and push frames) are not pickled: they are encoded as
+described in sysmon.codec, and their frames have the FRAME_SAMPLES bit
+set in their kind. The reply to 'meta' is encoded with
+sysmon.codec.encode_meta(). Pickles are only used in the line protocol.
+
+The server samples every part on its own schedule and answers from the
+latest sample. A query for samples (a part key or a snapshot) may end
+with ' max-age=SECONDS' to have any part whose latest sample is older
+than that sampled again first.
+
+The server also keeps the latest samples of every part for a while. The
+request 'history since=TIME KEY=SEQ,...' (see history(); each part of it
+is optional) asks for those
+taken at or after TIME and numbered above SEQ, oldest first, and is
+answered like a snapshot. A reply holds at most HISTORY_PAGE samples; if
+it is full, the client asks again for those after the last ones it got.
+
+The request 'top N by=FIELD user=USER name=PATTERN' (see top()) asks for
+the N processes using the most processor time, memory or I/O, of those
+of USER whose name matches PATTERN. The server scans the processes at
+most once per sampling interval, however often it is asked, and the reply
+holds N processes at most, however many are running; in the framed
+protocol, it is encoded with sysmon.codec.encode_processes().
+
+Before switching to the framed protocol, a client may ask for compression
+with the request 'compress zlib THRESHOLD'. A server that supports it
+echoes the request back, and then compresses the payload of every frame
+it sends that is at least THRESHOLD bytes long, setting the
+FRAME_COMPRESSED bit in its kind. All compressed payloads on a connection
+form a single zlib stream, each payload ending with a sync flush, so they
+must be decompressed in order.
+
+A relay (see sysmon.daemon.Relay) also serves the systems of other
+servers: part KEY of system NAME is served as 'NAME/KEY', the metadata of
+NAME as 'NAME/meta', and the overview lists every relayed part. Before
+switching to the framed protocol, a client may send 'relay NAME' to watch
+NAME alone: a relay that serves NAME echoes the request back, and from
+then on the connection behaves as if it were to NAME itself.
+"""
+
+import re,struct,time,zlib
+
+from error import *
+
+#the default port (from the sha1sum of YASMon with no newline)
+DEFAULT_PORT=61874
+
+#the version of the framed protocol spoken by this module
+PROTOCOL_VERSION=8
+
+FRAME_HEADER=struct.Struct('!IBI')
+
+#kinds of frames
+FRAME_REQUEST=0
+FRAME_REPLY=1
+FRAME_PUSH=2
+
+#set in the kind of frames whose payload is encoded samples
+FRAME_SAMPLES=0x80
+
+#set in the kind of frames whose payload is compressed
+FRAME_COMPRESSED=0x40
+
+#frames with smaller payloads are not compressed by default
+COMPRESS_THRESHOLD=128
+
+#the option of sample queries giving the greatest acceptable age
+MAX_AGE=' max-age='
+
+#the largest frame accepted, in bytes
+MAX_FRAME=1<<26
+
+#the most samples in the reply to a history request
+HISTORY_PAGE=4096
+
+def negotiation():
+    """Returns the request used to switch to the framed protocol.
+    """
+    return "protocol %d" % PROTOCOL_VERSION
+
+def compression(threshold=COMPRESS_THRESHOLD):
+    """Returns the request used to turn on compression.
+    """
+    return "compress zlib %d" % threshold
+
+def parse_compression(request):
+    """Returns the threshold given in a request made by compression(), or
+    None if the request is not one.
+    """
+    match=re.match("^compress zlib ([0-9]+)$",request)
+    if match:
+        return int(match.group(1))
+    return None
+
+def relay(name):
+    """Returns the request used to watch a single system served by a
+    relay.
+    """
+    return "relay %s" % name
+
+def parse_relay(request):
+    """Returns the name of the system given in a request made by relay(),
+    or None if the request is not one.
+    """
+    if request.startswith("relay "):
+        return request[6:]
+    return None
+
+def history(keys,since=None,seqs={}):
+    """Returns the request for the kept samples of the parts with the
+    given keys (or of all parts, if there are none) taken at or after the
+    time since, and numbered above the number seqs gives for the part, if
+    any.
+    """
+    request=["history"]
+    if since is not None:
+        request.append("since=%r" % float(since))
+    items=[]
+    for key in keys:
+        if seqs.get(key) is not None:
+            items.append("%s=%d" % (key,seqs[key]))
+        else:
+            items.append(key)
+    if items:
+        request.append(",".join(items))
+    return " ".join(request)
+
+def parse_history(request):
+    """Parses a request made by history(), and returns a tuple
+    (keys,since,seqs), or None if the request is not one.
+
+    UserError is raised if the request is malformed.
+    """
+    if request!="history" and not request.startswith("history "):
+        return None
+    rest=request[8:]
+    since=None
+    if rest.startswith("since="):
+        (since,sep,rest)=rest.partition(" ")
+        try:
+            since=float(since[6:])
+        except ValueError:
+            raise UserError("bad history: %s" % since)
+    keys=[]
+    seqs={}
+    for item in rest.split(','):
+        if not item:
+            continue
+        (key,sep,seq)=item.rpartition('=')
+        if not sep:
+            keys.append(item)
+            continue
+        try:
+            seqs[key]=int(seq)
+        except ValueError:
+            raise UserError("bad history: %s" % item)
+        keys.append(key)
+    return (keys,since,seqs)
+
+def top(n,by='cpu',user=None,name=None):
+    """Returns the request for the n processes using the most of by,
+    as in sysmon.system.top_processes().
+    """
+    request=["top %d by=%s" % (n,by)]
+    if user is not None:
+        request.append("user=%s" % user)
+    if name is not None:
+        request.append("name=%s" % name)
+    return " ".join(request)
+
+def parse_top(request):
+    """Parses a request made by top(), and returns a tuple
+    (n,by,user,name), or None if the request is not one.
+
+    UserError is raised if the request is malformed.
+    """
+    words=request.split(' ')
+    if words[0]!="top":
+        return None
+    try:
+        n=int(words[1])
+    except (IndexError,ValueError):
+        raise UserError("bad top: %s" % request)
+    options={'by': 'cpu', 'user': None, 'name': None}
+    for word in words[2:]:
+        (option,sep,value)=word.partition('=')
+        if option not in options or not sep:
+            raise UserError("bad top: %s" % word)
+        options[option]=value
+    return (n,options['by'],options['user'],options['name'])
+
+def split_max_age(query):
+    """Splits the max-age option off a query for samples, and returns a
+    tuple (query,max_age), where max_age is None if none was given.
+    """
+    (query,sep,age)=query.partition(MAX_AGE)
+    if not sep:
+        return (query,None)
+    try:
+        return (query,float(age))
+    except ValueError:
+        raise UserError("bad max-age: %s" % age)
+
+def pack_frame(payload,kind=FRAME_REQUEST,tag=0):
+    """Returns the frame of the given kind and request ID (tag) carrying
+    the given payload.
+    """
+    return FRAME_HEADER.pack(len(payload),kind,tag)+payload
+
+def parse_intervals(spec):
+    """Parses the argument of a subscribe request ('KEY=INTERVAL,...')
+    into a dictionary mapping part keys to intervals in seconds.
+    """
+    intervals={}
+    for item in spec.split(','):
+        if not item:
+            continue
+        (key,sep,interval)=item.rpartition('=')
+        try:
+            intervals[key]=float(interval)
+        except ValueError:
+            raise UserError("bad subscription: %s" % item)
+    return intervals
+
+def format_intervals(intervals):
+    """Formats a dictionary mapping part keys to intervals as the argument
+    of a subscribe request.
+    """
+    return ",".join(["%s=%r" % (key,float(interval))
+                     for (key,interval) in intervals.items()])
+
+
+class FrameReader():
+    """Reads frames from a socket into a reused buffer.
+
+    As much data as the socket has available is received with a single
+    recv_into() call, so a whole frame (header and payload) is usually
+    read with one system call, and never more than two unless it is larger
+    than the buffer.
+    """
+    def __init__(self,sock,size=65536):
+        """Creates a reader for frames arriving on sock.
+        """
+        self._sock=sock
+        self._buf=bytearray(size)
+        self._start=0 #start of unread data
+        self._end=0 #end of unread data
+
+    def available(self):
+        """Returns the number of bytes received but not yet read.
+        """
+        return self._end-self._start
+
+    def _reserve(self,size):
+        """Makes room for at least size bytes of unread data.
+        """
+        if self._start+size<=len(self._buf):
+            return
+        #move unread data to the front of the buffer
+        n=self._end-self._start
+        if self._start:
+            self._buf[:n]=self._buf[self._start:self._end]
+            self._start=0
+            self._end=n
+        if size>len(self._buf):
+            self._buf.extend(bytearray(size-len(self._buf)))
+
+    def feed(self,data):
+        """Adds data that was received by other means (before switching to
+        the framed protocol, say) to the unread data.
+        """
+        self._reserve(self._end-self._start+len(data))
+        self._buf[self._end:self._end+len(data)]=data
+        self._end+=len(data)
+
+    def fill(self,want=1,flags=0):
+        """Receives whatever data is available on the socket, making room
+        for at least want more bytes. flags are passed on to recv_into().
+
+        Returns the number of bytes received, which is 0 if the connection
+        has been closed.
+        """
+        self._reserve(self._end-self._start+want)
+        n=self._sock.recv_into(memoryview(self._buf)[self._end:],0,flags)
+        self._end+=n
+        return n
+
+    def next_frame(self):
+        """Returns the next frame as a tuple (kind,tag,payload) if it has
+        been received completely, or None otherwise.
+        """
+        n=self._end-self._start
+        if n<FRAME_HEADER.size:
+            return None
+        (length,kind,tag)=FRAME_HEADER.unpack_from(self._buf,self._start)
+        if length>MAX_FRAME:
+            raise InsaneError("frame of %d bytes is too large" % length)
+        if n<FRAME_HEADER.size+length:
+            return None
+        start=self._start+FRAME_HEADER.size
+        self._start=start+length
+        if self._start==self._end:
+            self._start=self._end=0
+        return (kind,tag,str(self._buf[start:start+length]))
+
+    def wanted(self):
+        """Returns the number of bytes still missing from the frame being
+        received (at least 1).
+        """
+        n=self._end-self._start
+        if n<FRAME_HEADER.size:
+            return FRAME_HEADER.size-n
+        (length,kind,tag)=FRAME_HEADER.unpack_from(self._buf,self._start)
+        return max(1,FRAME_HEADER.size+length-n)
+
+    def read_frame(self):
+        """Blocks until a whole frame has been received, and returns it as
+        a tuple (kind,tag,payload).
+
+        EOFError is raised if the connection is closed first.
+        """
+        frame=self.next_frame()
+        while frame is None:
+            if not self.fill(self.wanted()):
+                raise EOFError("connection closed")
+            frame=self.next_frame()
+        return frame
+
+
+class Compressor():
+    """Builds the frames sent on a connection that uses compression, and
+    keeps statistics about them.
+
+    Frames must be sent in the order they were built.
+    """
+    def __init__(self,threshold=COMPRESS_THRESHOLD,level=6):
+        """Creates a compressor for payloads of at least threshold bytes,
+        at the given zlib level.
+        """
+        self._zlib=zlib.compressobj(level)
+        self._threshold=threshold
+        self.raw=0 #bytes of frames before compression
+        self.wire=0 #bytes of frames as sent
+        self.time=0.0 #seconds spent compressing
+
+    def pack_frame(self,payload,kind=FRAME_REQUEST,tag=0):
+        """Returns the frame of the given kind and request ID (tag)
+        carrying the given payload, compressed if it is large enough.
+        """
+        self.raw+=FRAME_HEADER.size+len(payload)
+        if len(payload)>=self._threshold:
+            start=time.time()
+            payload=(self._zlib.compress(payload)+
+                     self._zlib.flush(zlib.Z_SYNC_FLUSH))
+            self.time+=time.time()-start
+            kind|=FRAME_COMPRESSED
+        frame=pack_frame(payload,kind,tag)
+        self.wire+=len(frame)
+        return frame
+
+
+class Decompressor():
+    """Decompresses the payloads of the frames received on a connection,
+    and keeps statistics about them.
+    """
+    def __init__(self):
+        self._zlib=zlib.decompressobj()
+        self.raw=0 #bytes of frames after decompression
+        self.wire=0 #bytes of frames as received
+        self.time=0.0 #seconds spent decompressing
+
+    def unpack(self,kind,payload):
+        """Returns the kind (without FRAME_COMPRESSED) and payload of a
+        received frame, decompressing the payload if needed.
+
+        Frames must be unpacked in the order they were received.
+        """
+        self.wire+=FRAME_HEADER.size+len(payload)
+        if kind&FRAME_COMPRESSED:
+            start=time.time()
+            try:
+                payload=self._zlib.decompress(payload,MAX_FRAME)
+            except zlib.error as err:
+                raise InsaneError("bad compressed frame: %s" % err)
+            if self._zlib.unconsumed_tail:
+                raise InsaneError("compressed frame is too large")
+            self.time+=time.time()-start
+            kind&=~FRAME_COMPRESSED
+        self.raw+=FRAME_HEADER.size+len(payload)
+        return (kind,payload)
@@ -20,58 +20,584 @@
 
 """
 
-import cPickle,re,socket,thread
+import errno,itertools,random,re,socket,struct,thread,threading,time
 from system import *
+import callback,codec,events,protocol
 
-def get_remote(addr,port=61874):
+def get_remote(addr,port=protocol.DEFAULT_PORT,timeout=10.0,compress=False,
+               loop=None,relayed=None):
     """Returns an object representing a remote system.
+
+    Connecting, and every query, time out after timeout seconds. If
+    compress is True, compression is used if the remote machine supports
+    it. The system is driven by the given EventLoop, or by the default one
+    (see sysmon.events). If relayed is given, the remote machine is a
+    relay, and the system it relays under that name is returned.
     """
-    contact=RemoteContact(addr,port)
+    contact=RemoteContact(addr,port,timeout,compress,loop,relayed=relayed)
     system=RemoteSystem(contact)
     return system
 
+def get_remotes(hosts,timeout=10.0,compress=False,loop=None):
+    """Returns a list of objects representing remote systems, connecting
+    to them concurrently.
+
+    hosts is a list of (addr,port) pairs, or (addr,port,relayed) triples
+    for systems served by relays, and the systems are returned in the same
+    order. The connections are made by the connector threads of the
+    EventLoop driving the systems (see get_remote() and
+    EventLoop.defer_connect()), as many hosts at once as it has of them,
+    and every attempt is subject to the timeout, as with get_remote().
+    This function returns once every host has been tried, or after
+    timeout seconds at the most: hosts that could not be reached by then
+    are returned anyway, in STATE_DOWN, and come up in the background
+    (emitting 'connection.up', after their parts are added) once they
+    answer. To reach more hosts at once, drive them by an EventLoop with
+    more connectors.
+    """
+    systems=[RemoteSystem(RemoteContact(host[0],host[1],timeout,compress,
+                                        loop,False,*host[2:]))
+             for host in hosts]
+    waiting=set(systems)
+    tried=threading.Condition()
+    def connect(system):
+        #reconnects later by itself on failure
+        system.contact()._reconnect()
+        with tried:
+            waiting.discard(system)
+            tried.notify()
+    for system in systems:
+        system.contact().loop().defer_connect(connect,system)
+    deadline=time.time()+timeout
+    with tried:
+        while waiting and time.time()<deadline:
+            tried.wait(deadline-time.time())
+    return systems
+
+#states of a RemoteContact's connection
+STATE_UP='up'
+STATE_DOWN='down'
+
+#limits of the delay between reconnection attempts, in seconds
+MIN_BACKOFF=0.5
+MAX_BACKOFF=60.0
+
+#a machine announcing its samples is down after missing this many
+#announcements
+MISSED_ANNOUNCEMENTS=3
+
+#samples were missed when the remote machine's clock moved on by more than
+#this many times a part's delay between two samples of the part
+GAP_FACTOR=2
+
+class PendingQuery():
+    """The reply to a query that has been sent but perhaps not yet
+    answered.
+    """
+    def __init__(self,callback=None):
+        """Creates an unanswered query.
+
+        If a callback is given, it is called with the reply as soon as it
+        arrives.
+        """
+        self._event=threading.Event()
+        self._reply=None
+        self._error=None
+        self._callback=callback
+        self.sent=time.time()
+
+    def done(self):
+        """Returns True if the query has been answered (or has failed).
+        """
+        return self._event.is_set()
+
+    def set_reply(self,reply):
+        """Answers the query.
+        """
+        self._reply=reply
+        self._event.set()
+        if self._callback is not None:
+            self._callback(reply)
+
+    def set_error(self,error):
+        """Fails the query with the given error.
+        """
+        self._error=error
+        self._event.set()
+
+    def wait(self,timeout=None):
+        """Blocks until the query has been answered, and returns the
+        reply.
+
+        If the query failed, the error is raised instead. If a timeout (in
+        seconds) is given and no reply arrives in time, None is returned.
+        """
+        if not self._event.wait(timeout):
+            return None
+        if self._error is not None:
+            raise self._error
+        return self._reply
+
+
 class RemoteContact():
     """Communicates with a remote machine.
 
     Objects of this class may be used for communication with the
     remote machine. The necessary locking is handled automatically, so
     this class is thread-safe.
+
+    When the remote machine speaks the framed protocol, any number of
+    queries may be in flight at once on the single connection: an event
+    loop receives all frames and matches replies to queries by request ID.
+    The loop is shared by all contacts (and reconnections are made by its
+    connector threads), so watching more machines takes no more threads.
+
+    Connecting and every query are subject to a timeout. If the
+    connection is lost or the remote machine stops answering, all waiting
+    queries fail with a RemoteError, the state changes to STATE_DOWN, and
+    the contact reconnects in the background, waiting longer (with some
+    random jitter) after each failed attempt. Queries made while the
+    contact is down fail immediately. Every change of state calls the
+    'connection.changed' hook of callback() with the contact.
+
+    If compression is asked for, it is negotiated on each connection; see
+    sysmon.protocol. stats() tells how well it works.
+
+    If the remote machine is a relay, the contact may be to one of the
+    systems it relays instead of to the relay itself.
     """
-    def __init__(self,addr,port):
-        """Connects to the remote machine.
+    def __init__(self,addr,port,timeout=10.0,compress=False,loop=None,
+                 connect=True,relayed=None):
+        """Connects to the remote machine, or, if addr is the path of a
+        Unix socket (starting with '/'), to the server listening on it.
+
+        The framed protocol is used if the remote machine speaks it (see
+        sysmon.protocol); otherwise, the line protocol is used. If the
+        first connection fails, RemoteError is raised. If connect is
+        False, the contact is created in STATE_DOWN instead, and connect()
+        (or connect_later()) must be called. If relayed is given, the
+        contact is to the system of that name served by the relay.
+
+        The contact is driven by the given EventLoop, or by the default one.
         """
-        #connect
-        sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((addr,port))
-        self._socket=sock
-        self._lock=thread.allocate_lock()
         self._addr=addr
         self._port=port
+        self._timeout=timeout
+        self._compress=compress
+        self._relayed=relayed
+        self._loop=loop or events.default_loop()
+        self._callback=callback.SysmonCallback()
+        self._lock=thread.allocate_lock()
+        self._sendlock=thread.allocate_lock()
+        self._socket=None
+        self._file=None
+        self._reader=None
+        self._decompressor=None
+        self._compressed=False
+        self._sent=0
+        self._heard=0
+        self._pending={} #request ID -> PendingQuery
+        self._tags=itertools.count(1)
+        self._push=None
+        self._intervals=None
+        self._state=STATE_DOWN
+        self._failures=0
+        self._retry=None
+        self._closed=False
+        if connect:
+            self.connect()
+
+    def connect(self):
+        """Connects to the remote machine, negotiating the protocol and
+        renewing any subscription.
+
+        This is done automatically, both when the contact is created and
+        after the connection is lost. RemoteError is raised on failure.
+        """
+        try:
+            if self._addr.startswith('/'):
+                #a Unix socket, on this machine
+                sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+                sock.settimeout(self._timeout)
+                try:
+                    sock.connect(self._addr)
+                except socket.error:
+                    sock.close()
+                    raise
+            else:
+                sock=socket.create_connection((self._addr,self._port),
+                                              self._timeout)
+                sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+        except socket.error as err:
+            raise RemoteError(self._addr,"could not connect (%s)" % err)
+        f=sock.makefile()
+        #try to turn on compression and switch to the framed protocol
+        compressed=False
+        try:
+            if self._relayed is not None:
+                request=protocol.relay(self._relayed)
+                relayed=(self._exchange(f,request)==request+"\n")
+            if self._compress:
+                reply=self._exchange(f,protocol.compression())
+                compressed=(reply==protocol.compression()+"\n")
+            reply=self._exchange(f,protocol.negotiation())
+        except (EOFError,socket.error) as err:
+            sock.close()
+            raise RemoteError(self._addr,"could not connect (%s)" % err)
+        if self._relayed is not None and not relayed:
+            sock.close()
+            raise RemoteError(self._addr,"%s is not relayed here" %
+                              self._relayed)
+        reader=None
+        if reply==protocol.negotiation()+"\n":
+            reader=protocol.FrameReader(sock)
+        decoder=codec.Decoder()
+        decompressor=protocol.Decompressor()
+        with self._sendlock:
+            self._socket=sock
+            self._file=f
+            self._reader=reader
+            self._decompressor=decompressor
+            self._compressed=compressed and reader is not None
+            self._sent=0
+        if reader is not None:
+            self._heard=time.time()
+            self._loop.add_reader(sock,lambda: self._readable(sock,reader,
+                                                              decoder,
+                                                              decompressor))
+            self._loop.call_later(self._timeout,self._check,sock)
+        #the subscription is renewed before anyone hears that we're up,
+        #so that whatever they ask for first is not missing from it
+        if self._push is not None and reader is not None:
+            try:
+                self._wait(self._send("subscribe %s" %
+                                      protocol.format_intervals(
+                                          self._intervals)))
+            except RemoteError:
+                #the connection was given up on, and will be retried
+                return
+        with self._sendlock:
+            if sock is not self._socket:
+                return
+            self._failures=0
+            self._state=STATE_UP
+        self._callback.call("connection.changed",self)
+
+    def connect_later(self):
+        """Connects to the remote machine in the background, retrying like
+        after a lost connection if that fails.
+        """
+        self._loop.defer_connect(self._reconnect)
+
+    def close(self):
+        """Closes the connection for good.
+        """
+        self._closed=True
+        if self._retry is not None:
+            self._retry.cancel()
+        self._lost(self._socket,"connection closed")
+
+    def callback(self):
+        """Returns the callback class on which the 'connection.changed'
+        hook is called.
+        """
+        return self._callback
+
+    def state(self):
+        """Returns the state of the connection, STATE_UP or STATE_DOWN.
+        """
+        return self._state
+
+    def connected(self):
+        """Returns True if the connection is up.
+        """
+        return self._state==STATE_UP
+
+    def _set_state(self,state):
+        if state!=self._state:
+            self._state=state
+            self._callback.call("connection.changed",self)
+
+    def _lost(self,sock,msg):
+        """Gives up on the given connection (if it is still the current
+        one): fails all waiting queries and schedules a reconnection.
+        """
+        with self._sendlock:
+            if sock is None or sock is not self._socket:
+                return
+            self._socket=None
+            self._file=None
+            self._reader=None
+            pending=self._pending.values()
+            self._pending={}
+        self._loop.remove_reader(sock)
+        try:
+            sock.close()
+        except socket.error:
+            pass
+        for p in pending:
+            p.set_error(RemoteError(self._addr,msg))
+        self._set_state(STATE_DOWN)
+        self._schedule()
+
+    def _schedule(self):
+        """Schedules the next reconnection attempt, backing off
+        exponentially.
+        """
+        if self._closed:
+            return
+        delay=min(MAX_BACKOFF,MIN_BACKOFF*2**self._failures)
+        self._failures+=1
+        self._retry=self._loop.call_later(delay*random.uniform(0.5,1.0),
+                                          self._loop.defer_connect,
+                                          self._reconnect)
+
+    def _reconnect(self):
+        if self._closed:
+            return
+        try:
+            self.connect()
+        except RemoteError:
+            self._schedule()
+
+    def framed(self):
+        """Returns True if the framed protocol is in use.
+        """
+        return self._reader is not None
+
+    def compressed(self):
+        """Returns True if the remote machine compresses what it sends.
+        """
+        return self._compressed
+
+    def stats(self):
+        """Returns statistics about the current connection in the framed
+        protocol, as a dictionary: 'sent' (bytes sent), 'received' (bytes
+        received), 'uncompressed' (bytes received, after decompression)
+        and 'latency' (seconds spent decompressing).
+        """
+        d=self._decompressor
+        if d is None:
+            return {'sent': 0, 'received': 0, 'uncompressed': 0,
+                    'latency': 0.0}
+        return {'sent': self._sent,
+                'received': d.wire,
+                'uncompressed': d.raw,
+                'latency': d.time}
+
+    def send(self,query,callback=None):
+        """Sends a query to the remote machine without waiting for the
+        reply, and returns a PendingQuery that will receive it.
+
+        In the line protocol, queries cannot overlap, so this method only
+        returns once the reply has arrived.
+        """
+        if self._state!=STATE_UP:
+            raise RemoteError(self._addr,"not connected")
+        return self._send(query,callback)
+
+    def _send(self,query,callback=None):
+        """Sends a query on the current connection, whether or not it is
+        up yet; see send().
+        """
+        pending=PendingQuery(callback)
+        if self._reader is None:
+            pending.set_reply(self._line_query(query))
+            return pending
+        with self._sendlock:
+            sock=self._socket
+            if sock is None:
+                raise RemoteError(self._addr,"not connected")
+            tag=self._tags.next()&0xffffffff or self._tags.next()
+            self._pending[tag]=pending
+        frame=protocol.pack_frame(query,tag=tag)
+        try:
+            with self.lock():
+                sock.sendall(frame)
+                self._sent+=len(frame)
+        except socket.error:
+            self._lost(sock,"connection lost")
+        return pending
 
     def query(self,query):
         """Queries the remote machine.
 
+        In the framed protocol, the reply to a query for samples is the
+        decoded list of (key,data) pairs; all other replies are strings.
+
         This method automatically handles the necessary locking to be
         thread-safe. Do NOT acquire this object's lock before calling
         this method - the method will block and never return.
         """
+        return self._wait(self.send(query))
+
+    def query_all(self,queries):
+        """Queries the remote machine with several queries at once, and
+        returns the list of replies.
+
+        In the framed protocol, all queries are sent before any reply is
+        waited for, so this takes a single round trip.
+        """
+        return [self._wait(pending)
+                for pending in [self.send(query) for query in queries]]
+
+    def sample(self,key,max_age=None):
+        """Returns the current data of the part with the given key, as
+        served by yasmond, or None if there is no such part.
+
+        If a max_age is given, the remote machine samples the part again
+        if its latest sample is older than max_age seconds (when it
+        supports that).
+        """
+        if self.framed():
+            if max_age is not None:
+                key="%s%s%r" % (key,protocol.MAX_AGE,float(max_age))
+            for sample in self.query(key):
+                return sample[1]
+            return None
+        reply=self.query(key)
+        if not reply:
+            return None
+        return codec.parse_line(key,reply)
+
+    def _wait(self,pending):
+        """Waits for the reply to a query, giving up on the connection if
+        it does not arrive in time.
+        """
+        sock=self._socket
+        reply=pending.wait(self._timeout)
+        if reply is None and not pending.done():
+            self._lost(sock,"timed out")
+            reply=pending.wait()
+        return reply
+
+    def _line_query(self,query):
+        """Queries the remote machine using the line protocol.
+        """
         with self.lock():
-            #get the file
-            f=self.socket().makefile()
-            #send the query
-            f.write("%s\n" % query)
-            f.flush()
-            info=""
-            #read until final token
-            for line in f:
-                #get rid of excess newline
-                line=re.sub("\n","",line)
-                if line=='*DONE':
-                    #it's over
-                    break
-                #append the line
-                info+="%s\n" % line
-            return info
+            sock=self._socket
+            f=self._file
+            if f is None:
+                raise RemoteError(self._addr,"not connected")
+            try:
+                return self._exchange(f,query)
+            except EOFError:
+                msg="connection closed"
+            except socket.timeout:
+                msg="timed out"
+            except socket.error:
+                msg="connection lost"
+        self._lost(sock,msg)
+        raise RemoteError(self._addr,msg)
+
+    def _exchange(self,f,query):
+        """Sends a query over the file f and reads the reply, in the line
+        protocol.
+        """
+        #send the query
+        f.write("%s\n" % query)
+        f.flush()
+        lines=[]
+        #read until final token
+        for line in iter(f.readline,''):
+            if line=='*DONE\n':
+                #it's over
+                return "".join(lines)
+            #append the line
+            lines.append(line)
+        raise EOFError("connection closed")
+
+    def subscribe(self,intervals,handler):
+        """Asks the remote machine to push samples of the given parts.
+
+        intervals is a dictionary mapping part keys to the interval, in
+        seconds, at which each part should be pushed. From then on,
+        handler is called from the event loop with the samples in every
+        push frame, as a list of (key,data,time,mono,seq) tuples (see
+        sysmon.codec); it must not block. Subscribing again replaces the
+        previous subscription, and the subscription is renewed
+        automatically after a reconnection.
+
+        Subscriptions require the framed protocol.
+        """
+        if not self.framed():
+            raise RemoteError(self._addr,"remote machine cannot push")
+        self._push=handler
+        self._intervals=intervals
+        self.query("subscribe %s" % protocol.format_intervals(intervals))
+
+    def unsubscribe(self):
+        """Cancels the subscription made with subscribe().
+        """
+        if self._push is not None:
+            self._push=None
+            self.query("unsubscribe")
+
+    def _overdue(self,idle):
+        """Returns True if the remote machine has not been heard from for
+        longer than it should have been, given that nothing was received
+        for idle seconds.
+        """
+        now=time.time()
+        with self._sendlock:
+            for p in self._pending.values():
+                if now-p.sent>=self._timeout:
+                    return True
+        if self._push is not None and self._intervals:
+            return idle>=self._timeout+min(self._intervals.values())
+        return False
+
+    def _check(self,sock):
+        """Called by the event loop every timeout seconds while sock is
+        the current connection, to give up on it if the remote machine has
+        stopped answering.
+        """
+        if sock is not self._socket:
+            return
+        if self._overdue(time.time()-self._heard):
+            self._lost(sock,"timed out")
+        else:
+            self._loop.call_later(self._timeout,self._check,sock)
+
+    def _readable(self,sock,reader,decoder,decompressor):
+        """Called by the event loop when sock is readable: reads whatever
+        has arrived, handing replies to the queries waiting for them and
+        pushed samples to the subscriber.
+        """
+        try:
+            if not reader.fill(reader.wanted(),socket.MSG_DONTWAIT):
+                self._lost(sock,"connection closed")
+                return
+        except socket.error as err:
+            if err.args[0] not in (errno.EAGAIN,errno.EWOULDBLOCK,
+                                   errno.EINTR):
+                self._lost(sock,"connection lost")
+            return
+        self._heard=time.time()
+        try:
+            frame=reader.next_frame()
+            while frame is not None:
+                (kind,tag,payload)=frame
+                #decoded here, in the order the frames were sent
+                (kind,payload)=decompressor.unpack(kind,payload)
+                if kind&protocol.FRAME_SAMPLES:
+                    payload=decoder.decode(payload)
+                    kind&=~protocol.FRAME_SAMPLES
+                if kind==protocol.FRAME_REPLY:
+                    with self._sendlock:
+                        pending=self._pending.pop(tag,None)
+                    if pending is not None:
+                        pending.set_reply(payload)
+                elif kind==protocol.FRAME_PUSH and self._push is not None:
+                    self._push(payload)
+                frame=reader.next_frame()
+        except InsaneError:
+            self._lost(sock,"bad data")
+
+    def loop(self):
+        """Returns the EventLoop driving this contact.
+        """
+        return self._loop
 
     def socket(self):
         """Returns the backing socket.
@@ -101,12 +627,271 @@ class RemoteContact():
         """
         return self._addr
 
+    def name(self):
+        """Returns the name of the remote system: the name it is relayed
+        under, if it is, or else the remote address, followed by the port
+        if it is not the default one.
+        """
+        if self._relayed is not None:
+            return self._relayed
+        if self._addr.startswith('/') or self._port==protocol.DEFAULT_PORT:
+            return self._addr
+        return "%s:%d" % (self._addr,self._port)
+
     def port(self):
         """Returns the remote port in use.
         """
         return self._port
 
 
+class AnnouncedContact():
+    """Follows a machine announcing its samples over UDP (see
+    sysmon.daemon.Announcer), as heard by an AnnouncementListener.
+
+    It stands in for a RemoteContact in a RemoteSystem: queries are
+    answered from the latest announcement, without going over the network,
+    and the subscriber gets every announcement as it arrives, whatever the
+    intervals asked for. The contact comes up when the layout of the
+    announcements is first heard, and goes down when MISSED_ANNOUNCEMENTS
+    announcements in a row are missed.
+    """
+    def __init__(self,addr,port,loop):
+        """Creates a contact to the machine announcing from the given
+        address and port.
+        """
+        self._addr=addr
+        self._port=port
+        self._loop=loop
+        self._callback=callback.SysmonCallback()
+        self._decoder=codec.DatagramDecoder()
+        self._samples={} #key -> latest sample
+        self._state=STATE_DOWN
+        self._heard=0
+        self._received=0
+        self._push=None
+        self._intervals=None
+
+    def receive(self,datagram):
+        """Handles a datagram received from the machine.
+
+        InsaneError is raised if the datagram is malformed.
+        """
+        samples=self._decoder.decode(datagram)
+        self._heard=time.time()
+        self._received+=len(datagram)
+        for sample in samples:
+            self._samples[sample[0]]=sample
+        if self._decoder.interval is not None:
+            self._set_state(STATE_UP)
+        if samples and self._push is not None:
+            self._push(samples)
+
+    def check(self,now):
+        """Marks the contact down if nothing was heard for too long.
+        """
+        interval=self._decoder.interval
+        if self.connected() and \
+                now-self._heard>MISSED_ANNOUNCEMENTS*interval:
+            self._set_state(STATE_DOWN)
+
+    def callback(self):
+        """Returns the callback class on which the 'connection.changed'
+        hook is called.
+        """
+        return self._callback
+
+    def state(self):
+        """Returns the state of the contact, STATE_UP or STATE_DOWN.
+        """
+        return self._state
+
+    def connected(self):
+        """Returns True if the machine is being heard.
+        """
+        return self._state==STATE_UP
+
+    def _set_state(self,state):
+        if state!=self._state:
+            self._state=state
+            self._callback.call("connection.changed",self)
+
+    def framed(self):
+        """Returns True: samples are pushed, as in the framed protocol.
+        """
+        return True
+
+    def compressed(self):
+        return False
+
+    def stats(self):
+        """Returns statistics about the announcements, as a dictionary:
+        'received' (bytes received), 'datagrams' (datagrams received),
+        'lost' (datagrams missed) and, as for a RemoteContact, 'sent',
+        'uncompressed' and 'latency'.
+        """
+        return {'sent': 0,
+                'received': self._received,
+                'uncompressed': self._received,
+                'latency': 0.0,
+                'datagrams': self._decoder.received,
+                'lost': self._decoder.lost}
+
+    def query(self,query):
+        """Answers a query from the latest announcement.
+        """
+        (query,max_age)=protocol.split_max_age(query)
+        if query=='meta':
+            return codec.encode_meta(self._decoder.meta)
+        if query=='overview':
+            return "".join(["%s\n" % key for key in self._decoder.keys
+                            if key not in ('uptime','memory')])
+        if query=='snapshot' or query.startswith('snapshot '):
+            keys=query[len('snapshot '):].split(',')
+            if keys==['']:
+                keys=self._decoder.keys
+            return [self._samples[key] for key in keys
+                    if key in self._samples]
+        if query in self._samples:
+            return [self._samples[query]]
+        return ""
+
+    def query_all(self,queries):
+        """Answers several queries from the latest announcement.
+        """
+        return [self.query(query) for query in queries]
+
+    def sample(self,key,max_age=None):
+        """Returns the latest announced data of the part with the given
+        key, or None. max_age is ignored.
+        """
+        sample=self._samples.get(key)
+        if sample is None:
+            return None
+        return sample[1]
+
+    def subscribe(self,intervals,handler):
+        """Has handler called with the samples of every announcement, as
+        a list of (key,data,time,mono,seq) tuples.
+        """
+        self._push=handler
+        self._intervals=intervals
+
+    def unsubscribe(self):
+        """Cancels the subscription made with subscribe().
+        """
+        self._push=None
+
+    def loop(self):
+        """Returns the EventLoop on which announcements are received.
+        """
+        return self._loop
+
+    def addr(self):
+        """Returns the address of the machine.
+        """
+        return self._addr
+
+    def port(self):
+        """Returns the port the machine announces from.
+        """
+        return self._port
+
+    def name(self):
+        """Returns the name of the machine: its address and the port it
+        announces from.
+        """
+        return "%s:%d" % (self._addr,self._port)
+
+
+class AnnouncementListener():
+    """Listens for machines announcing their samples over UDP (see
+    sysmon.daemon.Announcer), and follows each of them as a RemoteSystem
+    backed by an AnnouncedContact.
+
+    Machines are told apart by the address and port they announce from, so
+    that several servers on one machine are followed separately (a server
+    restarted announces from a new port, and is heard as a new machine
+    while the old one falls silent). The 'system.announced' hook of
+    callback() is called with the system of every machine heard for the
+    first time; its 'connection.up' and 'connection.down' hooks are called
+    as it is heard again or falls silent.
+    """
+    def __init__(self,port=protocol.DEFAULT_PORT,group=None,addr='',
+                 loop=None):
+        """Listens on the given port (on all interfaces, unless an
+        address is given), joining the given multicast group, if any.
+
+        Datagrams are received on the given EventLoop, or on the default
+        one.
+        """
+        self._loop=loop or events.default_loop()
+        self._callback=callback.SysmonCallback()
+        self._contacts={} #(address,port) -> AnnouncedContact
+        self._systems={} #(address,port) -> RemoteSystem
+        self.bad=0 #malformed datagrams received
+        sock=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        sock.bind((addr,port))
+        if group is not None:
+            sock.setsockopt(socket.IPPROTO_IP,socket.IP_ADD_MEMBERSHIP,
+                            struct.pack('4s4s',socket.inet_aton(group),
+                                        socket.inet_aton(addr or
+                                                         '0.0.0.0')))
+        sock.setblocking(0)
+        self._socket=sock
+        self._loop.add_reader(sock,self._readable)
+        self._timer=self._loop.call_later(1.0,self._check)
+
+    def _readable(self):
+        """Called by the event loop when datagrams have arrived.
+        """
+        while True:
+            try:
+                (datagram,sender)=self._socket.recvfrom(65536)
+            except socket.error:
+                return
+            contact=self._contacts.get(sender)
+            if contact is None:
+                contact=AnnouncedContact(sender[0],sender[1],self._loop)
+            try:
+                contact.receive(datagram)
+            except InsaneError:
+                self.bad+=1
+                continue
+            self._contacts[sender]=contact
+            if contact.connected() and sender not in self._systems:
+                system=RemoteSystem(contact)
+                self._systems[sender]=system
+                self._callback.call("system.announced",system)
+
+    def _check(self):
+        """Called by the event loop every second, to notice machines that
+        fell silent.
+        """
+        now=time.time()
+        for contact in self._contacts.values():
+            contact.check(now)
+        self._timer=self._loop.call_later(1.0,self._check)
+
+    def callback(self):
+        """Returns the callback class on which the 'system.announced' hook
+        is called.
+        """
+        return self._callback
+
+    def systems(self):
+        """Returns the list of systems heard so far.
+        """
+        return self._systems.values()
+
+    def close(self):
+        """Stops listening.
+        """
+        self._timer.cancel()
+        self._loop.remove_reader(self._socket)
+        self._socket.close()
+
+
 class RemoteSystem(System):
     """Represents a remote system.
     """
@@ -117,21 +902,45 @@ class RemoteSystem(System):
         RemoteContact passed to it (generally by get_remote).
         """
         #initialize stuff
-        addr=contact.addr()
-        System.__init__(self,addr)
+        System.__init__(self,contact.name())
         self._contact=contact
         #assume certain things - we have uptime, memory, etc...
         self.set_uptime(RemoteUptime(contact))
         self.set_memory(RemoteMemory(contact))
         self.set_processlist(RemoteProcessList(contact))
         #get information from the contact
-        #get metadata
-        info=contact.query('meta')
-        self._meta=cPickle.loads(info)
-        #get overview of parts
-        info=contact.query('overview')
+        self._snapshots=True
+        self._subscribed=False
+        self._running=False
+        self._timer=None
+        self._stamps={} #part -> (previous,latest) (mono,seq,metrics)
+        self._missed={} #part -> number of samples missed
+        #pushes held back while catching up (see backfill())
+        self._held=None
+        self._held_lock=threading.Lock()
+        if contact.connected():
+            self.sync()
+        #follow the connection
+        contact.callback().hook("connection.changed",self.catch_state)
+
+    def sync(self):
+        """Reads the metadata and the overview of parts from the remote
+        machine, adding any parts that are not known yet.
+
+        Returns True if any parts were added.
+        """
+        contact=self._contact
+        #get metadata and overview of parts, in one go
+        (meta,info)=contact.query_all(['meta','overview'])
+        if contact.framed():
+            self._meta=codec.decode_meta(meta)
+        else:
+            self._meta=codec.safe_loads(meta)
+        known=set([part.key() for part in self.parts()])
         lines=re.split("\n",info)
         for line in lines:
+            if line in known:
+                continue
             #processor?
             match=re.match("^processor ([a-z0-9]+)",line)
             if match:
@@ -142,13 +951,382 @@ class RemoteSystem(System):
             if match:
                 #create the filesystem and add it to the system
                 self.add_filesystem(RemoteFilesystem(match.group(1),contact))
+        return len(self.parts())>len(known)
 
+    def catch_state(self,contact):
+        """Reports a change in the state of the connection, by calling the
+        'connection.up' or 'connection.down' hook with the system, and
+        re-syncs the system after a reconnection. A system that was run
+        before it was ever connected starts following the remote machine
+        now.
+        """
+        if contact.connected():
+            try:
+                added=self.sync()
+                #subscribed before the history is caught up with, so that
+                #nothing sampled in between is missed
+                self._hold()
+                if self._running and self._timer is None and \
+                        not self._subscribed:
+                    self.start()
+                elif added and self._subscribed:
+                    self.subscribe()
+                self.backfill()
+            except RemoteError:
+                #lost again; we'll be back
+                return
+        else:
+            #the subscription is renewed as soon as we're back, before
+            #the history is caught up with
+            self._hold()
+        self.callback().call("connection.%s" % contact.state(),self)
 
     def contact(self):
         """Returns the backing RemoteContact object.
         """
         return self._contact
 
+    def served_parts(self):
+        """Returns a list of all parts whose data is served by the remote
+        machine.
+        """
+        return ([self.uptime(),self.memory()]+
+                self.processors()+
+                self.filesystems())
+
+    def run(self):
+        """Runs the system monitor.
+
+        If the remote machine can push samples, all served parts are
+        subscribed to at their own intervals, and updated as samples
+        arrive. Otherwise, all parts that are due are refreshed together,
+        with a single snapshot query, at the interval of the part that
+        updates most often.
+
+        If the remote machine has not been reached yet, this happens once
+        it is.
+        """
+        self._due={}
+        self._timer=None
+        self._running=True
+        for part in self.served_parts():
+            if not part.delay():
+                part.set_delay(self.delay())
+        if self._contact.connected():
+            self._hold()
+            self.start()
+            try:
+                self.backfill()
+            except RemoteError:
+                pass
+
+    def start(self):
+        """Starts following the connected remote machine, as described
+        in run().
+        """
+        if self._contact.framed():
+            self._subscribed=True
+            try:
+                self.subscribe()
+            except RemoteError:
+                #renewed when the connection comes back
+                pass
+        else:
+            self.tick()
+
+    def subscribe(self):
+        """Subscribes to all served parts, at their own intervals.
+        """
+        intervals={}
+        for part in self.served_parts():
+            if not part.delay():
+                part.set_delay(self.delay())
+            if part.delay()!=-1:
+                intervals[part.key()]=part.delay()
+        self._contact.subscribe(intervals,self.catch_push)
+
+    def stop(self):
+        """Stops the system monitor.
+        """
+        self._running=False
+        if self._subscribed:
+            self._subscribed=False
+            try:
+                self._contact.unsubscribe()
+            except RemoteError:
+                pass
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def catch_push(self,samples):
+        """Updates the system from samples pushed by the remote machine.
+        """
+        with self._held_lock:
+            if self._held is not None:
+                self._held.extend(samples)
+                return
+        self.apply(samples)
+
+    def backfill(self,parts=None):
+        """Fills the histories of the given parts (by default, all served
+        parts) with the samples the remote machine kept of them since the
+        latest ones recorded, so that their histories have no holes after
+        a reconnection, and go back as far as the remote machine's on
+        startup.
+
+        Parts without a history are skipped, as are remote machines that do
+        not keep samples. Samples pushed meanwhile are applied afterwards.
+        """
+        try:
+            if self._contact.framed():
+                self._backfill(parts)
+        finally:
+            self._release()
+
+    def _backfill(self,parts):
+        if parts is None:
+            parts=self.served_parts()
+        last={} #key -> time of the latest sample recorded
+        histories={}
+        for part in parts:
+            history=part.history()
+            if history is not None and hasattr(history,'last_time'):
+                histories[part.key()]=(part,history)
+                last[part.key()]=history.last_time()
+        if not histories:
+            return
+        times=last.values()
+        if None in times:
+            since=None
+        else:
+            since=min(times)
+        seqs={}
+        while True:
+            samples=self._contact.query(protocol.history(histories.keys(),
+                                                         since,seqs))
+            if isinstance(samples,str):
+                #not understood
+                return
+            self.acquire()
+            try:
+                for (key,data,t,mono,seq) in samples:
+                    seqs[key]=seq
+                    (part,history)=histories[key]
+                    if self.seen(part,t,mono,seq) or \
+                            (self.stamp(part) is None and
+                             last[key] is not None and t<=last[key]):
+                        continue
+                    last[key]=t
+                    #(the update hook isn't called for every sample, as it
+                    #would record the sample a second time)
+                    part.load(data)
+                    part.set_sampled(t)
+                    self._stamp(part,mono,seq,
+                                self._stamps.get(part,(None,None))[1])
+                    history.record(t)
+            finally:
+                self.release()
+            if len(samples)<protocol.HISTORY_PAGE:
+                return
+
+    def _hold(self):
+        """Holds back pushes until _release() is called.
+        """
+        with self._held_lock:
+            if self._held is None:
+                self._held=[]
+
+    def _release(self):
+        """Applies the pushes held back during a backfill, leaving out the
+        samples it filled in already, and stops holding them back.
+        """
+        while True:
+            with self._held_lock:
+                held=self._held
+                if not held:
+                    self._held=None
+                    return
+                self._held=[]
+            parts=dict([(part.key(),part) for part in self.served_parts()])
+            fresh=[]
+            for (key,data,t,mono,seq) in held:
+                part=parts.get(key)
+                if part is not None and self.seen(part,t,mono,seq):
+                    #backfilled
+                    continue
+                fresh.append((key,data,t,mono,seq))
+            self.apply(fresh)
+
+    def tick(self):
+        """Refreshes all parts that are due, and sets the timer for the
+        next refresh.
+        """
+        now=time.time()
+        parts=self.served_parts()
+        due=[part for part in parts if self._due.get(part,0)<=now]
+        try:
+            self.refresh(due)
+        except RemoteError:
+            #the contact reconnects by itself; keep trying
+            pass
+        for part in due:
+            self._due[part]=now+part.delay()
+        delays=[self._due[part] for part in parts if part.delay()!=-1]
+        if delays:
+            loop=self._contact.loop()
+            self._timer=loop.call_later(max(0,min(delays)-time.time()),
+                                        loop.defer,self.tick)
+
+    def refresh(self,parts=None):
+        """Refreshes the given parts (by default, all served parts) with a
+        single round trip to the remote machine, and calls their update
+        hooks.
+
+        If the remote machine does not support snapshots, each part is
+        queried on its own (but, if possible, all queries are in flight at
+        once).
+        """
+        if parts is None:
+            parts=self.served_parts()
+        if not parts:
+            return
+        contact=self._contact
+        if self._snapshots:
+            info=contact.query("snapshot %s" %
+                               ",".join([part.key() for part in parts]))
+            if contact.framed():
+                self.apply(info,parts)
+                return
+            #(the line protocol doesn't tell when samples were taken)
+            now=time.time()
+            if info:
+                self.apply([(key,data,now,None,None) for (key,data)
+                            in codec.safe_loads(info).items()],parts)
+                return
+            #an old server
+            self._snapshots=False
+        replies=contact.query_all([part.key() for part in parts])
+        now=time.time()
+        self.apply([(part.key(),codec.parse_line(part.key(),info),now,
+                     None,None)
+                    for (part,info) in zip(parts,replies) if info],parts)
+
+    def apply(self,samples,parts=None):
+        """Loads samples (a list of (key,data,time,mono,seq) tuples, as
+        described in sysmon.codec) into the given parts (by default, all
+        served parts), and calls their update hooks.
+
+        The times and sequence numbers are those of the remote machine, or
+        None where it does not give them (the part is then taken to be
+        sampled at the time given). A sample that was loaded already (or
+        taken before the one that was, see seen()) is skipped, and when
+        samples of a part were missed, the 'samples.missed' hook is called
+        with the part.
+        """
+        if parts is None:
+            parts=self.served_parts()
+        parts=dict([(part.key(),part) for part in parts])
+        self.acquire()
+        try:
+            for (key,data,t,mono,seq) in samples:
+                part=parts.get(key)
+                if part is None:
+                    continue
+                if self.seen(part,t,mono,seq):
+                    #seen it, or a later one
+                    continue
+                last=self._stamps.get(part,(None,None))[1]
+                part.load(data)
+                part.set_sampled(t)
+                if mono is None:
+                    mono=t
+                self._stamp(part,mono,seq,last)
+                self.callback().call(part.update_hook(),part)
+        finally:
+            self.release()
+
+    def seen(self,part,t,mono,seq):
+        """Returns True if a sample of part taken at the time t (mono by
+        the monotonic clock of the remote machine), with the sequence
+        number seq, is no later than the latest sample loaded into it.
+
+        Samples are told apart by their sequence numbers, whatever the
+        wall clock of the remote machine does. A lower sequence number
+        than the latest only means an older sample if neither clock moved
+        on either; otherwise, the remote server was restarted (or the
+        remote machine rebooted), and numbers its samples afresh.
+        """
+        latest=self._stamps.get(part,(None,None))[1]
+        if seq is None or latest is None or latest[1] is None:
+            return False
+        if seq>latest[1]:
+            return False
+        if mono is not None and mono>latest[0]:
+            #a new server on the same machine
+            return False
+        return part.sampled() is not None and t<=part.sampled()
+
+    def _stamp(self,part,mono,seq,last):
+        """Keeps the monotonic time, sequence number and metrics of the
+        sample just loaded into part, following the latest one before.
+        """
+        metrics={}
+        for (name,value) in part.metrics().items():
+            try:
+                metrics[name]=float(value())
+            except (KeyError,TypeError,ValueError):
+                pass
+        if last is not None and seq is not None and last[1] is not None \
+                and seq>last[1]+1:
+            delay=part.delay()
+            if delay is None or delay<=0:
+                delay=self.delay()
+            if delay and mono-last[0]>GAP_FACTOR*delay:
+                self._missed[part]=self._missed.get(part,0)+seq-last[1]-1
+                self.callback().call("samples.missed",part)
+        self._stamps[part]=(last,(mono,seq,metrics))
+
+    def stamp(self,part):
+        """Returns the time of the latest sample of part by the monotonic
+        clock of the remote machine, and its sequence number, as a tuple
+        (mono,seq), or None if no sample was loaded. Both are None for
+        remote machines that do not give them.
+        """
+        latest=self._stamps.get(part,(None,None))[1]
+        if latest is None:
+            return None
+        return latest[:2]
+
+    def missed(self,part=None):
+        """Returns the number of samples of part (by default, of all parts)
+        that were taken by the remote machine but never received.
+        """
+        if part is None:
+            return sum(self._missed.values())
+        return self._missed.get(part,0)
+
+    def rate(self,part,name):
+        """Returns the rate of change, per second, of the named metric of
+        part between its latest two samples, or None if it is not known.
+
+        The time between the samples is measured by the monotonic clock of
+        the remote machine, so delays on the way do not show up in the
+        rate.
+        """
+        (previous,latest)=self._stamps.get(part,(None,None))
+        if previous is None or latest is None:
+            return None
+        if (latest[1] is None)!=(previous[1] is None):
+            #the times are not from the same clock
+            return None
+        if latest[1] is not None and latest[1]<previous[1]:
+            #the remote machine was restarted
+            return None
+        elapsed=latest[0]-previous[0]
+        if elapsed<=0 or name not in latest[2] or name not in previous[2]:
+            return None
+        return (latest[2][name]-previous[2][name])/elapsed
+
 
 class RemoteUptime(Uptime):
     """Represents the uptime of a remote system.
@@ -168,8 +1346,13 @@ class RemoteUptime(Uptime):
         return "uptime.updated"
 
     def do_update(self):
-        info=self._contact.query('uptime')
-        self._uptime=int(info)
+        self.load(self._contact.sample(self.key()))
+
+    def load(self,data):
+        """Loads the uptime as served by yasmond, in seconds.
+        """
+        if data is not None:
+            self._uptime=float(data)
         
     def contact(self):
         """Returns the backing RemoteContact object.
@@ -195,9 +1378,12 @@ class RemoteProcessor(Processor):
         return "processor.%s.updated" % self.name()
 
     def do_update(self):
-        info=self._contact.query("processor %s" % self.name())
-        #load as pickle'd from the string
-        self._dict=cPickle.loads(info)
+        self.load(self._contact.sample(self.key()))
+
+    def load(self,data):
+        """Loads the processor's dictionary as served by yasmond.
+        """
+        self._dict=data
 
     def dict(self):
         return self._dict
@@ -218,9 +1404,12 @@ class RemoteMemory(Memory):
         return "memory.updated"
         
     def do_update(self):
-        info=self._contact.query('memory')
-        #load as pickle'd from the string
-        self._dict=cPickle.loads(info)
+        self.load(self._contact.sample(self.key()))
+
+    def load(self,data):
+        """Loads the memory dictionary as served by yasmond.
+        """
+        self._dict=data
 
     def dict(self):
         return self._dict
@@ -248,10 +1437,12 @@ class RemoteFilesystem(Filesystem):
         return "filesystem.updated"
 
     def do_update(self):
-        info=self._contact.query('filesystem '+self._name)
-        #load as pickle'd from the string
-        info=cPickle.loads(info)
-        (self.sz,self.free,self.mount)=info
+        self.load(self._contact.sample(self.key()))
+
+    def load(self,data):
+        """Loads the (size,available,mount point) tuple served by yasmond.
+        """
+        (self.sz,self.free,self.mount)=data
 
     def mount_point(self):
         return self.mount
@@ -283,6 +1474,31 @@ class RemoteProcessList(ProcessList):
         """
         ProcessList.__init__(self)
         self._contact=contact
+        self._processes=[]
+
+    def processes(self):
+        """Returns the processes fetched by the latest call to top().
+        """
+        return self._processes
+
+    def top(self,n,by='cpu',user=None,name=None):
+        """Returns the n processes using the most of by, as described in
+        sysmon.system.top_processes(). They are picked by the remote
+        machine, which sends only those.
+        """
+        if by not in PROCESS_RANKS:
+            raise UserError("cannot rank processes by %s" % by)
+        contact=self._contact
+        reply=contact.query(protocol.top(n,by,user,name))
+        if not reply:
+            #the remote machine doesn't know about processes
+            processes=[]
+        elif contact.framed():
+            processes=codec.decode_processes(reply)
+        else:
+            processes=codec.safe_loads(reply)
+        self._processes=processes
+        return processes
 
     def contact(self):
         """Returns the backing RemoteContact object.
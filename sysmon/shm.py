@@ -0,0 +1,250 @@
+#########################################################################
+# YASMon - Yet Another System Monitor                                   #
+# Copyright (C) 2010  Scott Lawrence                                    #
+#                                                                       #
+# This program is free software: you can redistribute it and/or modify  #
+# it under the terms of the GNU General Public License as published by  #
+# the Free Software Foundation, either version 3 of the License, or     #
+# (at your option) any later version.                                   #
+#                                                                       #
+# This program is distributed in the hope that it will be useful,       #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+# GNU General Public License for more details.                          #
+#                                                                       #
+# You should have received a copy of the GNU General Public License     #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>. #
+#########################################################################
+
+"""Snapshots published in shared memory, for clients on the same machine
+as yasmond.
+
+yasmond writes the latest sample of every part into a file (normally in
+/dev/shm), which readers map into memory: reading the current values then
+takes no system calls at all, and yasmond does no work for them.
+
+The file starts with SNAPSHOT_HEADER: a magic string, the format version,
+a sequence number and the lengths of the two datagrams that follow, a
+layout datagram and a samples datagram as built by
+sysmon.codec.DatagramEncoder. The sequence number is a seqlock: it is odd
+while the snapshot is being written, and changes with every snapshot, so
+a reader that sees the same even number before and after reading knows
+that what it read is whole.
+"""
+
+import mmap,os,struct,time
+
+from error import *
+import codec,daemon
+
+#the start of a snapshot file (the sequence number is aligned, so that it
+#is written in one go)
+SNAPSHOT_HEADER=struct.Struct('=4sB3xQII')
+SNAPSHOT_MAGIC='YSMs'
+SNAPSHOT_VERSION=3
+
+#where the sequence number is in the file
+_SEQ=struct.Struct('=Q')
+_SEQ_OFFSET=8
+
+#the initial size of a snapshot file
+SNAPSHOT_SIZE=65536
+
+#the number of times a reader tries to get a whole snapshot before giving
+#up and keeping the one it has
+READ_TRIES=1000
+
+class SnapshotPublisher():
+    """Publishes the latest samples of all parts served from a cache in a
+    snapshot file, every interval seconds.
+
+    It is run as a task of a sysmon.daemon.Server.
+    """
+    def __init__(self,system,cache,path,interval):
+        """Creates the snapshot file at path, for the system served from
+        the given cache.
+        """
+        self._cache=cache
+        self._path=path
+        self._interval=interval
+        #(a snapshot is never sent anywhere, so nothing is cut in pieces)
+        self._encoder=codec.DatagramEncoder(system.meta(),interval,
+                                            max_size=None)
+        self._layout=''
+        fd=os.open(path,os.O_RDWR|os.O_CREAT|os.O_TRUNC,0644)
+        try:
+            os.ftruncate(fd,SNAPSHOT_SIZE)
+            self._map=mmap.mmap(fd,SNAPSHOT_SIZE)
+        finally:
+            os.close(fd)
+        self._seq=0
+        SNAPSHOT_HEADER.pack_into(self._map,0,SNAPSHOT_MAGIC,
+                                  SNAPSHOT_VERSION,0,0,0)
+        self._due=time.time()
+
+    def next_due(self):
+        return self._due
+
+    def run(self):
+        """Publishes the latest samples, if it is time to.
+        """
+        now=time.time()
+        if now<self._due:
+            return
+        self._due+=self._interval
+        if self._due<now:
+            #we fell behind; don't try to catch up
+            self._due=now+self._interval
+        cache=self._cache
+        samples=[]
+        #(relayed systems are not published)
+        for key in sorted(cache.keys()):
+            entry=cache.get(key)
+            if '/' not in key and entry is not None:
+                samples.append((key,)+entry)
+        datagrams=self._encoder.encode(samples,now,daemon.monotonic())
+        if len(datagrams)>1:
+            self._layout=datagrams[0]
+        self.publish(self._layout,datagrams[-1])
+
+    def publish(self,layout,samples):
+        """Writes a layout and a samples datagram into the file.
+        """
+        size=SNAPSHOT_HEADER.size+len(layout)+len(samples)
+        m=self._map
+        if size>len(m):
+            m.resize(max(size,2*len(m)))
+        #odd while writing
+        self._seq+=1
+        _SEQ.pack_into(m,_SEQ_OFFSET,self._seq)
+        start=SNAPSHOT_HEADER.size
+        m[start:start+len(layout)]=layout
+        start+=len(layout)
+        m[start:start+len(samples)]=samples
+        SNAPSHOT_HEADER.pack_into(m,0,SNAPSHOT_MAGIC,SNAPSHOT_VERSION,
+                                  self._seq,len(layout),len(samples))
+        self._seq+=1
+        _SEQ.pack_into(m,_SEQ_OFFSET,self._seq)
+
+    def close(self):
+        """Stops publishing, and removes the file.
+        """
+        self._map.close()
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+
+class SnapshotReader():
+    """Reads the snapshots published by a SnapshotPublisher.
+    """
+    def __init__(self,path):
+        """Maps the snapshot file at path.
+
+        InsaneError is raised if it is not a snapshot file.
+        """
+        self._path=path
+        self._map=None
+        self._open()
+        self._seq=None
+        self._decoder=codec.DatagramDecoder()
+        self._layout=None #the layout datagram decoded last
+        self._samples=[]
+
+    def _open(self):
+        if self._map is not None:
+            self._map.close()
+        fd=os.open(self._path,os.O_RDONLY)
+        try:
+            self._map=mmap.mmap(fd,0,access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        (magic,version,seq,n,m)=SNAPSHOT_HEADER.unpack_from(self._map,0)
+        if magic!=SNAPSHOT_MAGIC or version!=SNAPSHOT_VERSION:
+            raise InsaneError("not a snapshot: %s" % self._path)
+
+    def read(self):
+        """Returns the latest samples, as a list of
+        (key,data,time,mono,seq) tuples (see sysmon.codec).
+
+        If yasmond keeps writing while the snapshot is read (or died while
+        writing it), the samples read last time are returned.
+        """
+        m=self._map
+        for i in xrange(READ_TRIES):
+            (seq,)=_SEQ.unpack_from(m,_SEQ_OFFSET)
+            if seq==self._seq:
+                #nothing new
+                return self._samples
+            if seq&1:
+                continue
+            (magic,version,s,n,k)=SNAPSHOT_HEADER.unpack_from(m,0)
+            start=SNAPSHOT_HEADER.size
+            if start+n+k>len(m):
+                #the file grew
+                self._open()
+                m=self._map
+                continue
+            header=self._header(m,start+n,k)
+            if self._seq is not None and seq<self._seq:
+                if header is not None and \
+                        header[2]==self._decoder.session:
+                    #older than what we have; never decoded, so that the
+                    #decoder's counts stay right
+                    return self._samples
+                #a new yasmond took over the file
+                self._decoder=codec.DatagramDecoder()
+                self._layout=None
+                self._seq=None
+            try:
+                #(the same layout datagram is published until it changes;
+                #it is only counted if it came with these samples)
+                layout=m[start:start+n]
+                if layout!=self._layout:
+                    first=self._header(m,start,n)
+                    fresh=(first is not None and header is not None and
+                           (header[3]-first[3])&0xffffffff==1)
+                    self._decoder.decode(layout,fresh)
+                samples=self._decoder.decode(buffer(m,start+n,k))
+            except InsaneError:
+                samples=None
+            if samples is None or _SEQ.unpack_from(m,_SEQ_OFFSET)[0]!=seq:
+                #written meanwhile; forget whatever was read
+                self._decoder=codec.DatagramDecoder()
+                self._layout=None
+                continue
+            self._layout=layout
+            if samples:
+                self._seq=seq
+                self._samples=samples
+            break
+        return self._samples
+
+    def _header(self,m,start,size):
+        """Returns the header of the datagram of the given size at start,
+        unpacked, or None if it is too short.
+        """
+        if size<codec.DATAGRAM_HEADER.size:
+            return None
+        return codec.DATAGRAM_HEADER.unpack_from(m,start)
+
+    def sample(self,key):
+        """Returns the latest data of the part with the given key, or
+        None.
+        """
+        for sample in self.read():
+            if sample[0]==key:
+                return sample[1]
+        return None
+
+    def meta(self):
+        """Returns the metadata of the system.
+        """
+        self.read()
+        return self._decoder.meta
+
+    def close(self):
+        """Unmaps the snapshot file.
+        """
+        self._map.close()
@@ -20,9 +20,9 @@
 
 """
 
-import copy
+import copy,fnmatch,heapq
 from threading import Lock,Timer
-import re
+import re,time
 
 import callback
 from error import *
@@ -30,6 +30,9 @@ from error import *
 class System():
     """Represents an abstract system and implements some basic logic.
 
+    Adding a part calls the 'part.added' hook of callback() with the part.
+    Parts may be added while the system is running; the lists of parts
+    handed out before are not changed.
     """
     
     def __init__(self,name="no-name"):
@@ -153,7 +156,10 @@ class System():
         """Adds a processor to the system.
         """
         processor.set_system(self)
-        self._processors+=[processor]
+        #(replaced rather than extended, so that lists handed out before
+        #are left alone)
+        self._processors=self._processors+[processor]
+        self._callback.call("part.added",processor)
 
     def processors(self):
         """Returns a list of processors in the system.
@@ -184,7 +190,8 @@ class System():
         """adds a drive to the system
         """
         drive.set_system(self)
-        self._drives+=[drive]
+        self._drives=self._drives+[drive]
+        self._callback.call("part.added",drive)
 
     def drives(self):
         """Returns a list of all physical drives in the system.
@@ -195,7 +202,8 @@ class System():
         """adds a filesystem to the system
         """
         filesystem.set_system(self)
-        self._filesystems+=[filesystem]
+        self._filesystems=self._filesystems+[filesystem]
+        self._callback.call("part.added",filesystem)
 
     def filesystems(self):
         """Returns a list of all filesystems in the system.
@@ -206,7 +214,8 @@ class System():
         """Adds a network connection to the system.
         """
         nc.set_system(self)
-        self._netconns+=[nc]
+        self._netconns=self._netconns+[nc]
+        self._callback.call("part.added",nc)
 
     def networkconnections(self):
         """Returns a list of all network connections in the system
@@ -231,6 +240,8 @@ class SystemPart():
     def __init__(self):
         self._delay=None
         self._system=None
+        self._history=None
+        self._sampled=None
         self.timer=None
 
     def update_hook(self):
@@ -241,6 +252,14 @@ class SystemPart():
         """
         return "misc.updated"
 
+    def key(self):
+        """Returns a string identifying this part within its system, like
+        'processor cpu0'.
+
+        This is the same string used to query the part from yasmond.
+        """
+        return "misc"
+
     def values(self):
         """An abstract method returning a list of functions referring to (and
         returning) the data contained in an object of this class.
@@ -253,6 +272,17 @@ class SystemPart():
         """
         raise UnimplementedError("SystemParts must implement values()")
 
+    def metrics(self):
+        """Returns a dictionary mapping the names of this part's numeric
+        metrics to functions returning their current values.
+
+        Unlike values(), every function returned by this method must return
+        a single number, so that the metric can be stored in a typed array
+        (see sysmon.history). Parts without any numeric metrics return an
+        empty dictionary.
+        """
+        return {}
+
     def data_copy(self):
         """Returns a persistent object encapsulating all current data for this
         part.
@@ -264,6 +294,15 @@ class SystemPart():
         """
         return [None]
 
+    def sample(self):
+        """Returns the current data of this part in the form yasmond serves
+        it, or None if the part is not served.
+
+        Remote implementations of the part accept the same data in their
+        load() method.
+        """
+        return None
+
     @staticmethod
     def null():
         """Returns a null part to be used when no real part is
@@ -284,20 +323,24 @@ class SystemPart():
             
         #acquire the lock
         self.system().acquire()
-        #do the wuhk
-        self.do_update()
-
-        #call the appropriate hook
-        self.system().callback().call(self.update_hook(),self)
-
-        #don't set the timer if we're weird
-        if not self.delay()==-1:
-            #reset the timer
-            self.timer=Timer(self.delay(),self.update)
-            self.timer.daemon=True
-            self.timer.start()
-        #release the lock
-        self.system().release()
+        try:
+            #do the wuhk
+            self.do_update()
+            self._sampled=time.time()
+
+            #call the appropriate hook
+            self.system().callback().call(self.update_hook(),self)
+
+            #don't set the timer if we're weird
+            if not self.delay()==-1:
+                #reset the timer
+                self.timer=Timer(self.delay(),self.update)
+                self.timer.daemon=True
+                self.timer.start()
+        finally:
+            #release the lock (even if the update failed, so that the
+            #other parts can still be updated)
+            self.system().release()
 
     def callback(self):
         return self.system().callback()
@@ -333,8 +376,26 @@ class SystemPart():
         """
         return self._system
 
+    def sampled(self):
+        """Returns the time at which the current data of this part was
+        sampled, or None if it never was.
+        """
+        return self._sampled
+
+    def set_sampled(self,t):
+        """Sets the time at which the current data of this part was
+        sampled.
+        """
+        self._sampled=t
+
+    def set_history(self,history):
+        """Sets the history storing information about this part.
+        """
+        self._history=history
+
     def history(self):
-        """Returns the history storing information about this part.
+        """Returns the history storing information about this part, or
+        None if there is none.
         """
         return self._history
 
@@ -358,6 +419,15 @@ class Uptime(SystemPart):
     def values(self):
         return [self.uptime]
 
+    def metrics(self):
+        return {'uptime': self.uptime}
+
+    def sample(self):
+        return self.uptime()
+
+    def key(self):
+        return "uptime"
+
 class Processor(SystemPart):
     """Represents a single abstract processor.
     """
@@ -371,6 +441,15 @@ class Processor(SystemPart):
     def values(self):
         return [self.dict]
 
+    def metrics(self):
+        return {'usage': self.usage}
+
+    def sample(self):
+        return self.dict()
+
+    def key(self):
+        return "processor %s" % self.name()
+
     def name(self):
         """An appropriate name for the processor, like cpu4.
         """
@@ -426,6 +505,17 @@ class Memory(SystemPart):
     def values(self):
         return [self.dict]
 
+    def metrics(self):
+        return {'total': self.total_memory,
+                'free': self.free_memory,
+                'active': self.active_memory}
+
+    def sample(self):
+        return self.dict()
+
+    def key(self):
+        return "memory"
+
     def total_memory(self):
         """Returns the total amount of memory, in bytes.
         """
@@ -493,6 +583,16 @@ class Filesystem(SystemPart):
     def values(self):
         return []
 
+    def metrics(self):
+        return {'size': self.size,
+                'used': self.used}
+
+    def sample(self):
+        return (self.size(),self.available(),self.mount_point())
+
+    def key(self):
+        return "filesystem %s" % self.device()
+
     def size(self):
         """Returns the size, in bytes, of the filesystem.
         """
@@ -541,6 +641,31 @@ class Drive(SystemPart):
         return []
 
 
+#the fields of the tuples describing processes (see ProcessList)
+PROCESS_FIELDS=('pid','name','user','cpu','rss','io')
+
+#the fields processes may be ranked by
+PROCESS_RANKS=('cpu','rss','io')
+
+def top_processes(processes,n,by='cpu',user=None,name=None):
+    """Returns the n processes in the list of process tuples (see
+    ProcessList.processes()) using the most of by ('cpu', 'rss' or 'io'),
+    largest first. If a user is given, only the processes of that user are
+    counted, and if a name is given (a shell-style pattern), only those
+    whose name matches it.
+    """
+    if by not in PROCESS_RANKS:
+        raise UserError("cannot rank processes by %s" % by)
+    #(filtered as the heap is filled, without copying the list)
+    if user is not None:
+        processes=(process for process in processes if process[2]==user)
+    if name is not None:
+        processes=(process for process in processes
+                   if fnmatch.fnmatchcase(process[1],name))
+    i=PROCESS_FIELDS.index(by)
+    return heapq.nlargest(n,processes,key=lambda process: process[i])
+
+
 class ProcessList(SystemPart):
     """Represents a list of processes.
     """
@@ -551,6 +676,25 @@ class ProcessList(SystemPart):
     def values(self):
         return []
 
+    def key(self):
+        return "processlist"
+
+    def processes(self):
+        """Returns the processes running on the system, as of the latest
+        update, as a list of (pid,name,user,cpu,rss,io) tuples (see
+        PROCESS_FIELDS): cpu is the percentage of a processor the process
+        used since the previous update, rss the memory it has resident, in
+        bytes, and io the number of bytes per second it read from and
+        wrote to storage since the previous update.
+        """
+        return []
+
+    def top(self,n,by='cpu',user=None,name=None):
+        """Returns the n processes using the most of by, as described in
+        top_processes().
+        """
+        return top_processes(self.processes(),n,by,user,name)
+
 
 class NetworkConnection(SystemPart):
     """Represents a single network connection
@@ -23,7 +23,8 @@
 from unittest import *
 
 #available unit tests
-import localtest,remotetest,daemontest,testrunner
+import localtest,remotetest,daemontest,codectest,protocoltest,historytest,\
+    testrunner
 
 def run_tests():
     """Simple interface to run all tests.
@@ -31,6 +32,7 @@ def run_tests():
     #run the tests!
     runner=TextTestRunner(verbosity=2)
     #for each suite
-    suites=[localtest.suite(),remotetest.suite(),daemontest.suite()]
+    suites=[localtest.suite(),remotetest.suite(),daemontest.suite(),
+            codectest.suite(),protocoltest.suite(),historytest.suite()]
     for suite in suites:
         runner.run(suite)
@@ -0,0 +1,253 @@
+#########################################################################
+# YASMon - Yet Another System Monitor                                   #
+# Copyright (C) 2010  Scott Lawrence                                    #
+#                                                                       #
+# This program is free software: you can redistribute it and/or modify  #
+# it under the terms of the GNU General Public License as published by  #
+# the Free Software Foundation, either version 3 of the License, or     #
+# (at your option) any later version.                                   #
+#                                                                       #
+# This program is distributed in the hope that it will be useful,       #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+# GNU General Public License for more details.                          #
+#                                                                       #
+# You should have received a copy of the GNU General Public License     #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>. #
+#########################################################################
+
+"""Codec YASMon test suite.
+"""
+
+#unit tests
+import unittest
+
+import cPickle,os
+
+#to import modules with a strange path
+import sys
+sys.path=['..']+sys.path
+
+#import the needed YASMon modules
+from sysmon import codec,error
+
+#a processor's flags, as long as those of a recent server
+FLAGS=' '.join(['flag%d' % i for i in xrange(250)])
+
+def processor(n):
+    """Returns the data of a processor, as served by yasmond.
+    """
+    return {'usage': 100.0+n, 'cpu MHz': 2400.0,
+            'model name': 'Some Processor @ 2.40GHz', 'vendor_id': 'Some',
+            'cpu family': '6', 'model': '85', 'stepping': '7',
+            'cache size': '36608 KB', 'cpu cores': '64',
+            'bogomips': '4800.00', 'flags': FLAGS}
+
+class EncoderTest(unittest.TestCase):
+    """Tests the encoding of samples on a connection.
+    """
+    def stream(self,n):
+        """Returns n rounds of samples of every kind of part, changing a
+        little from one round to the next.
+        """
+        rounds=[]
+        for i in xrange(n):
+            t=1000.0+i
+            rounds.append([
+                    ('uptime',500.0+i,t,50.0+i,i+1),
+                    ('memory',{'MemTotal': 1<<33, 'MemFree': (1<<30)+i*4096,
+                               'Cached': 1<<29},t,50.0+i,i+1),
+                    ('processor 0',processor(i%3),t,50.0+i,i+1),
+                    ('filesystem sda1',(1<<40,(1<<39)-i,'/'),t,50.0+i,i+1)])
+        return rounds
+
+    def assertSamples(self,samples,decoded):
+        self.assertEqual(len(samples),len(decoded))
+        for (sample,got) in zip(samples,decoded):
+            self.assertEqual(sample[0],got[0])
+            self.assertEqual(sample[1],got[1])
+            for i in (2,3):
+                self.assertAlmostEqual(sample[i],got[i],3)
+            self.assertEqual(sample[4],got[4])
+
+    def test_round_trip(self):
+        """Every kind of part is decoded as it was encoded."""
+        encoder=codec.Encoder()
+        decoder=codec.Decoder()
+        for samples in self.stream(10):
+            self.assertSamples(samples,decoder.decode(encoder.encode(samples)))
+
+    def test_deltas(self):
+        """Only the fields that changed are sent after a keyframe."""
+        encoder=codec.Encoder()
+        (first,second)=self.stream(2)
+        keyframe=encoder.encode(first)
+        delta=encoder.encode(second)
+        self.assertTrue(len(delta)<len(keyframe)/4)
+        #sent again: a byte each for the part, the three stamps and the
+        #empty mask
+        self.assertEqual(len(encoder.encode([second[0]])),5)
+
+    def test_keyframes(self):
+        """A keyframe is sent for each part every keyframe_interval
+        records, and puts a decoder that missed records right again."""
+        encoder=codec.Encoder(keyframe_interval=3)
+        good=codec.Decoder()
+        stale=codec.Decoder()
+        keyframes=0
+        for (i,samples) in enumerate(self.stream(12)):
+            payload=encoder.encode(samples[1:2])
+            keyframes+=bool(ord(payload[0])&4)
+            self.assertSamples(samples[1:2],good.decode(payload))
+            if i in (1,2):
+                #lost on the way
+                continue
+            decoded=stale.decode(payload)
+            if i>=4:
+                #after the keyframe of record 4
+                self.assertSamples(samples[1:2],decoded)
+        self.assertEqual(keyframes,3)
+
+    def test_absent_field(self):
+        """A field that goes away is absent once decoded."""
+        encoder=codec.Encoder()
+        decoder=codec.Decoder()
+        samples=[('memory',{'MemTotal': 10, 'MemFree': 5},1.0,1.0,1)]
+        decoder.decode(encoder.encode(samples))
+        samples=[('memory',{'MemTotal': 10},2.0,2.0,2)]
+        self.assertSamples(samples,decoder.decode(encoder.encode(samples)))
+
+    def test_static_change(self):
+        """Static fields are sent again when they change."""
+        encoder=codec.Encoder()
+        decoder=codec.Decoder()
+        data=processor(0)
+        decoder.decode(encoder.encode([('processor 0',data,1.0,1.0,1)]))
+        data=dict(data,flags='fpu')
+        samples=[('processor 0',data,2.0,2.0,2)]
+        self.assertSamples(samples,decoder.decode(encoder.encode(samples)))
+
+    def test_skipped(self):
+        """Parts without a schema, or without data, are not sent."""
+        encoder=codec.Encoder()
+        self.assertEqual(encoder.encode([('nope',1,1.0,1.0,1),
+                                         ('uptime',None,1.0,1.0,1)]),'')
+
+    def test_malformed(self):
+        """Malformed payloads raise InsaneError."""
+        payload=codec.Encoder().encode(self.stream(1)[0])
+        for bad in (payload[:-3],payload[:5],'\x08',
+                    codec.pack_varint(1)+codec.pack_string('nope')):
+            self.assertRaises(error.InsaneError,codec.Decoder().decode,bad)
+        #a delta for a part never sent in a keyframe
+        encoder=codec.Encoder()
+        encoder.encode([('uptime',1.0,1.0,1.0,1)])
+        payload=encoder.encode([('uptime',2.0,2.0,2.0,2)])
+        self.assertRaises(error.InsaneError,codec.Decoder().decode,payload)
+
+
+class SafeLoadsTest(unittest.TestCase):
+    """Tests the unpickling of replies in the line protocol.
+    """
+    def test_builtins(self):
+        """Builtin types are unpickled."""
+        for data in ({'a': (1,2.5,[u'x',None])},'text',-3,1<<70):
+            for protocol in (0,2):
+                self.assertEqual(codec.safe_loads(
+                        cPickle.dumps(data,protocol)),data)
+
+    def test_global(self):
+        """Pickles referring to a global are refused."""
+        for protocol in (0,2):
+            self.assertRaises(error.InsaneError,codec.safe_loads,
+                              cPickle.dumps(os.getcwd,protocol))
+            self.assertRaises(error.InsaneError,codec.safe_loads,
+                              cPickle.dumps(Exception('x'),protocol))
+
+    def test_reduce(self):
+        """Pickles calling something are refused."""
+        self.assertRaises(error.InsaneError,codec.safe_loads,
+                          "cos\nsystem\n(S'true'\ntR.")
+        self.assertRaises(error.InsaneError,codec.safe_loads,
+                          "c__builtin__\neval\n(S'1'\ntR.")
+
+    def test_garbage(self):
+        """Malformed pickles raise InsaneError."""
+        for bad in ('','(','garbage',cPickle.dumps([1,2])[:-2]):
+            self.assertRaises(error.InsaneError,codec.safe_loads,bad)
+
+
+class DatagramTest(unittest.TestCase):
+    """Tests the encoding of samples announced over UDP.
+    """
+    def samples(self,cpus):
+        samples=[('uptime',1234.5,10.0,5.0,7),
+                 ('memory',{'MemTotal': 1<<35, 'MemFree': 1<<30},10.0,5.0,7),
+                 ('filesystem sda1',(1<<40,1<<39,'/'),10.0,5.0,3)]
+        for n in xrange(cpus):
+            samples.append(('processor %d' % n,processor(n),10.0,5.0,7))
+        return samples
+
+    def test_large_layout(self):
+        """A layout too large for one datagram is cut in pieces."""
+        samples=self.samples(160)
+        encoder=codec.DatagramEncoder({'name': ('Name','big')},1.0)
+        datagrams=encoder.encode(samples,10.5,5.5)
+        self.assertTrue(len(datagrams)>2)
+        for datagram in datagrams:
+            self.assertTrue(len(datagram)<=codec.DATAGRAM_SIZE)
+        decoder=codec.DatagramDecoder()
+        decoded=[]
+        for datagram in datagrams:
+            decoded+=decoder.decode(datagram)
+        self.assertEqual(decoder.lost,0)
+        self.assertEqual(decoder.meta,{'name': ('Name','big')})
+        self.assertEqual([sample[0] for sample in decoded],
+                         [sample[0] for sample in samples])
+        for (sample,got) in zip(samples,decoded):
+            self.assertEqual(sample[1],got[1])
+            self.assertEqual(sample[4],got[4])
+            self.assertAlmostEqual(got[3],5.0,3)
+
+    def test_pieces_out_of_order(self):
+        """The layout is decoded whatever order its pieces arrive in."""
+        encoder=codec.DatagramEncoder({},1.0)
+        datagrams=encoder.encode(self.samples(128),10.5,5.5)
+        layouts=[d for d in datagrams
+                 if ord(d[4])==codec.DATAGRAM_LAYOUT]
+        decoder=codec.DatagramDecoder()
+        for datagram in reversed(layouts):
+            decoder.decode(datagram,False)
+        self.assertEqual(len(decoder.keys),131)
+
+    def test_missing_piece(self):
+        """Nothing is decoded until every piece of the layout is heard."""
+        encoder=codec.DatagramEncoder({},1.0)
+        datagrams=encoder.encode(self.samples(128),10.5,5.5)
+        decoder=codec.DatagramDecoder()
+        decoded=[]
+        for datagram in datagrams[1:]:
+            decoded+=decoder.decode(datagram)
+        self.assertEqual(decoded,[])
+        #the next announcement resends the layout after LAYOUT_INTERVAL
+        decoded=[]
+        for i in xrange(codec.LAYOUT_INTERVAL):
+            for datagram in encoder.encode(self.samples(128),11.5,6.5):
+                decoded+=decoder.decode(datagram)
+        self.assertEqual(len(decoded),131)
+
+    def test_unlimited(self):
+        """Without a size limit, there is one datagram of each kind."""
+        encoder=codec.DatagramEncoder({},1.0,max_size=None)
+        datagrams=encoder.encode(self.samples(128),10.5,5.5)
+        self.assertEqual(len(datagrams),2)
+        decoder=codec.DatagramDecoder()
+        decoder.decode(datagrams[0])
+        self.assertEqual(len(decoder.decode(datagrams[1])),131)
+
+def suite():
+    """Returns the relevant test suite.
+    """
+    loader=unittest.TestLoader()
+    return unittest.TestSuite([loader.loadTestsFromTestCase(test) for test
+                               in (EncoderTest,SafeLoadsTest,DatagramTest)])
@@ -22,14 +22,111 @@
 #unit tests
 import unittest
 
+import os,shutil,socket,tempfile,time
+
 #to import modules with a strange path
 import sys
 sys.path=['..']+sys.path
 
 #import the needed YASMon modules
-from sysmon import version
+from sysmon import codec,daemon,local,protocol,version
+
+class NegotiationTest(unittest.TestCase):
+    """Tests the switch from the line protocol to the framed protocol, as
+    a client on a Unix socket sees it.
+    """
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        path=os.path.join(self.dir,"yasmond.sock")
+        system=local.get_local()
+        system.set_delay(-1)
+        self.server=daemon.Server(system,0,address='127.0.0.1')
+        self.server.listen_unix(path)
+        self.sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.sock.setblocking(0)
+        self.reader=protocol.FrameReader(self.sock)
+
+    def tearDown(self):
+        self.sock.close()
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def receive(self,done):
+        """Serves the client until done(data received so far) is true, and
+        returns what it received.
+        """
+        data=''
+        deadline=time.time()+5
+        while not done(data) and time.time()<deadline:
+            self.server.serve_once(0.01)
+            try:
+                chunk=self.sock.recv(65536)
+            except socket.error:
+                continue
+            if not chunk:
+                break
+            data+=chunk
+        return data
+
+    def line(self,request):
+        self.sock.sendall(request+"\n")
+        return self.receive(lambda data: data.endswith("*DONE\n"))
+
+    def frame(self,request,tag=1):
+        self.sock.sendall(protocol.pack_frame(request,tag=tag))
+        data=self.receive(lambda data: self.whole(data))
+        self.reader.feed(data)
+        return self.reader.next_frame()
+
+    def whole(self,data):
+        if len(data)<protocol.FRAME_HEADER.size:
+            return False
+        (length,kind,tag)=protocol.FRAME_HEADER.unpack_from(data)
+        return len(data)>=protocol.FRAME_HEADER.size+length
+
+    def test_framed(self):
+        """A server speaking the version asked for switches to frames."""
+        self.assertEqual(self.line(protocol.negotiation()),
+                         protocol.negotiation()+"\n*DONE\n")
+        (kind,tag,payload)=self.frame("meta",tag=42)
+        self.assertEqual((kind,tag),(protocol.FRAME_REPLY,42))
+        self.assertTrue('version' in codec.decode_meta(payload))
+        (kind,tag,payload)=self.frame("uptime",tag=43)
+        self.assertEqual((kind,tag),
+                         (protocol.FRAME_REPLY|protocol.FRAME_SAMPLES,43))
+        self.assertEqual(codec.Decoder().decode(payload)[0][0],'uptime')
+
+    def test_version_mismatch(self):
+        """Any other version is turned down, and the line protocol goes
+        on."""
+        self.assertEqual(self.line("protocol %d" %
+                                   (protocol.PROTOCOL_VERSION+1)),"*DONE\n")
+        reply=self.line("uptime")
+        self.assertTrue(reply.endswith("\n*DONE\n"))
+        float(reply.split("\n")[0])
+
+    def test_compressed(self):
+        """Compression asked for before the switch applies to frames."""
+        request=protocol.compression(16)
+        self.assertEqual(self.line(request),request+"\n*DONE\n")
+        self.line(protocol.negotiation())
+        (kind,tag,payload)=self.frame("overview")
+        self.assertTrue(kind&protocol.FRAME_COMPRESSED)
+        (kind,payload)=protocol.Decompressor().unpack(kind,payload)
+        self.assertTrue("memory\n" in payload or "processor" in payload)
+
+    def test_oversized(self):
+        """A client sending a frame larger than MAX_FRAME is dropped."""
+        self.line(protocol.negotiation())
+        self.sock.sendall(protocol.FRAME_HEADER.pack(protocol.MAX_FRAME+1,
+                                                     protocol.FRAME_REQUEST,
+                                                     1))
+        self.receive(lambda data: False)
+        self.assertEqual(self.server.connections(),[])
 
 def suite():
     """Returns the relevant test suite.
     """
-    return unittest.TestSuite([])
+    return unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(NegotiationTest)])
@@ -0,0 +1,412 @@
+#########################################################################
+# YASMon - Yet Another System Monitor                                   #
+# Copyright (C) 2010  Scott Lawrence                                    #
+#                                                                       #
+# This program is free software: you can redistribute it and/or modify  #
+# it under the terms of the GNU General Public License as published by  #
+# the Free Software Foundation, either version 3 of the License, or     #
+# (at your option) any later version.                                   #
+#                                                                       #
+# This program is distributed in the hope that it will be useful,       #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+# GNU General Public License for more details.                          #
+#                                                                       #
+# You should have received a copy of the GNU General Public License     #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>. #
+#########################################################################
+
+"""History YASMon test suite.
+"""
+
+#unit tests
+import unittest
+
+import math,os,random,shutil,tempfile
+from cStringIO import StringIO
+
+#to import modules with a strange path
+import sys
+sys.path=['..']+sys.path
+
+#import the needed YASMon modules
+from sysmon import error,history
+
+NAN=float('nan')
+INF=float('inf')
+
+def samples(n,start=1000.0,step=1.0):
+    """Returns n (time,value) samples, step seconds apart.
+    """
+    return [(start+i*step,float(i*i%17)-8) for i in xrange(n)]
+
+class HistoryTestCase(unittest.TestCase):
+    def assertSameFloats(self,expected,got):
+        """Checks that two sequences of floats are equal, NaN included.
+        """
+        self.assertEqual([repr(float(x)) for x in expected],
+                         [repr(float(x)) for x in got])
+
+    def assertSeries(self,expected,(times,values)):
+        self.assertSameFloats([t for (t,value) in expected],times)
+        self.assertSameFloats([value for (t,value) in expected],values)
+
+class ColumnTest(HistoryTestCase):
+    """Tests the in-memory columns.
+    """
+    def test_round_trip(self):
+        """Samples appended are sliced back in order, NaN included."""
+        column=history.Column()
+        data=samples(100)+[(1100.0,NAN),(1101.0,INF),(1102.0,-0.0)]
+        for (t,value) in data:
+            column.append(t,value)
+        self.assertEqual(len(column),len(data))
+        self.assertSeries(data,column.slice())
+        self.assertSeries(data[10:20],column.slice(1010.0,1020.0))
+        self.assertSeries(data[-3:],column.slice(1100.0))
+        self.assertEqual(repr(column.last()),repr((1102.0,-0.0)))
+        chunks=list(column.chunks(7))
+        self.assertEqual([len(times) for (times,values) in chunks],
+                         [7]*14+[5])
+
+    def test_empty(self):
+        """Empty columns and empty ranges give empty slices."""
+        column=history.Column()
+        self.assertEqual(column.last(),None)
+        self.assertSeries([],column.slice())
+        self.assertEqual(list(column.chunks()),[])
+        for (t,value) in samples(10):
+            column.append(t,value)
+        self.assertSeries([],column.slice(1020.0))
+        self.assertSeries([],column.slice(None,1000.0))
+        self.assertSeries([],column.slice(1005.0,1002.0))
+        self.assertEqual(column.bounds(1005.0,1002.0),(5,5))
+
+    def test_maxlen(self):
+        """At least the last maxlen samples are kept."""
+        column=history.Column(10)
+        data=samples(1000)
+        for (t,value) in data:
+            column.append(t,value)
+            self.assertTrue(len(column)<=12)
+        n=len(column)
+        self.assertTrue(n>=10)
+        self.assertSeries(data[-n:],column.slice())
+
+class WindowTest(HistoryTestCase):
+    """Tests the sliding window aggregates.
+    """
+    def test_aggregates(self):
+        """Every aggregate matches the samples left in the window."""
+        random.seed(1)
+        stats=history.WindowStats(30)
+        data=[(float(t),random.uniform(-100,100)) for t in xrange(200)]
+        #an outlier, to be expired
+        data[50]=(50.0,1e12)
+        for (i,(t,value)) in enumerate(data):
+            stats.append(t,value)
+            window=[v for (s,v) in data[:i+1] if s>t-30]
+            self.assertEqual(len(stats),len(window))
+            self.assertEqual(stats.min(),min(window))
+            self.assertEqual(stats.max(),max(window))
+            mean=math.fsum(window)/len(window)
+            self.assertAlmostEqual(stats.mean()/mean,1.0,6)
+            stddev=math.sqrt(math.fsum([(v-mean)**2 for v in window])/
+                             len(window))
+            if stddev:
+                self.assertAlmostEqual(stats.stddev()/stddev,1.0,6)
+            median=sorted(window)[(len(window)-1)//2]
+            self.assertTrue(abs(stats.percentile(50)-median)<=
+                            abs(median)*0.02)
+
+    def test_empty(self):
+        """An expired window has no aggregates."""
+        stats=history.WindowStats(10)
+        self.assertEqual((stats.min(),stats.max(),stats.mean(),
+                          stats.stddev(),stats.percentile(50)),
+                         (None,)*5)
+        stats.append(0.0,5.0)
+        stats.expire(10.0)
+        self.assertEqual(len(stats),0)
+        self.assertEqual((stats.min(),stats.max(),stats.mean(),
+                          stats.stddev(),stats.percentile(50)),
+                         (None,)*5)
+
+    def test_nonfinite(self):
+        """NaN and infinite samples are skipped."""
+        stats=history.WindowStats(10)
+        for (t,value) in ((0.0,1.0),(1.0,NAN),(2.0,INF),(3.0,-INF),
+                          (4.0,3.0)):
+            stats.append(t,value)
+        self.assertEqual(len(stats),2)
+        self.assertEqual((stats.min(),stats.max(),stats.mean()),
+                         (1.0,3.0,2.0))
+        self.assertAlmostEqual(stats.percentile(50),1.0,1)
+        stats.append(14.0,NAN)
+        self.assertEqual(len(stats),0)
+
+    def test_history(self):
+        """A window asked for late starts from the recorded history."""
+        hist=history.ColumnarHistory()
+        for (t,value) in samples(100):
+            hist.append('x',t,value)
+        window=hist.window('x',10)
+        self.assertTrue(hist.window('x',10) is window)
+        self.assertEqual(len(window),10)
+        hist.append('x',1100.0,100.0)
+        self.assertEqual(window.max(),100.0)
+        self.assertEqual(len(window),10)
+
+class RollupTest(HistoryTestCase):
+    """Tests the consolidated tiers.
+    """
+    def test_consolidation(self):
+        """Each bucket holds the min, max, average and last value."""
+        tier=history.RollupTier(10,100)
+        for (t,value) in ((0,5.0),(3,1.0),(7,9.0),(9,4.0),(12,2.0)):
+            tier.add(t,value)
+        (times,mins,maxs,avgs,lasts)=tier.rows()
+        self.assertEqual(list(times),[0.0,10.0])
+        self.assertEqual(list(mins),[1.0,2.0])
+        self.assertEqual(list(maxs),[9.0,2.0])
+        self.assertEqual(list(avgs),[4.75,2.0])
+        self.assertEqual(list(lasts),[4.0,2.0])
+        self.assertEqual(tier.last(),(10,2.0))
+        self.assertEqual(tier.oldest(),0.0)
+
+    def test_wraparound(self):
+        """A full ring keeps the newest buckets, in order."""
+        tier=history.RollupTier(1,5)
+        for t in xrange(13):
+            tier.add(float(t),float(t))
+        self.assertEqual(len(tier),6)
+        self.assertEqual(tier.oldest(),7.0)
+        (times,mins,maxs,avgs,lasts)=tier.rows()
+        self.assertEqual(list(times),range(7,13))
+        self.assertEqual(list(avgs),range(7,13))
+        self.assertEqual(list(tier.rows(8.0,11.0)[0]),[8.0,9.0,10.0])
+        self.assertEqual(list(tier.rows(12.0)[0]),[12.0])
+
+    def test_empty(self):
+        """Empty tiers and empty ranges give no rows."""
+        tier=history.RollupTier(1,5)
+        self.assertEqual((tier.last(),tier.oldest()),(None,None))
+        self.assertEqual([list(col) for col in tier.rows()],[[]]*5)
+        for t in xrange(3):
+            tier.add(float(t),1.0)
+        self.assertEqual([list(col) for col in tier.rows(5.0)],[[]]*5)
+        self.assertEqual([list(col) for col in tier.rows(2.0,1.0)],[[]]*5)
+
+    def test_series(self):
+        """A series is consolidated into every tier."""
+        series=history.RollupSeries(((60,10),(1,100)))
+        for t in xrange(300):
+            series.append(float(t),1.0)
+        self.assertEqual([tier.step() for tier in series.tiers()],[1,60])
+        (step,rows)=series.query(resolution=60)
+        self.assertEqual(step,60)
+        self.assertEqual(list(rows[0]),[0.0,60.0,120.0,180.0,240.0])
+        #a full ring, and the bucket being filled
+        self.assertSeries([(float(t),1.0) for t in xrange(199,300)],
+                          series.slice())
+
+    def test_retention(self):
+        """Queries reaching past a tier's retention use a coarser tier."""
+        series=history.RollupSeries(((1,10),(5,10),(60,10)))
+        self.assertEqual(series.query(0.0,resolution=1)[0],1)
+        for t in xrange(100):
+            series.append(float(t),float(t))
+        self.assertEqual(series.query(95.0,resolution=1)[0],1)
+        self.assertEqual(series.query(95.0,resolution=5)[0],5)
+        (step,rows)=series.query(50.0,resolution=1)
+        self.assertEqual(step,5)
+        self.assertEqual(list(rows[0]),range(50,100,5))
+        self.assertEqual(series.query(0.0,resolution=1)[0],60)
+        self.assertEqual(series.query(resolution=1)[0],1)
+
+class MappedTest(HistoryTestCase):
+    """Tests the memory-mapped columns.
+    """
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.filename=os.path.join(self.dir,'x.hist')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_wraparound(self):
+        """A full ring keeps the last length samples, in order."""
+        column=history.MappedColumn(self.filename,10)
+        self.assertEqual(column.last(),None)
+        self.assertSeries([],column.slice())
+        data=samples(25)+[(1025.0,NAN)]
+        for (t,value) in data:
+            column.append(t,value)
+        self.assertEqual(len(column),10)
+        self.assertSeries(data[-10:],column.slice())
+        self.assertSeries(data[-5:-2],column.slice(1021.0,1024.0))
+        self.assertSeries([],column.slice(1030.0))
+        self.assertSeries(data[-10:],
+                          (sum([list(times) for (times,values)
+                                in column.chunks(3)],[]),
+                           sum([list(values) for (times,values)
+                                in column.chunks(3)],[])))
+        column.close()
+
+    def test_reopen(self):
+        """Samples survive reopening, and resizing the column."""
+        column=history.MappedColumn(self.filename,10)
+        data=samples(15)
+        for (t,value) in data:
+            column.append(t,value)
+        column.flush()
+        column.close()
+        column=history.MappedColumn(self.filename,10)
+        self.assertSeries(data[-10:],column.slice())
+        column.close()
+        column=history.MappedColumn(self.filename,4)
+        self.assertSeries(data[-4:],column.slice())
+        self.assertEqual(os.path.getsize(self.filename),
+                         history.mapped_size(4))
+        column.close()
+
+    def test_corrupt(self):
+        """A file that is not a mapped column is started afresh."""
+        f=open(self.filename,'wb')
+        f.write('x'*history.mapped_size(10))
+        f.close()
+        column=history.MappedColumn(self.filename,10)
+        self.assertEqual(len(column),0)
+        column.close()
+
+    def test_history(self):
+        """A mapped history reopens every metric, whatever its name."""
+        hist=history.MappedHistory(None,self.dir)
+        names=['a/b','..x','100%','c:d']
+        for name in names:
+            hist.append(name,1000.0,1.0)
+        hist.close()
+        hist=history.MappedHistory(None,self.dir)
+        self.assertEqual(hist.metrics(),sorted(names))
+        self.assertEqual(hist.series('a/b').last(),(1000.0,1.0))
+        hist.close()
+
+    def test_quote(self):
+        """Names are escaped into single path components."""
+        for name in ('a/b','%2F','c:d','x\0y','..x'):
+            quoted=history.quote_filename(name)
+            self.assertFalse('/' in quoted)
+            self.assertEqual(history.unquote_filename(quoted),name)
+        for name in ('','.','..'):
+            self.assertRaises(error.InsaneError,history.quote_filename,name)
+
+class CompressedTest(HistoryTestCase):
+    """Tests the Gorilla-style compressed blocks.
+    """
+    def test_round_trip(self):
+        """Samples are decoded as they were appended."""
+        data=samples(300)
+        #irregular timestamps, a long gap, and awkward values
+        data+=[(1300.5,1.5),(1300.501,NAN),(1400.0,INF),(1400.25,-INF),
+               (1e6,-0.0),(1e6+1,1e-300),(2e6,1.0/3)]
+        series=history.CompressedSeries(block_size=64)
+        for (t,value) in data:
+            series.append(t,value)
+        self.assertEqual(len(series),len(data))
+        self.assertEqual(len(series.blocks()),-(-len(data)//64))
+        self.assertSeries(data,series.slice())
+        self.assertSeries(data[100:200],series.slice(1100.0,1200.0))
+        self.assertSeries(data[-3:],series.slice(1e6))
+        self.assertEqual(series.last(),(2e6,1.0/3))
+        self.assertTrue(series.nbytes()<16*len(data)/4)
+
+    def test_empty(self):
+        """Empty series and empty ranges give nothing."""
+        series=history.CompressedSeries()
+        self.assertEqual(series.last(),None)
+        self.assertEqual(list(series),[])
+        self.assertSeries([],series.slice())
+        for (t,value) in samples(10):
+            series.append(t,value)
+        self.assertSeries([],series.slice(2000.0))
+        self.assertSeries([],series.slice(None,1000.0))
+        self.assertSeries([],series.slice(1005.0,1002.0))
+
+    def test_maxlen(self):
+        """Whole blocks are dropped once maxlen samples are kept without
+        them."""
+        series=history.CompressedSeries(block_size=16,maxlen=32)
+        data=samples(200)
+        for (t,value) in data:
+            series.append(t,value)
+            self.assertTrue(len(series)<=48)
+        self.assertSeries(data[-len(series):],series.slice())
+
+class ExportTest(HistoryTestCase):
+    """Tests exporting and importing histories.
+    """
+    def histories(self):
+        a=history.ColumnarHistory()
+        for (t,value) in samples(50):
+            a.append('free',t,value)
+        a.append('free',1050.0,NAN)
+        b=history.CompressedHistory()
+        for (t,value) in samples(20,step=0.1):
+            b.append('usage, "quoted"',t,value)
+        return {'memory': a, 'processor 0': b}
+
+    def assertHistories(self,expected,got):
+        self.assertEqual(sorted(expected.keys()),sorted(got.keys()))
+        for key in expected:
+            self.assertEqual(expected[key].metrics(),got[key].metrics())
+            for name in expected[key].metrics():
+                (times,values)=expected[key].slice(name)
+                self.assertSeries(zip(times,values),got[key].slice(name))
+
+    def test_csv(self):
+        """Histories survive a CSV round trip."""
+        histories=self.histories()
+        f=StringIO()
+        history.export_csv(histories,f,size=16)
+        f.seek(0)
+        self.assertHistories(histories,
+                             history.load(history.import_csv(f,size=16)))
+
+    def test_binary(self):
+        """Histories survive a binary round trip."""
+        histories=self.histories()
+        f=StringIO()
+        history.export_binary(histories,f,size=16)
+        f.seek(0)
+        self.assertHistories(histories,
+                             history.load(history.import_binary(f)))
+
+    def test_empty(self):
+        """Nothing exported is nothing imported."""
+        f=StringIO()
+        history.export_binary({},f)
+        f.seek(0)
+        self.assertEqual(history.load(history.import_binary(f)),{})
+        f=StringIO()
+        history.export_csv({},f)
+        f.seek(0)
+        self.assertEqual(history.load(history.import_csv(f)),{})
+
+    def test_truncated(self):
+        """Truncated or foreign binary exports raise UserError."""
+        f=StringIO()
+        history.export_binary(self.histories(),f)
+        data=f.getvalue()
+        for bad in (data[:-1],data[:history.EXPORT_HEADER.size+3],
+                    'XXXX'+data[4:]):
+            self.assertRaises(error.UserError,list,
+                              history.import_binary(StringIO(bad)))
+
+def suite():
+    """Returns the relevant test suite.
+    """
+    loader=unittest.TestLoader()
+    return unittest.TestSuite([loader.loadTestsFromTestCase(test)
+                               for test in (ColumnTest,WindowTest,
+                                            RollupTest,MappedTest,
+                                            CompressedTest,ExportTest)])
@@ -0,0 +1,189 @@
+#########################################################################
+# YASMon - Yet Another System Monitor                                   #
+# Copyright (C) 2010  Scott Lawrence                                    #
+#                                                                       #
+# This program is free software: you can redistribute it and/or modify  #
+# it under the terms of the GNU General Public License as published by  #
+# the Free Software Foundation, either version 3 of the License, or     #
+# (at your option) any later version.                                   #
+#                                                                       #
+# This program is distributed in the hope that it will be useful,       #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+# GNU General Public License for more details.                          #
+#                                                                       #
+# You should have received a copy of the GNU General Public License     #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>. #
+#########################################################################
+
+"""Protocol YASMon test suite.
+"""
+
+#unit tests
+import unittest
+
+import socket,zlib
+
+#to import modules with a strange path
+import sys
+sys.path=['..']+sys.path
+
+#import the needed YASMon modules
+from sysmon import error,protocol
+
+class FrameReaderTest(unittest.TestCase):
+    """Tests the reading of frames.
+    """
+    def test_split(self):
+        """A frame received a byte at a time is only returned whole."""
+        frame=protocol.pack_frame("hello",protocol.FRAME_REPLY,7)
+        reader=protocol.FrameReader(None)
+        for c in frame[:-1]:
+            reader.feed(c)
+            self.assertEqual(reader.next_frame(),None)
+            self.assertTrue(reader.wanted()>=1)
+        reader.feed(frame[-1])
+        self.assertEqual(reader.next_frame(),(protocol.FRAME_REPLY,7,"hello"))
+        self.assertEqual(reader.available(),0)
+
+    def test_several(self):
+        """Several frames received at once are returned in order, and the
+        start of the next one is kept."""
+        frames=[protocol.pack_frame("x"*n,protocol.FRAME_REQUEST,n)
+                for n in (0,1,300)]
+        data=''.join(frames)
+        reader=protocol.FrameReader(None,size=64)
+        reader.feed(data[:-10])
+        self.assertEqual(reader.next_frame(),(protocol.FRAME_REQUEST,0,""))
+        self.assertEqual(reader.next_frame(),(protocol.FRAME_REQUEST,1,"x"))
+        self.assertEqual(reader.next_frame(),None)
+        self.assertEqual(reader.wanted(),10)
+        reader.feed(data[-10:])
+        self.assertEqual(reader.next_frame(),
+                         (protocol.FRAME_REQUEST,300,"x"*300))
+
+    def test_socket(self):
+        """Frames are read from a socket, and larger ones than the buffer
+        make it grow."""
+        (a,b)=socket.socketpair()
+        try:
+            reader=protocol.FrameReader(b,size=16)
+            payload="y"*1000
+            a.sendall(protocol.pack_frame(payload,protocol.FRAME_PUSH))
+            self.assertEqual(reader.read_frame(),
+                             (protocol.FRAME_PUSH,0,payload))
+            a.close()
+            self.assertRaises(EOFError,reader.read_frame)
+        finally:
+            a.close()
+            b.close()
+
+    def test_oversized(self):
+        """Frames larger than MAX_FRAME are refused from their header."""
+        reader=protocol.FrameReader(None)
+        reader.feed(protocol.FRAME_HEADER.pack(protocol.MAX_FRAME+1,
+                                               protocol.FRAME_REPLY,1))
+        self.assertRaises(error.InsaneError,reader.next_frame)
+
+
+class CompressionTest(unittest.TestCase):
+    """Tests the compression of frames.
+    """
+    def unpack(self,frame,decompressor):
+        reader=protocol.FrameReader(None)
+        reader.feed(frame)
+        (kind,tag,payload)=reader.next_frame()
+        return decompressor.unpack(kind,payload)
+
+    def test_threshold(self):
+        """Only payloads of at least the threshold are compressed."""
+        compressor=protocol.Compressor(threshold=100)
+        small=compressor.pack_frame("a"*99,protocol.FRAME_REPLY,1)
+        large=compressor.pack_frame("a"*100,protocol.FRAME_REPLY,2)
+        self.assertFalse(ord(small[4])&protocol.FRAME_COMPRESSED)
+        self.assertTrue(ord(large[4])&protocol.FRAME_COMPRESSED)
+        decompressor=protocol.Decompressor()
+        self.assertEqual(self.unpack(small,decompressor),
+                         (protocol.FRAME_REPLY,"a"*99))
+        self.assertEqual(self.unpack(large,decompressor),
+                         (protocol.FRAME_REPLY,"a"*100))
+        self.assertTrue(compressor.wire<compressor.raw)
+
+    def test_stream(self):
+        """Compressed payloads form one stream, which must be decompressed
+        in order, and may be received in any number of pieces."""
+        compressor=protocol.Compressor(threshold=1)
+        payloads=["sample %d " % i*50 for i in xrange(5)]
+        kind=protocol.FRAME_REPLY|protocol.FRAME_SAMPLES
+        frames=[compressor.pack_frame(payload,kind,i)
+                for (i,payload) in enumerate(payloads)]
+        #later frames refer to what came before
+        self.assertRaises(error.InsaneError,self.unpack,frames[1],
+                          protocol.Decompressor())
+        reader=protocol.FrameReader(None)
+        decompressor=protocol.Decompressor()
+        data=''.join(frames)
+        got=[]
+        for i in xrange(0,len(data),7):
+            reader.feed(data[i:i+7])
+            frame=reader.next_frame()
+            while frame is not None:
+                got.append(decompressor.unpack(frame[0],frame[2]))
+                frame=reader.next_frame()
+        self.assertEqual(got,[(kind,payload) for payload in payloads])
+
+    def test_bad(self):
+        """Payloads that are not zlib data are refused."""
+        frame=protocol.pack_frame("not zlib",
+                                  protocol.FRAME_REPLY|
+                                  protocol.FRAME_COMPRESSED)
+        self.assertRaises(error.InsaneError,self.unpack,frame,
+                          protocol.Decompressor())
+
+    def test_bomb(self):
+        """Payloads decompressing to more than MAX_FRAME are refused."""
+        z=zlib.compressobj()
+        payload=(z.compress("\0"*(protocol.MAX_FRAME+1))+
+                 z.flush(zlib.Z_SYNC_FLUSH))
+        frame=protocol.pack_frame(payload,protocol.FRAME_REPLY|
+                                  protocol.FRAME_COMPRESSED)
+        self.assertRaises(error.InsaneError,self.unpack,frame,
+                          protocol.Decompressor())
+
+
+class RequestTest(unittest.TestCase):
+    """Tests the building and parsing of requests.
+    """
+    def test_history(self):
+        """History requests are parsed as they were built."""
+        for (keys,since,seqs) in (([],None,{}),
+                                  (['memory','processor 0'],12.5,
+                                   {'memory': 3}),
+                                  (['h/uptime'],None,{'h/uptime': 9})):
+            self.assertEqual(protocol.parse_history(
+                    protocol.history(keys,since,seqs)),(keys,since,seqs))
+        self.assertEqual(protocol.parse_history("uptime"),None)
+        self.assertRaises(error.UserError,protocol.parse_history,
+                          "history since=soon")
+
+    def test_top(self):
+        """Top requests are parsed as they were built."""
+        self.assertEqual(protocol.parse_top(protocol.top(5,'rss','root')),
+                         (5,'rss','root',None))
+        self.assertRaises(error.UserError,protocol.parse_top,"top many")
+        self.assertRaises(error.UserError,protocol.parse_top,"top 1 by")
+
+    def test_compression(self):
+        """Compression requests are told apart."""
+        self.assertEqual(protocol.parse_compression(
+                protocol.compression(64)),64)
+        self.assertEqual(protocol.parse_compression("compress gzip 1"),None)
+
+
+def suite():
+    """Returns the relevant test suite.
+    """
+    loader=unittest.TestLoader()
+    return unittest.TestSuite([loader.loadTestsFromTestCase(test) for test
+                               in (FrameReaderTest,CompressionTest,
+                                   RequestTest)])
@@ -23,7 +23,7 @@
 from unittest import *
 
 #available unit tests
-import localtest,remotetest,daemontest
+import localtest,remotetest,daemontest,codectest,protocoltest,historytest
 
 class MyTestRunner():
     """Custom TestRunner implemenation for YASMon.